@@ -6,7 +6,6 @@ import time
 import json
 import requests
 import base64
-import hashlib
 import random
 import re
 import shutil
@@ -14,6 +13,11 @@ import sqlite3
 import bcrypt
 from shared_utils import clear_chat_history, getnvr_url
 from query_service import get_query_service
+from file_utils import calculate_file_hash
+from warmup import start_warmup, get_warmup_status_markdown, is_ready
+from http_client import get_http_session, endpoint_timeout
+from sse_parser import iter_sse
+from stream_frames import coalesced_stream
 
 
 # 定义初始最大允许的请求数
@@ -51,10 +55,19 @@ MODEL_LONG_NAME = "qwen-long"
 MODEL_VL_NAME = "qwen3-vl-plus"
 MODEL_NAME="qwen3-max"
 EMBEDDING_MODEL_NAME = "quentinz/bge-large-zh-v1.5:latest"
+# 智能体知识库工具模式：generate（知识库先生成答案）或 passages（直接返回带出处的原文片段，省去一次LLM生成）
+KB_TOOL_MODE = "generate"
+
+# 智能体对话事件的并发上限（工作流在共享事件循环中运行，不再受每请求线程数限制）
+CHAT_CONCURRENCY_LIMIT = 32
 
 # 默认用户
 DEFAULT_LOGGED_IN_NAME = "root"
 
+# 启动预热（嵌入模型、知识库索引、智能体服务、DashScope 连接），在后台执行
+ENABLE_WARMUP = True
+WARMUP_STEPS = ["embed", "kb", "service", "http"]
+
 # 任务管理相关
 ACTIVE_TASKS_FILE = "active_tasks.json"
 TASKS_DIR_NAME = "tasks"
@@ -488,15 +501,6 @@ def login(username_or_name, password, state):
 # 工具函数
 ##########################################
 
-# 计算文件内容的MD5哈希值
-def calculate_file_hash(file_path):
-    """计算文件内容的MD5哈希值，用于判断文件是否相同"""
-    hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
-
 # 读取目录下的文件列表
 def read_directory(directory_path, extflag=True):
     """读取目录下的所有文件，并将文件名作为列表中的一个元素。并返回列表"""
@@ -831,8 +835,9 @@ def upload_file_and_get_id(file_path, logged_in_name: str = DEFAULT_LOGGED_IN_NA
     """            
     api_key, _ = getapi_key(logged_in_name) 
     with open(file_path, 'rb') as f:
-        file_response = requests.post(
+        file_response = get_http_session().post(
             f"{QWEN_OPENAI_API_BASE}/files",
+            timeout=endpoint_timeout("upload"),
             headers={
                 "Authorization": f"Bearer {api_key}",
             },
@@ -1359,6 +1364,7 @@ def create_unique_task_name(task_name):
 ##########################################
 
 # 修改agent_chart函数以支持session_id 云端知识库
+@coalesced_stream
 def agent_chatX(prompt, session_state=None):
     # 从 session_state 获取登录用户，否则使用默认
     logged_in_name = DEFAULT_LOGGED_IN_NAME
@@ -1417,6 +1423,7 @@ def agent_chatX(prompt, session_state=None):
         yield "网络连接错误：请检查您的网络连接或稍后重试！", session_id
 
 #本地RAG查询服务 本地知识库
+@coalesced_stream
 def agent_chat(prompt, session_state=None):
     # 从 session_state 获取登录用户，否则使用默认
     logged_in_name = DEFAULT_LOGGED_IN_NAME
@@ -1487,64 +1494,17 @@ def agent_chativ(prompt, session_state=None):
         size = "1024*768"  # 图像大小
         isplus = "False"   # 是否启用增强版
         voice = "严肃男"   # 语音合成的声音
+        kb_mode = KB_TOOL_MODE  # 知识库工具模式
 
         # 导入agent_rag_service并调用其流式函数 不要提示导入，避免循环依赖
-        import asyncio
-        from queue import Queue, Empty
-        import threading
         from agent_rag_service import run_agent_workflow_stream
+        from agent_loop import iterate_async
 
-        output_queue = Queue()
-        result = []
-
-        def run_workflow_in_thread():
-            try:
-                # 获取事件循环，如果不存在则创建新的
-                try:
-                    loop = asyncio.get_running_loop()
-                except RuntimeError:
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                
-                async def execute_workflow():
-                    # 在异步上下文中执行流式工作流
-                    full_output = ""
-                    try:
-                        async for output in run_agent_workflow_stream(
-                                prompt, session_state, model_name, 
-                                embedding_model_name, size, isplus, voice):
-                            output_queue.put(output)
-                    except Exception as e:
-                        output_queue.put(f"工作流执行出错: {str(e)}")
-                    finally:
-                        output_queue.put(None)  # 发送结束标记
-
-                loop.run_until_complete(execute_workflow())
-            except Exception as e:
-                output_queue.put(f"线程执行出错: {str(e)}")
-                output_queue.put(None)
-
-        # 启动工作流线程
-        thread = threading.Thread(target=run_workflow_in_thread)
-        thread.start()
-
-        # 持续从队列中获取输出并流式返回给Gradio
-        full_output = ""
-        while True:
-            try:
-                item = output_queue.get(timeout=1)  # 1秒超时
-                if item is None:  # 结束标记
-                    break
-                full_output = item  # 更新完整输出内容
-                yield full_output, session_id  # 流式返回给Gradio
-            except Empty:
-                # 检查线程是否仍在运行
-                if not thread.is_alive():
-                    break
-                continue
-
-        # 等待线程完成
-        thread.join()
+        # 工作流作为任务在共享的事件循环线程中运行，这里逐项取用流式输出返回给Gradio
+        for full_output in iterate_async(run_agent_workflow_stream(
+                prompt, session_state, model_name,
+                embedding_model_name, size, isplus, voice, kb_mode)):
+            yield full_output, session_id  # 流式返回给Gradio
             
     except Exception as e:
         yield f"IV智能体执行出错: {str(e)}", session_id
@@ -1552,6 +1512,7 @@ def agent_chativ(prompt, session_state=None):
         traceback.print_exc()
         return
    
+@coalesced_stream
 def agent_chat_with_document(file_path, prompt, session_state=None):
     """使用agent_chat处理文档问答，支持 session_state 获取用户上下文"""
     logged_in_name = DEFAULT_LOGGED_IN_NAME
@@ -1582,8 +1543,9 @@ def agent_chat_with_document(file_path, prompt, session_state=None):
         full_content = ""
         try:
             # 使用全局 QWEN_OPENAI_API_BASE 和模型常量
-            response = requests.post(
+            response = get_http_session().post(
                 f"{QWEN_OPENAI_API_BASE}/chat/completions",
+                timeout=endpoint_timeout("chat"),
                 headers={
                     "Authorization": f"Bearer {dashscope_api_key}",
                     "Content-Type": "application/json"
@@ -1601,24 +1563,12 @@ def agent_chat_with_document(file_path, prompt, session_state=None):
             )
             
             if response.status_code == 200:
-                for line in response.iter_lines():
-                    if line:
-                        decoded_line = line.decode('utf-8')
-                        if decoded_line.startswith("data:"):
-                            data_str = decoded_line[5:]  # 移除 "data:" 前缀
-                            if data_str.strip() == "[DONE]":
-                                return full_content, session_id
-                            
-                            try:
-                                data = json.loads(data_str)
-                                if 'choices' in data and len(data['choices']) > 0:
-                                    delta = data['choices'][0].get('delta', {})
-                                    content = delta.get('content', '')
-                                    if content:
-                                        full_content += content
-                                        yield full_content, session_id
-                            except json.JSONDecodeError:
-                                continue
+                for event in iter_sse(response.iter_content(chunk_size=None)):
+                    if event.kind == "done":
+                        return full_content, session_id
+                    if event.kind == "delta":
+                        full_content += event.text
+                        yield full_content, session_id
                 return full_content, session_id
             else:
                 print(f"提取文件内容失败: {response.status_code}, {response.text}")
@@ -1630,6 +1580,7 @@ def agent_chat_with_document(file_path, prompt, session_state=None):
     except Exception as e:
         yield f"文件处理失败: {str(e)}", session_id
 
+@coalesced_stream
 def agent_chat_with_image(file_path, prompt, session_state=None):
     """使用agent_chat处理图像问答，支持 session_state 获取用户上下文"""
     logged_in_name = DEFAULT_LOGGED_IN_NAME
@@ -1658,8 +1609,9 @@ def agent_chat_with_image(file_path, prompt, session_state=None):
     
     try:
         encoded_image = encode_image_to_base64(file_path)        
-        response = requests.post(
+        response = get_http_session().post(
             f"{QWEN_OPENAI_API_BASE}/chat/completions",
+            timeout=endpoint_timeout("chat"),
             headers={
                 "Authorization": f"Bearer {dashscope_api_key}",
                 "Content-Type": "application/json",
@@ -1680,18 +1632,10 @@ def agent_chat_with_image(file_path, prompt, session_state=None):
         )
         
         full_response = ""
-        for chunk in response.iter_content(chunk_size=None):
-            if not chunk:
-                continue
-            try:           
-                chunk_str = chunk.decode('utf-8')
-                if chunk_str.startswith("data:"):
-                    data = json.loads(chunk_str[5:])
-                    if data.get("choices") and data["choices"][0].get("delta", {}).get("content"):
-                        full_response += data["choices"][0]["delta"]["content"]
-                        yield full_response, session_id         
-            except json.JSONDecodeError:
-                continue
+        for event in iter_sse(response.iter_content(chunk_size=None)):
+            if event.kind == "delta":
+                full_response += event.text
+                yield full_response, session_id
                 
     except Exception as e:
         yield f"图像处理失败: {str(e)}", session_id
@@ -1994,8 +1938,8 @@ def chat_with_history(file_path, user_input, session_state, ragchk, include_file
         for response, updated_session_id in response_gen:
             ai_response = response  # 持续更新为最新的响应
             final_session_id = updated_session_id
-            # 显示历史记录 + 当前AI响应
-            yield history_text + f"<div class='ai-message'>{ai_response}</div>\n\n", {"conversation_history": conversation_history.copy(), "session_id": final_session_id, "logged_in_name": logged_in_name, "class": session_state.get("class"), "name": session_state.get("name"), "gender": session_state.get("gender")}, gr.update(visible=False, value="")
+            # 显示历史记录 + 当前AI响应（流式过程中不闭合消息，保持新内容只在末尾追加，Gradio 只发送增量）
+            yield history_text + f"<div class='ai-message'>{ai_response}", {"conversation_history": conversation_history.copy(), "session_id": final_session_id, "logged_in_name": logged_in_name, "class": session_state.get("class"), "name": session_state.get("name"), "gender": session_state.get("gender")}, gr.update(visible=False, value="")
     
     # 将最终AI响应添加到历史记录
     if ai_response:
@@ -2971,7 +2915,9 @@ with gr.Blocks(title="教育智能体-高中信通版",theme="soft",css=css) as
     query_event =query_button.click(
         fn=chat_with_history,
         inputs=[file_input, query_input, session_state,ragchk,include_file_context], 
-        outputs=[query_output, session_state, html_output] 
+        outputs=[query_output, session_state, html_output],
+        concurrency_limit=CHAT_CONCURRENCY_LIMIT,
+        concurrency_id="chat"
     ).then(
         fn=refresh_file_explorer_after_chat,
         inputs=[session_state, history_file_explorer],
@@ -2989,7 +2935,9 @@ with gr.Blocks(title="教育智能体-高中信通版",theme="soft",css=css) as
     submit_event=query_input.submit(
         fn=chat_with_history,
         inputs=[file_input, query_input, session_state,ragchk,include_file_context], 
-        outputs=[query_output, session_state, html_output]
+        outputs=[query_output, session_state, html_output],
+        concurrency_limit=CHAT_CONCURRENCY_LIMIT,
+        concurrency_id="chat"
     ).then(
         fn=refresh_file_explorer_after_chat,
         inputs=[session_state, history_file_explorer],
@@ -3164,12 +3112,26 @@ with gr.Blocks(title="教育智能体-高中信通版",theme="soft",css=css) as
     
     with gr.Row():
             linkurl=gr.Markdown()
+    # 关闭预热时不显示预热状态，也不创建定时刷新
+    if ENABLE_WARMUP:
+        with gr.Row():
+                warmup_msg=gr.Markdown()
+                warmup_timer=gr.Timer(2)
     with gr.Row():
             gr.Markdown("""
                         <p style='text-align: center;'>
                         Copyright © 2025 By [UNET] All rights reserved.
                         </p>""")
     demo.load(fn=get_host,inputs=None,outputs=linkurl)
+
+    def refresh_warmup_status():
+        """刷新预热状态，预热结束后停止定时刷新"""
+        return get_warmup_status_markdown(), gr.Timer(active=not is_ready())
+
+    if ENABLE_WARMUP:
+        demo.load(fn=refresh_warmup_status, inputs=None, outputs=[warmup_msg, warmup_timer])
+        warmup_timer.tick(fn=refresh_warmup_status, inputs=None, outputs=[warmup_msg, warmup_timer])
+        start_warmup(MODEL_NAME, EMBEDDING_MODEL_NAME, DEFAULT_LOGGED_IN_NAME, ROOT_DIR, WARMUP_STEPS, KB_TOOL_MODE)
     demo.queue(default_concurrency_limit=8,max_size=20)
     demo.launch(
         server_name=SERVER_HOST,
@@ -0,0 +1,91 @@
+"""
+共享的智能体事件循环
+
+所有智能体工作流作为任务运行在常驻的事件循环线程上（可配置为少量几个，按轮询分配），
+不再为每个请求创建线程和事件循环。同步调用方（Gradio 生成器）通过 iterate_async 逐项取用异步生成器的输出：
+每取一项提交一次 __anext__ 并阻塞等待结果，没有队列轮询和超时等待。
+同步工具通过 asyncio.to_thread 在循环的默认线程池中执行，线程池按并发智能体数量放大。
+"""
+import os
+import asyncio
+import logging
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+AGENT_LOOP_THREADS = int(os.getenv("agent_loop_threads", "1"))
+# 事件循环默认线程池大小（同步工具、检索、asyncio.to_thread）
+AGENT_LOOP_EXECUTOR_WORKERS = int(os.getenv("agent_loop_executor_workers", "64"))
+
+
+class EventLoopThread:
+    """在独立的守护线程中常驻运行的事件循环"""
+
+    def __init__(self, name: str, executor_workers: int = AGENT_LOOP_EXECUTOR_WORKERS):
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=executor_workers, thread_name_prefix=f"{name}-worker"))
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """把协程提交到事件循环，返回 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        """在事件循环中执行协程并阻塞等待结果（不能在事件循环线程内调用）"""
+        return self.submit(coro).result()
+
+    def stats(self) -> dict:
+        """返回线程状态与循环中的任务数"""
+        async def count_tasks():
+            return len(asyncio.all_tasks())
+        alive = self._thread.is_alive()
+        return {"name": self._thread.name, "alive": alive, "tasks": self.run(count_tasks()) if alive else 0}
+
+
+_loops = None
+_next_loop = None
+_loops_lock = threading.Lock()
+
+
+def get_agent_loop() -> EventLoopThread:
+    """获取一个共享事件循环线程（首次调用时启动，多个循环时轮询分配）"""
+    global _loops, _next_loop
+    if _loops is None:
+        with _loops_lock:
+            if _loops is None:
+                loops = [EventLoopThread(f"agent-loop-{i}") for i in range(max(1, AGENT_LOOP_THREADS))]
+                _next_loop = itertools.cycle(loops)
+                _loops = loops
+                logger.info("智能体事件循环已启动: %d 个线程", len(loops))
+    with _loops_lock:
+        return next(_next_loop)
+
+
+def iterate_async(agen, runner: EventLoopThread = None):
+    """
+    功能：在共享事件循环中驱动异步生成器，作为同步生成器逐项返回结果。
+    参数：agen：异步生成器对象（尚未开始迭代）；runner：指定的事件循环线程，默认自动分配。
+    返回：同步生成器。调用方提前关闭时，在事件循环中关闭异步生成器（触发其 finally 清理）。
+    """
+    runner = runner or get_agent_loop()
+    try:
+        while True:
+            try:
+                yield runner.run(agen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        runner.run(agen.aclose())
+
+
+def get_agent_loop_stats() -> list:
+    """返回各事件循环线程的状态"""
+    return [loop.stats() for loop in (_loops or [])]
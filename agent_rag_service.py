@@ -11,18 +11,102 @@ from shared_utils import (
     VectorIndexRetriever,VectorStoreQueryMode,ContextChatEngine,ChatMemoryBuffer,BaseRetriever
 )
 from dashscope.audio.tts_v2 import SpeechSynthesizer, AudioFormat, ResultCallback
+from kb_pool import kb_pool, kb_lease, get_embed_model, resolve_kbname, HYBRID_ALPHA, VECTOR_BACKEND
+from semantic_cache import semantic_cache
+from rerank_cache import rerank_cache, sort_by_vector_score
+from web_search_cache import web_search_cache
+from context_packing import pack_context
+from llama_index.core.tools import FunctionTool
+from http_client import get_async_client, get_http_session, endpoint_timeout
+from sse_parser import iter_sse, aiter_sse
+from speculative_search import SpeculativeSearch, current_speculation, matches_web_search_triggers
+from output_channel import OutputChannel, current_channel, emit
+from session_memory import session_memories
 from typing import Dict, Any, AsyncGenerator, Optional
 import threading
 import asyncio
-from queue import Queue, Empty
+import logging
+from collections import OrderedDict
 
 
+logger = logging.getLogger(__name__)
+
 # 设置标准输出编码为UTF-8
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 
+# 知识库重新导入后清空对应的语义答案缓存
+kb_pool.add_reload_hook(semantic_cache.invalidate)
+
+# 知识库工具模式：generate（检索后由 ContextChatEngine 生成答案）、passages（直接把带出处的分块交给智能体LLM）
+KB_TOOL_MODES = ("generate", "passages")
+DEFAULT_KB_TOOL_MODE = "generate"
+DASHSCOPE_API_BASE = "https://dashscope.aliyuncs.com/api/v1"
+# 命中联网搜索触发词时并行推测执行知识库查询与联网搜索
+SPECULATIVE_SEARCH = True
+# 智能体服务缓存：最多保留的实例数、空闲超时（秒），以及每个实例 LLM 客户端与编译后工作流的估算固定开销
+SERVICE_CACHE_MAX_ENTRIES = 64
+SERVICE_CACHE_IDLE_SECONDS = 3600
+SERVICE_BASE_BYTES = 2 * 1024 * 1024
+
+
+def _threaded_tool(fn) -> FunctionTool:
+    """
+    同步工具的异步调用改用 asyncio.to_thread 执行：llama_index 默认用 run_in_executor，
+    不会把上下文变量带入线程，工具的 emit 输出会找不到当前请求的输出通道。
+    协程函数（如 set_name）直接交给工作流注册，不能经过这里：to_thread 只会创建协程而不会 await
+    """
+    if asyncio.iscoroutinefunction(fn):
+        raise TypeError(f"{fn.__name__} 是协程函数，请直接注册，不要用 _threaded_tool 包装")
+    async def async_fn(*args, **kwargs):
+        return await asyncio.to_thread(fn, *args, **kwargs)
+    return FunctionTool.from_defaults(fn=fn, async_fn=async_fn)
+
+
+def _read_base64(file_path: str) -> str:
+    """读取文件并返回 base64 字符串"""
+    with open(file_path, "rb") as f:
+        return base64.b64encode(f.read()).decode('utf-8')
+
+
+def _write_bytes(file_path: str, content: bytes):
+    with open(file_path, 'wb') as f:
+        f.write(content)
+
+
+def _read_bytes(file_path: str) -> bytes:
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+
+def _oss_form_fields(policy_data: dict, key: str) -> dict:
+    """OSS 表单上传的字段（file 字段需放在最后）"""
+    return {
+        'OSSAccessKeyId': policy_data['oss_access_key_id'],
+        'Signature': policy_data['signature'],
+        'policy': policy_data['policy'],
+        'x-oss-object-acl': policy_data['x_oss_object_acl'],
+        'x-oss-forbid-overwrite': policy_data['x_oss_forbid_overwrite'],
+        'key': key,
+        'success_action_status': '200',
+    }
+
+
+def _upload_content_type(file_name: str) -> str:
+    """根据文件扩展名确定上传到OSS的Content-Type"""
+    name = file_name.lower()
+    if name.endswith('.png'):
+        return "image/png"
+    if name.endswith(('.jpg', '.jpeg')):
+        return "image/jpeg"
+    if name.endswith('.gif'):
+        return "image/gif"
+    if name.endswith(('.mp3', '.wav')):
+        return "audio/mpeg"
+    return "application/octet-stream"
+
 
 class AgentRagService:
-    def __init__(self, model_name: str, embedding_model_name: str, logged_in_name: str, nvr1_url: str = "", nvr2_url: str = "", size: str = "1024*768", isplus: str = "False", voice: str = "严肃男"):
+    def __init__(self, model_name: str, embedding_model_name: str, logged_in_name: str, nvr1_url: str = "", nvr2_url: str = "", size: str = "1024*768", isplus: str = "False", voice: str = "严肃男", kb_mode: str = DEFAULT_KB_TOOL_MODE):
         self.model_name = model_name
         self.embedding_model_name = embedding_model_name
         self.logged_in_name = logged_in_name
@@ -31,7 +115,9 @@ class AgentRagService:
         self.size = size
         self.isplus = isplus
         self.voice = voice
+        self.kb_mode = kb_mode if kb_mode in KB_TOOL_MODES else DEFAULT_KB_TOOL_MODE
         self.memory = None
+        self.last_used = time.time()
 
         # 获取用户的API KEY
         self.dashscope_api_key, self.deepseek_api_key = getapi_key(logged_in_name)
@@ -49,16 +135,25 @@ class AgentRagService:
             extra_body={"enable_search": True}
         )
 
+        # 没有会话ID时（命令行、基准测试）使用的默认对话记忆；界面请求按会话使用 session_memories
         if self.memory is None:
             #self.memory = Memory(token_limit=8192)
             self.memory = ChatMemoryBuffer.from_defaults(token_limit=8192) #旧版本兼容
         # 初始化工作流
         self.iva_workflow = AgentWorkflow.from_tools_or_functions(
-            tools_or_functions=[self.query_knowledge_base, self.get_camera_image, self.vision_query_image,
-                                self.get_camera_video, self.vision_query_video,
-                                self.get_current_datetime, self.generate_image_show,
-                                self.generate_audio_show, self.generate_video_show, self.set_name,
-                                self.generate_lecture_video_by_topic, self.generate_lecture_script,self.web_search
+            # 网络密集的工具同时注册异步实现，工作流直接 await，不再为每次调用占用一个线程
+            tools_or_functions=[self.get_kb_tool(), _threaded_tool(self.get_camera_image),
+                                FunctionTool.from_defaults(fn=self.vision_query_image, async_fn=self.avision_query_image),
+                                _threaded_tool(self.get_camera_video),
+                                FunctionTool.from_defaults(fn=self.vision_query_video, async_fn=self.avision_query_video),
+                                _threaded_tool(self.get_current_datetime),
+                                FunctionTool.from_defaults(fn=self.generate_image_show, async_fn=self.agenerate_image_show),
+                                _threaded_tool(self.generate_audio_show),
+                                FunctionTool.from_defaults(fn=self.generate_video_show, async_fn=self.agenerate_video_show),
+                                self.set_name,
+                                FunctionTool.from_defaults(fn=self.generate_lecture_video_by_topic, async_fn=self.agenerate_lecture_video_by_topic),
+                                _threaded_tool(self.generate_lecture_script),
+                                FunctionTool.from_defaults(fn=self.web_search, async_fn=self.aweb_search)
                                 ],    
             llm=self.llm,
             initial_state={"name":"IVAgent"},
@@ -235,6 +330,32 @@ class AgentRagService:
             """
         )
 
+    def touch(self):
+        """记录最近一次使用时间"""
+        self.last_used = time.time()
+
+    def history_messages(self) -> int:
+        """返回实例自带对话记忆中的消息数"""
+        try:
+            return len(self.memory.get_all())
+        except Exception:
+            return 0
+
+    def estimated_bytes(self) -> int:
+        """粗略估算实例自身的常驻内存：固定开销 + 对话记忆中的消息 + 工作流各智能体的系统提示词"""
+        size = SERVICE_BASE_BYTES
+        try:
+            size += sum(sys.getsizeof(str(message.content or "")) for message in self.memory.get_all())
+        except Exception:
+            pass
+        agents = getattr(self.iva_workflow, "agents", None) or {}
+        size += sum(sys.getsizeof(agent.system_prompt or "") for agent in agents.values())
+        return size
+
+    def kb_handle(self):
+        """返回实例所用知识库已打开的句柄（未打开时返回 None），其内存由知识库池在多个实例间共享"""
+        return kb_pool.peek(resolve_kbname(self.logged_in_name))
+
     #获取摄像头的图像，并保存到cap目录中，并返回图像文件路径image_file_path。
     def get_camera_image(self, prompt: str):
         """
@@ -267,14 +388,14 @@ class AgentRagService:
             cap = cv2.VideoCapture(url)
             ret, frame = cap.read()
             if not ret:
-                print("RTSP 摄像头无法访问，使用本地摄像头...")
+                emit("RTSP 摄像头无法访问，使用本地摄像头...")
                 cap.release()
                 cap = cv2.VideoCapture(0)
         else:
             cap = cv2.VideoCapture(0)
             ret, frame = cap.read()
             if not ret:
-                print("本地摄像头无法打开...")
+                emit("本地摄像头无法打开...")
                 cap.release()
                 return None
             
@@ -295,11 +416,11 @@ class AgentRagService:
                     cv2.imwrite(image_file_path, frame)
                     #图像居中显示
                     htmlstr=f"<p style='text-align: center;'> <img src='/gradio_api/file={self.logged_in_name}/cap/{file_name}'  style='display: inline; vertical-align: middle;'></p>"
-                    print(htmlstr)
+                    emit(htmlstr)
                     #print(file_path)  
                     break            
                 else:
-                    print("无法读取摄像头图像。")
+                    emit("无法读取摄像头图像。")
                     return None
         cap.release()    
         return image_file_path
@@ -335,14 +456,14 @@ class AgentRagService:
             cap = cv2.VideoCapture(url)
             ret, frame = cap.read()
             if not ret:
-                print("RTSP 摄像头无法访问，使用本地摄像头...")
+                emit("RTSP 摄像头无法访问，使用本地摄像头...")
                 cap.release()
                 cap = cv2.VideoCapture(0)
         else:
             cap = cv2.VideoCapture(0)
             ret, frame = cap.read()
             if not ret:
-                print("本地摄像头无法打开...")
+                emit("本地摄像头无法打开...")
                 cap.release()
                 return None
         
@@ -369,7 +490,7 @@ class AgentRagService:
         while cap.isOpened() : 
             ret, frame = cap.read() 
             if not ret:
-                print("无法读取摄像头图像。")
+                emit("无法读取摄像头图像。")
                 break
             
             # 缩小帧的尺寸
@@ -392,8 +513,7 @@ class AgentRagService:
                     您的浏览器不支持HTML5视频标签。</video>
                     </div>
                     """
-        print(htmlstr)
-        sys.stdout.flush()
+        emit(htmlstr)
         return video_file_path
 
 
@@ -410,8 +530,9 @@ class AgentRagService:
         #print("vision_query_image:",image_file_path)
         with open(image_file_path, "rb") as image_file:
             base64str=base64.b64encode(image_file.read()).decode('utf-8')                     
-        response = requests.post(
+        response = get_http_session().post(
             f"{QWEN_OPENAI_API_BASE}/chat/completions",
+            timeout=endpoint_timeout("chat"),
             headers={
                 "Authorization": f"Bearer {self.dashscope_api_key}",
                 "Content-Type": "application/json",
@@ -431,23 +552,47 @@ class AgentRagService:
             stream=True
         )
         full_response = ""
-        for chunk in response.iter_content(chunk_size=None):
-            if not chunk:
-                continue
-            try:           
-                chunk_str = chunk.decode('utf-8')
-                if chunk_str.startswith("data:"):
-                    data = json.loads(chunk_str[5:])
-                    if data.get("choices") and data["choices"][0].get("delta", {}).get("content"):
-                        text=data["choices"][0]["delta"]["content"]
-                        full_response =full_response+text                                      
-                        print(text,end="",flush=True)
-                        sys.stdout.flush()
-                      
-            except json.JSONDecodeError:
-                continue   
+        for event in iter_sse(response.iter_content(chunk_size=None)):
+            if event.kind == "delta":
+                full_response += event.text
+                emit(event.text, end="", flush=True)
         return full_response
      
+    async def avision_query_image(self, image_file_path: str):
+        """vision_query_image 的异步版本：通过共享异步 HTTP 客户端流式读取"""
+        if image_file_path==None:
+            return "打开摄像头失败"
+        base64str = await asyncio.to_thread(_read_base64, image_file_path)
+        content = {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64str}"}}
+        return await self._avision_query(content, "请用中文描述这个图像的内容。")
+
+    async def avision_query_video(self, video_file_path: str):
+        """vision_query_video 的异步版本：通过共享异步 HTTP 客户端流式读取"""
+        if not video_file_path:
+            return "打开摄像头失败"
+        videobase64str = await asyncio.to_thread(_read_base64, video_file_path)
+        content = {"type": "video_url", "video_url": {"url": f"data:video/mp4;base64,{videobase64str}"}}
+        return await self._avision_query(content, "描述这个视频的具体过程")
+
+    async def _avision_query(self, content: dict, prompt: str) -> str:
+        """向视觉模型流式提问，逐段输出并返回完整描述"""
+        full_response = ""
+        async with get_async_client().stream(
+            "POST",
+            f"{QWEN_OPENAI_API_BASE}/chat/completions",
+            headers={"Authorization": f"Bearer {self.dashscope_api_key}"},
+            json={
+                "model": "qwen3-vl-plus",
+                "messages": [{"role": "user", "content": [content, {"type": "text", "text": prompt}]}],
+                "stream": True
+            },
+        ) as response:
+            async for event in aiter_sse(response.aiter_bytes()):
+                if event.kind == "delta":
+                    full_response += event.text
+                    emit(event.text, end="", flush=True)
+        return full_response
+
     #根据视频的video_file_path，描述视频的具体过程，并返回视频的描述。
     def vision_query_video(self, video_file_path: str):
         '''
@@ -465,8 +610,9 @@ class AgentRagService:
             videobase64str = base64.b64encode(video_file.read()).decode('utf-8')
            
 
-        response = requests.post(
+        response = get_http_session().post(
             f"{QWEN_OPENAI_API_BASE}/chat/completions",
+            timeout=endpoint_timeout("chat"),
             headers={
                 "Authorization": f"Bearer {self.dashscope_api_key}",
                 "Content-Type": "application/json",
@@ -490,20 +636,10 @@ class AgentRagService:
             )
         
         full_response = ""
-        for chunk in response.iter_content(chunk_size=None):
-            if not chunk:
-                continue
-            try:
-                chunk_str = chunk.decode('utf-8')
-                if chunk_str.startswith("data:"):
-                    data = json.loads(chunk_str[5:])
-                    if data.get("choices") and data["choices"][0].get("delta", {}).get("content"):
-                        text = data["choices"][0]["delta"]["content"]
-                        full_response += text
-                        print(text, end="", flush=True)
-                        sys.stdout.flush()
-            except json.JSONDecodeError:
-                continue
+        for event in iter_sse(response.iter_content(chunk_size=None)):
+            if event.kind == "delta":
+                full_response += event.text
+                emit(event.text, end="", flush=True)
         return full_response
 
     #获取当前日期和时间，并返回一个包含日期和时间的字符串。
@@ -605,15 +741,14 @@ class AgentRagService:
         
         # 下载并保存图像
         try:
-            response = requests.get(image_url)
+            response = get_http_session().get(image_url, timeout=endpoint_timeout("download"))
             if response.status_code == HTTPStatus.OK:
                 with open(file_path, 'wb') as f:
                     f.write(response.content)
                 #print(f"Image saved to {file_path}")
                 #图像居中显示
                 htmlstr=f"<p style='text-align: center;'> <img src='/gradio_api/file={file_path}'  style='display: inline; vertical-align: middle;'></p>"
-                print(htmlstr)
-                sys.stdout.flush()
+                emit(htmlstr)
                 return file_path
             else:
                 #print(f"下载图像失败，HTTP状态码: {response.status_code}")
@@ -681,8 +816,7 @@ class AgentRagService:
 
         #音频居中显示
         htmlstr=f"<p style='text-align: center;'> <audio controls><source src='/gradio_api/file={file_path}' type='audio/mpeg'></audio></p>"
-        print(htmlstr)
-        sys.stdout.flush()
+        emit(htmlstr)
         
         return file_path
         
@@ -753,14 +887,13 @@ class AgentRagService:
         file_path = file_path.replace("\\", "/")
 
         try:
-            response = requests.get(video_url)
+            response = get_http_session().get(video_url, timeout=endpoint_timeout("download"))
             if response.status_code == HTTPStatus.OK:
                 with open(file_path, 'wb') as f:
                     f.write(response.content)
                 #视频居中显示
                 htmlstr=f"<p style='text-align: center;'> <video controls><source src='/gradio_api/file={file_path}' type='video/mp4'></video></p>"
-                print(htmlstr)
-                sys.stdout.flush()
+                emit(htmlstr)
                 return file_path
             else:
                 #print(f"下载视频失败，HTTP状态码: {response.status_code}")
@@ -769,6 +902,94 @@ class AgentRagService:
             #print(f"保存视频文件失败: {e}")
             return None
         
+    async def agenerate_image_show(self, prompt: str):
+        """generate_image_show 的异步版本：任务状态异步轮询，图片通过共享异步 HTTP 客户端下载"""
+        modelname = "wanx2.1-t2i-plus" if self.isplus=="True" else "qwen-image"
+        try:
+            rsp = await asyncio.to_thread(
+                ImageSynthesis.async_call,
+                api_key=self.dashscope_api_key, # type: ignore
+                model=modelname,
+                prompt=prompt,
+                n=1,
+            )
+            if rsp.status_code != HTTPStatus.OK:
+                return None
+            output = await self._apoll_dashscope_task(rsp.output.task_id, interval=2, max_polls=30)
+            image_url = output["results"][-1]["url"]
+        except Exception:
+            return None
+
+        output_dir = os.path.join(self.logged_in_name, "imgoutput")
+        os.makedirs(output_dir, exist_ok=True)
+        file_path = os.path.join(output_dir, f"{time.strftime('%Y%m%d%H%M%S')}.png").replace("\\", "/")
+        if not await self._adownload(image_url, file_path):
+            return None
+        #图像居中显示
+        emit(f"<p style='text-align: center;'> <img src='/gradio_api/file={file_path}'  style='display: inline; vertical-align: middle;'></p>")
+        return file_path
+
+    async def agenerate_video_show(self, prompt: str):
+        """generate_video_show 的异步版本：任务状态异步轮询，视频通过共享异步 HTTP 客户端下载"""
+        modelname = "wanx2.1-t2v-plus" if self.isplus=="True" else "wanx2.1-t2v-turbo"
+        try:
+            rsp = await asyncio.to_thread(
+                VideoSynthesis.async_call,
+                api_key=self.dashscope_api_key, # type: ignore
+                model=modelname,
+                prompt=prompt,
+                size=self.size,
+            )
+            if rsp.status_code != HTTPStatus.OK:
+                return None
+            output = await self._apoll_dashscope_task(rsp.output.task_id, interval=2, max_polls=30)
+            video_url = output["video_url"]
+        except Exception:
+            return None
+
+        output_dir = os.path.join(self.logged_in_name, "videooutput")
+        os.makedirs(output_dir, exist_ok=True)
+        file_path = os.path.join(output_dir, f"{time.strftime('%Y%m%d%H%M%S')}.mp4").replace("\\", "/")
+        if not await self._adownload(video_url, file_path):
+            return None
+        #视频居中显示
+        emit(f"<p style='text-align: center;'> <video controls><source src='/gradio_api/file={file_path}' type='video/mp4'></video></p>")
+        return file_path
+
+    async def _apoll_dashscope_task(self, task_id: str, interval: float = 5, max_polls: int = 120, on_poll=None) -> dict:
+        """
+        功能：异步轮询 DashScope 异步任务，直到成功、失败或超时。
+        参数：interval：轮询间隔（秒）；max_polls：最多轮询次数；on_poll(i)：每次轮询后的回调（用于输出进度）。
+        返回：任务成功时的 output 字典。
+        """
+        client = get_async_client()
+        poll_url = f"{DASHSCOPE_API_BASE}/tasks/{task_id}"
+        poll_headers = {"Authorization": f"Bearer {self.dashscope_api_key}"}
+        for i in range(max_polls):
+            await asyncio.sleep(interval)
+            poll_result = (await client.get(poll_url, headers=poll_headers)).json()
+            if on_poll:
+                on_poll(i)
+            if "output" not in poll_result or "task_status" not in poll_result["output"]:
+                raise Exception(f"轮询响应格式不正确: {poll_result}")
+            task_status = poll_result["output"]["task_status"]
+            if task_status == "SUCCEEDED":
+                return poll_result["output"]
+            if task_status in ["FAILED", "CANCELLED", "UNKNOWN"]:
+                raise Exception(f"任务失败: {poll_result['output'].get('message', '未知错误')}")
+        raise Exception("任务等待超时")
+
+    async def _adownload(self, url: str, file_path: str) -> bool:
+        """通过共享异步 HTTP 客户端下载文件"""
+        try:
+            response = await get_async_client().get(url)
+            if response.status_code != HTTPStatus.OK:
+                return False
+            await asyncio.to_thread(_write_bytes, file_path, response.content)
+            return True
+        except Exception:
+            return False
+
     ####################讲解视频生成################################################    
     def generate_teacher_image(self, topic: str) -> tuple[str, str]:
         """
@@ -826,14 +1047,13 @@ class AgentRagService:
             file_path = file_path.replace("\\", "/")
             
             # 下载并保存图片
-            response = requests.get(image_url)
+            response = get_http_session().get(image_url, timeout=endpoint_timeout("download"))
             if response.status_code == HTTPStatus.OK:
                 with open(file_path, 'wb') as f:
                     f.write(response.content)
                 # 图像居中显示，模仿generate_image_show的输出方式
                 htmlstr=f"<p style='text-align: center;'> <img src='/gradio_api/file={file_path}'  style='display: inline; vertical-align: middle;'></p>"
-                print(htmlstr)
-                sys.stdout.flush()  # 强制刷新输出缓冲区
+                emit(htmlstr)
                 return file_path, gender
             else:
                 raise Exception(f"图片下载失败: {response.status_code}")
@@ -848,87 +1068,12 @@ class AgentRagService:
         参数：topic：提示文本内容。
         返回：查询结果。
         """
-        Settings.llm = self.llm
-        # 设置嵌入模型
-        Settings.embed_model = OllamaEmbedding(
-            model_name=self.embedding_model_name,
-            embedding_dim=1024
-        )
-        kbname="root"
-        # 初始化ChromaDB
-        #db = chromadb.PersistentClient(path=os.path.join(self.logged_in_name,"chroma_db"))
-        db = chromadb.PersistentClient(path=os.path.join(kbname,"chroma_db"))
-        chroma_collection = db.get_or_create_collection(
-            #name=logged_in_name,
-            name=kbname,
-            metadata={
-                "hnsw:space": "cosine",
-                "hnsw:construction_ef": 200,
-                "hnsw:search_ef": 100,
-                "hnsw:M": 32
-            },
-        )
-        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
-        
-        # 判断是否有知识库，如果没有，返回提示
-        if chroma_collection.count() == 0:
-            return "知识库为空，请先添加知识库文档。\n\n"
-        else:
-            pass
-            # print("知识库查询:", topic + "\n\n")
-        
         try:
-            # 从向量存储创建索引
-            index = VectorStoreIndex.from_vector_store(vector_store, storage_context=storage_context)
-            
-            # 初始检索，获取更多候选结果用于重排序
-
-            # 初始检索，获取更多候选结果用于重排序
-            retriever = VectorIndexRetriever(
-                index=index,
-                similarity_top_k=10,  # 增加检索结果数量供重排序使用
-                vector_store_query_mode=VectorStoreQueryMode.HYBRID,
-                alpha=0.3
-            )
+            query = self._prepare_kb_query(topic)
+            if "answer" in query:
+                return query["answer"]
 
-            # 执行初始检索
-            retrieved_nodes = retriever.retrieve(topic)
-            
-            # 如果有检索到节点，则进行重排序
-            if retrieved_nodes:
-                # 提取文档内容用于重排序
-                documents = [node.get_content() for node in retrieved_nodes]
-                
-                # 使用Qwen3-Rerank进行重排序
-                reranked_nodes = self._rerank_documents(topic, retrieved_nodes, documents)
-            else:
-                reranked_nodes = retrieved_nodes
-
-            # 创建新的检索器使用重排序后的结果
-            class RerankedRetriever(BaseRetriever):
-                def __init__(self, nodes_with_scores, similarity_top_k=5):
-                    self.nodes_with_scores = nodes_with_scores[:similarity_top_k]
-                    super().__init__()
-                    
-                def _retrieve(self, query_str, **kwargs):  # type: ignore
-                    return self.nodes_with_scores
-
-            # 使用重排序后的前5个结果
-            final_retriever = RerankedRetriever(reranked_nodes, similarity_top_k=5)
-
-            # 初始化对话记忆
-            memory = ChatMemoryBuffer.from_defaults(
-                token_limit=8000,
-            )
-
-            # 创建聊天引擎
-            chat_engine = ContextChatEngine(
-                retriever=final_retriever,
-                memory=memory,
-                llm=Settings.llm,
-                prefix_messages=[]
-            )
+            chat_engine = self._create_kb_chat_engine(query["nodes"])
 
             # 流式输出
             full_response = ""
@@ -936,19 +1081,258 @@ class AgentRagService:
             
             for chunk in response_stream.response_gen:
                 full_response += chunk
-                print(chunk, end="", flush=True)
+                emit(chunk, end="", flush=True)
             
-            print("\n\n")
+            emit("\n\n")
+            self._store_kb_answer(query, full_response)
             return full_response
 
         except Exception as e:
-            print(f"Error in query_knowledge_base: {e}")
+            emit(f"Error in query_knowledge_base: {e}", kind="error")
             import traceback
             traceback.print_exc()  # 打印完整的堆栈跟踪信息
             raise
 
-    def _rerank_documents(self, query, nodes, documents):
-        """使用dashscope的TextReRank对文档进行重排序"""
+    async def aquery_knowledge_base(self, topic: str) -> str:
+        """query_knowledge_base 的异步版本（工具入口）：优先取用推测执行的结果"""
+        speculative = await self._take_speculative("kb", topic)
+        if speculative is not None:
+            return speculative
+        return await self._aquery_knowledge_base(topic)
+
+    async def _aquery_knowledge_base(self, topic: str, echo: bool = True, on_retrieved=None) -> str:
+        """
+        aquery_knowledge_base 的实现：检索与重排序在线程池中执行，LLM 生成异步流式输出。
+        echo=False 时不输出（推测执行时使用）；on_retrieved(nodes)：检索完成后的回调。
+        """
+        try:
+            query = await asyncio.to_thread(self._prepare_kb_query, topic, echo)
+            if "answer" in query:
+                return query["answer"]
+            if on_retrieved:
+                on_retrieved(query["top_nodes"])
+
+            chat_engine = self._create_kb_chat_engine(query["nodes"])
+
+            full_response = ""
+            response_stream = await chat_engine.astream_chat(topic)
+            async for chunk in response_stream.async_response_gen():
+                full_response += chunk
+                if echo:
+                    emit(chunk, end="", flush=True)
+
+            if echo:
+                emit("\n\n")
+            self._store_kb_answer(query, full_response)
+            return full_response
+
+        except Exception as e:
+            emit(f"Error in aquery_knowledge_base: {e}", kind="error")
+            import traceback
+            traceback.print_exc()
+            raise
+
+    async def _take_speculative(self, name: str, query: str):
+        """取用本次工作流中已推测启动、且查询与 query 一致的知识库查询或联网搜索结果，并输出到界面；没有时返回 None"""
+        speculation = current_speculation.get()
+        if speculation is None:
+            return None
+        result = await speculation.take(name, query)
+        if result is not None:
+            emit(result, end="", flush=True)
+            emit("\n\n")
+        return result
+
+    def _prepare_kb_query(self, topic: str, echo: bool = True) -> dict:
+        """
+        功能：知识库查询的检索阶段：打开知识库、查语义答案缓存、混合检索并重排序。
+        返回：知识库为空或命中缓存时返回 {"answer"}；否则返回 {"kbname", "fingerprint", "query_embedding", "top_nodes", "nodes"}。
+        """
+        Settings.llm = self.llm
+        # 设置嵌入模型（进程内共享实例）
+        Settings.embed_model = get_embed_model(self.embedding_model_name)
+        # 用户建有自己的知识库时查询该知识库，否则查询 root 公共知识库
+        kbname = resolve_kbname(self.logged_in_name)
+        # 从知识库连接池租用已打开的ChromaDB集合与索引（首次查询时打开，空闲时自动关闭，租用期间不会关闭）
+        with kb_lease(kbname) as kb:
+            # 判断是否有知识库，如果没有，返回提示
+            if kb.count() == 0:
+                return {"answer": "知识库为空，请先添加知识库文档。\n\n"}
+
+            # 语义答案缓存：与已回答过的问题足够相似时直接返回缓存答案
+            fingerprint = kb.fingerprint()
+            query_embedding = get_embed_model(self.embedding_model_name).get_query_embedding(topic)
+            cached = semantic_cache.lookup(kbname, self.model_name, fingerprint, query_embedding)
+            if cached:
+                if echo:
+                    emit(cached["answer"], end="", flush=True)
+                    emit("\n\n")
+                return {"answer": cached["answer"]}
+
+            # 混合检索 + 重排序
+            reranked_nodes = self.retrieve_knowledge_base(topic, kb, query_embedding=query_embedding)
+            # 使用重排序后的前5个结果，去重、合并相邻分块并裁剪到 token 预算
+            top_nodes = reranked_nodes[:5]
+            return {
+                "kbname": kbname,
+                "fingerprint": fingerprint,
+                "query_embedding": query_embedding,
+                "top_nodes": top_nodes,
+                "nodes": pack_context(top_nodes),
+            }
+
+    def _create_kb_chat_engine(self, nodes):
+        """用检索好的分块创建 ContextChatEngine"""
+        # 创建新的检索器使用重排序后的结果
+        class RerankedRetriever(BaseRetriever):
+            def __init__(self, nodes_with_scores, similarity_top_k=5):
+                self.nodes_with_scores = nodes_with_scores[:similarity_top_k]
+                super().__init__()
+                
+            def _retrieve(self, query_str, **kwargs):  # type: ignore
+                return self.nodes_with_scores
+
+        final_retriever = RerankedRetriever(nodes, similarity_top_k=5)
+
+        # 初始化对话记忆
+        memory = ChatMemoryBuffer.from_defaults(
+            token_limit=8000,
+        )
+
+        # 创建聊天引擎
+        return ContextChatEngine(
+            retriever=final_retriever,
+            memory=memory,
+            llm=self.llm,
+            prefix_messages=[]
+        )
+
+    def _store_kb_answer(self, query: dict, answer: str):
+        """把知识库生成的答案写入语义答案缓存"""
+        if answer:
+            node_ids = [node.node.node_id for node in query["top_nodes"]]
+            semantic_cache.store(query["kbname"], self.model_name, query["fingerprint"], query["query_embedding"], node_ids, answer)
+
+    def retrieve_knowledge_base(self, topic: str, kb, similarity_top_k: int = 10, rerank_top_k: int = 5,
+                                alpha: float = HYBRID_ALPHA, vector_backend: str = VECTOR_BACKEND,
+                                use_rerank: bool = True, use_rerank_cache: bool = True,
+                                query_embedding=None, timings: dict = None):
+        """
+        功能：query_knowledge_base 的检索部分（不调用LLM）：嵌入、混合检索、重排序。
+        参数：kb：知识库句柄；similarity_top_k：初始检索数量；rerank_top_k：重排序保留数量；
+              alpha：向量检索权重；timings：传入字典时记录 embed/search/rerank 各阶段耗时（毫秒）。
+        返回：重排序后的节点列表（按相关性降序，未截断）。
+        """
+        start = time.perf_counter()
+        if query_embedding is None:
+            query_embedding = get_embed_model(self.embedding_model_name).get_query_embedding(topic)
+        embedded = time.perf_counter()
+
+        # 初始检索：向量检索 + BM25关键词检索，倒数排名融合，获取更多候选结果用于重排序
+        retrieved_nodes = kb.hybrid_retrieve(
+            self.embedding_model_name,
+            topic,
+            similarity_top_k=similarity_top_k,  # 增加检索结果数量供重排序使用
+            alpha=alpha,
+            query_embedding=query_embedding,
+            vector_backend=vector_backend
+        )
+        searched = time.perf_counter()
+
+        # 如果有检索到节点，则进行重排序
+        if retrieved_nodes and use_rerank:
+            # 提取文档内容用于重排序
+            documents = [node.get_content() for node in retrieved_nodes]
+
+            # 使用Qwen3-Rerank进行重排序
+            reranked_nodes = self._rerank_documents(topic, retrieved_nodes, documents,
+                                                    top_k=rerank_top_k, use_cache=use_rerank_cache)
+        else:
+            reranked_nodes = retrieved_nodes
+
+        if timings is not None:
+            timings["embed"] = (embedded - start) * 1000
+            timings["search"] = (searched - embedded) * 1000
+            timings["rerank"] = (time.perf_counter() - searched) * 1000
+        return reranked_nodes
+
+    def get_kb_tool(self):
+        """按 kb_mode 返回知识库工具；passages 模式沿用 query_knowledge_base 的工具名，系统提示词无需修改"""
+        if self.kb_mode == "passages":
+            return FunctionTool.from_defaults(
+                fn=self.query_knowledge_base_passages,
+                async_fn=self.aquery_knowledge_base_passages,
+                name="query_knowledge_base",
+                description=self.query_knowledge_base_passages.__doc__,
+            )
+        return FunctionTool.from_defaults(fn=self.query_knowledge_base, async_fn=self.aquery_knowledge_base)
+
+    def query_knowledge_base_passages(self, topic: str) -> str:
+        """
+        功能：根据提示文本内容，查询本地知识库，返回带出处编号的相关原文片段（不生成答案）。
+        参数：topic：提示文本内容。
+        返回：相关知识库片段，每段以 [编号] 和来源开头，回答时请引用编号。
+        """
+        return self._query_knowledge_base_passages(topic)
+
+    def _query_knowledge_base_passages(self, topic: str, echo: bool = True, on_retrieved=None) -> str:
+        """
+        query_knowledge_base_passages 的实现。
+        echo=False 时不输出参考资料（推测执行时使用）；on_retrieved(nodes)：检索完成后的回调。
+        """
+        kbname = resolve_kbname(self.logged_in_name)
+        try:
+            with kb_lease(kbname) as kb:
+                if kb.count() == 0:
+                    return "知识库为空，请先添加知识库文档。\n\n"
+                top_nodes = self.retrieve_knowledge_base(topic, kb)[:5]
+            if on_retrieved:
+                on_retrieved(top_nodes)
+            nodes = pack_context(top_nodes)
+        except Exception as e:
+            emit(f"Error in query_knowledge_base_passages: {e}", kind="error")
+            raise
+        if not nodes:
+            return "本地知识库中没有找到相关内容。"
+
+        passages = []
+        sources = []
+        for i, item in enumerate(nodes, start=1):
+            metadata = item.node.metadata or {}
+            source = metadata.get("file_name") or metadata.get("file_path") or "知识库"
+            if metadata.get("page_label"):
+                source += f" 第{metadata['page_label']}页"
+            sources.append(f"[{i}] {source}")
+            passages.append(f"[{i}] 来源：{source}\n{item.node.get_content()}")
+        if echo:
+            emit("参考资料：" + "；".join(sources) + "\n\n")
+        return "\n\n".join(passages)
+
+    async def aquery_knowledge_base_passages(self, topic: str) -> str:
+        """query_knowledge_base_passages 的异步版本（工具入口）：优先取用推测执行的结果"""
+        speculative = await self._take_speculative("kb", topic)
+        if speculative is not None:
+            return speculative
+        return await self._aquery_knowledge_base_passages(topic)
+
+    async def _aquery_knowledge_base_passages(self, topic: str, echo: bool = True, on_retrieved=None) -> str:
+        """_query_knowledge_base_passages 的异步版本（检索与重排序在线程池中执行）"""
+        return await asyncio.to_thread(self._query_knowledge_base_passages, topic, echo, on_retrieved)
+
+    def _rerank_documents(self, query, nodes, documents, top_k: int = 5, use_cache: bool = True):
+        """使用dashscope的TextReRank对文档进行重排序（带结果缓存和分差跳过策略）"""
+        node_ids = [node.node.node_id for node in nodes]
+
+        # 相同查询与候选集已排序过，直接使用缓存结果
+        cached = rerank_cache.get(query, node_ids) if use_cache else None
+        if cached is not None:
+            return self._apply_rerank_scores(nodes, cached)
+
+        # 向量分数已明显分层，按向量相似度排序后的前top_k个结果已确定，无需重排序
+        # （混合检索的节点是融合顺序，需按向量顺序返回，否则截取的前top_k个不是分层判断所依据的结果）
+        if rerank_cache.should_skip(nodes, top_k=top_k):
+            return sort_by_vector_score(nodes)
+
         try:
             # 调用dashscope的TextReRank API
             resp = dashscope.TextReRank.call(
@@ -958,31 +1342,43 @@ class AgentRagService:
                 top_n=len(documents),  # 返回所有文档的排序结果
                 return_documents=True
             )
-            
+
             if resp.status_code == HTTPStatus.OK:
                 # 根据重排序结果重新组织nodes
-                reranked_nodes = []
-                for item in resp.output.results:
-                    original_index = item.index
-                    # 保持原有的NodeWithScore结构，但更新分数为重排序的分数
-                    node_with_score = nodes[original_index]
-                    node_with_score.score = item.relevance_score
-                    reranked_nodes.append(node_with_score)
-                return reranked_nodes
+                ranking = [(item.index, item.relevance_score) for item in resp.output.results]
+                rerank_cache.put(query, node_ids, ranking)
+                return self._apply_rerank_scores(nodes, ranking)
             else:
                 # 如果重排序失败，返回原始节点
+                rerank_cache.record_network_call()
                 return nodes
-                
+
         except Exception as e:
             # 发生异常时返回原始节点
             return nodes
 
+    def _apply_rerank_scores(self, nodes, ranking):
+        """按重排序结果 [(原始下标, 相关性分数)] 重新组织nodes"""
+        reranked_nodes = []
+        for original_index, relevance_score in ranking:
+            # 保持原有的NodeWithScore结构，但更新分数为重排序的分数
+            node_with_score = nodes[original_index]
+            node_with_score.score = relevance_score
+            reranked_nodes.append(node_with_score)
+        return reranked_nodes
+
     def web_search(self, query: str) -> str:
         """
         功能：执行联网搜索，获取最新、最准确的外部信息
         参数：query：搜索查询内容
         返回：搜索结果
         """
+        cached = web_search_cache.get(self.model_name, query)
+        if cached:
+            emit(cached["text"], end="", flush=True)
+            emit("\n\n", flush=True)
+            return cached["text"]
+
         # 构建消息
         messages = [ChatMessage(role="user", content=query)]
         msglst = [{
@@ -1004,34 +1400,26 @@ class AgentRagService:
         }
 
         full_response = ""
+        usage = None
+        web_search_cache.record_upstream_call()
         try:
-            with requests.post(url, headers=headers, json=data, stream=True) as response:
+            with get_http_session().post(url, headers=headers, json=data, stream=True, timeout=endpoint_timeout("chat")) as response:
                 if response.status_code == 200:
-                    for chunk in response.iter_lines():
-                        if not chunk:
-                            continue
-                        try:
-                            chunk_str = chunk.decode('utf-8')
-                            if chunk_str.startswith("data:"):
-                                chunk_str = chunk_str[5:].strip()
-                                if chunk_str == "[DONE]":
-                                    continue
-                                data_chunk = json.loads(chunk_str)
-                                if data_chunk.get("choices") and data_chunk["choices"][0].get("delta", {}).get("content"):
-                                    res = data_chunk["choices"][0]["delta"]["content"]
-                                    full_response += res
-                                    # 流式输出到控制台，以便调用方可以实时获取结果
-                                    print(res, end="", flush=True)
-                        except json.JSONDecodeError as e:
-                            print(f"解析数据失败：{str(e)}", flush=True)
+                    for event in iter_sse(response.iter_content(chunk_size=None)):
+                        if event.kind == "usage":
+                            usage = event.usage
+                        elif event.kind == "delta":
+                            full_response += event.text
+                            # 流式输出到控制台，以便调用方可以实时获取结果
+                            emit(event.text, end="", flush=True)
                 else:
                     # 如果API调用失败，尝试使用LLM的普通回答
                     response = self.llm.chat(messages)
                     result = response.message.content if hasattr(response.message, 'content') else str(response)
-                    print(result, end="", flush=True)
+                    emit(result, end="", flush=True)
                     return str(result)
         except Exception as e:
-            print(f"Error in web_search: {e}", flush=True)
+            emit(f"Error in web_search: {e}", flush=True, kind="error")
             import traceback
             traceback.print_exc()
             # 如果出错，使用LLM的普通回答
@@ -1039,16 +1427,81 @@ class AgentRagService:
                 messages = [ChatMessage(role="user", content=query)]
                 response = self.llm.chat(messages)
                 result = response.message.content if hasattr(response.message, 'content') else str(response)
-                print(result, end="", flush=True)
+                emit(result, end="", flush=True)
                 return str(result)
             except Exception as fallback_e:
                 error_msg = f"联网搜索失败: {str(fallback_e)}"
-                print(error_msg, flush=True)
+                emit(error_msg, flush=True, kind="error")
                 return error_msg
 
-        print("\n\n", flush=True)  # 添加换行
+        emit("\n\n", flush=True)  # 添加换行
+        if full_response:
+            web_search_cache.put(self.model_name, query, full_response, usage)
+        return full_response
+
+    async def aweb_search(self, query: str) -> str:
+        """web_search 的异步版本（工具入口）：优先取用推测执行的结果"""
+        speculative = await self._take_speculative("web", query)
+        if speculative is not None:
+            return speculative
+        return await self._aweb_search(query)
+
+    async def _aweb_search(self, query: str, echo: bool = True) -> str:
+        """aweb_search 的实现：通过共享异步 HTTP 客户端流式读取搜索结果；echo=False 时不输出（推测执行时使用）"""
+        cached = web_search_cache.get(self.model_name, query)
+        if cached:
+            if echo:
+                emit(cached["text"], end="", flush=True)
+                emit("\n\n", flush=True)
+            return cached["text"]
+
+        url = f'{QWEN_OPENAI_API_BASE}/chat/completions'
+        headers = {"Authorization": f"Bearer {self.dashscope_api_key}"}
+        data = {
+            "model": self.model_name,
+            "messages": [{"role": "user", "content": query}],
+            "enable_search": True,
+            "stream": True,  # 流式返回结果
+            "stream_options": {"include_usage": True}
+        }
+
+        full_response = ""
+        usage = None
+        web_search_cache.record_upstream_call()
+        try:
+            async with get_async_client().stream("POST", url, headers=headers, json=data) as response:
+                if response.status_code != 200:
+                    # 如果API调用失败，使用LLM的普通回答
+                    return await self._aweb_search_fallback(query)
+                async for event in aiter_sse(response.aiter_bytes()):
+                    if event.kind == "usage":
+                        usage = event.usage
+                    elif event.kind == "delta":
+                        full_response += event.text
+                        if echo:
+                            emit(event.text, end="", flush=True)
+        except Exception as e:
+            emit(f"Error in aweb_search: {e}", flush=True, kind="error")
+            return await self._aweb_search_fallback(query)
+
+        if echo:
+            emit("\n\n", flush=True)  # 添加换行
+        if full_response:
+            web_search_cache.put(self.model_name, query, full_response, usage)
         return full_response
 
+    async def _aweb_search_fallback(self, query: str) -> str:
+        """联网搜索失败时使用LLM的普通回答"""
+        try:
+            response = await self.llm.achat([ChatMessage(role="user", content=query)])
+            result = response.message.content if hasattr(response.message, 'content') else str(response)
+            emit(result, end="", flush=True)
+            return str(result)
+        except Exception as fallback_e:
+            error_msg = f"联网搜索失败: {str(fallback_e)}"
+            emit(error_msg, flush=True, kind="error")
+            return error_msg
+
     def generate_lecture_script(self, topic: str) -> str:
         """
         生成讲解稿
@@ -1103,8 +1556,7 @@ class AgentRagService:
             for chunk in response:
                 if chunk.delta:
                     script += chunk.delta
-                    print(chunk.delta, end="", flush=True)
-                    sys.stdout.flush()  # 强制刷新输出缓冲区
+                    emit(chunk.delta, end="", flush=True)
             
                 
             word_count = len(script)
@@ -1113,8 +1565,7 @@ class AgentRagService:
             
             # 输出讲解稿内容，使用居中的div展示
             htmlstr = f"<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #f9f9f9;'><p><strong>讲解稿:</strong></p><p>{script}</p><p><small>({word_count}字，约{estimated_duration:.1f}秒)</small></p></div>"
-            print(htmlstr)
-            sys.stdout.flush()  # 强制刷新输出缓冲区
+            emit(htmlstr)
             return script
             
         except Exception as e:
@@ -1205,8 +1656,7 @@ class AgentRagService:
                 
             # 音频居中显示，模仿generate_audio_show的输出方式
             htmlstr=f"<p style='text-align: center;'> <audio controls><source src='/gradio_api/file={file_path}' type='audio/mpeg'></audio></p>"
-            print(htmlstr)
-            sys.stdout.flush()  # 强制刷新输出缓冲区
+            emit(htmlstr)
             return file_path
             
         except Exception as e:
@@ -1229,17 +1679,9 @@ class AgentRagService:
             def upload_file_to_oss(file_path: str, model_name: str) -> str:
                 """上传文件到OSS并获取临时公网URL"""
                 # 1. 获取上传凭证
-                url = "https://dashscope.aliyuncs.com/api/v1/uploads"
-                headers = {
-                    "Authorization": f"Bearer {self.dashscope_api_key}",
-                    "Content-Type": "application/json"
-                }
-                params = {
-                    "action": "getPolicy",
-                    "model": model_name
-                }
-
-                response = requests.get(url, headers=headers, params=params)
+                response = get_http_session().get(f"{DASHSCOPE_API_BASE}/uploads", headers=self._dashscope_headers(),
+                                                  params={"action": "getPolicy", "model": model_name},
+                                                  timeout=endpoint_timeout("upload"))
                 if response.status_code != 200:
                     raise Exception(f"Failed to get upload policy: {response.text}")
                 
@@ -1249,30 +1691,10 @@ class AgentRagService:
                 file_name = os.path.basename(file_path)
                 key = f"{policy_data['upload_dir']}/{file_name}"
                 with open(file_path, 'rb') as file:
-                    # 根据文件扩展名确定Content-Type
-                    content_type = "application/octet-stream"  # 默认类型
-                    if file_name.lower().endswith(('.png', '.jpg', '.jpeg')):
-                        if file_name.lower().endswith('.png'):
-                            content_type = "image/png"
-                        elif file_name.lower().endswith(('.jpg', '.jpeg')):
-                            content_type = "image/jpeg"
-                    elif file_name.lower().endswith('.gif'):
-                        content_type = "image/gif"
-                    elif file_name.lower().endswith(('.mp3', '.wav')):
-                        content_type = "audio/mpeg"
-                    
-                    files = {
-                        'OSSAccessKeyId': (None, policy_data['oss_access_key_id']),
-                        'Signature': (None, policy_data['signature']),
-                        'policy': (None, policy_data['policy']),
-                        'x-oss-object-acl': (None, policy_data['x_oss_object_acl']),
-                        'x-oss-forbid-overwrite': (None, policy_data['x_oss_forbid_overwrite']),
-                        'key': (None, key),
-                        'success_action_status': (None, '200'),
-                        'file': (file_name, file, content_type)
-                    }
-
-                    response = requests.post(policy_data['upload_host'], files=files)
+                    files = {name: (None, value) for name, value in _oss_form_fields(policy_data, key).items()}
+                    files['file'] = (file_name, file, _upload_content_type(file_name))
+
+                    response = get_http_session().post(policy_data['upload_host'], files=files, timeout=endpoint_timeout("upload"))
                     if response.status_code != 200:
                         raise Exception(f"Failed to upload file: {response.text}")
 
@@ -1282,96 +1704,29 @@ class AgentRagService:
             audio_url = upload_file_to_oss(audio_path, "wan2.2-s2v")
             
             # 提交视频生成任务
-            url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/image2video/video-synthesis"
-            headers = {
-                "Authorization": f"Bearer {self.dashscope_api_key}",
-                "Content-Type": "application/json",
-                "X-DashScope-Async": "enable",
-                "X-DashScope-OssResourceResolve": "enable"
-            }
-            
-            data = {
-                "model": "wan2.2-s2v",
-                "input": {
-                    "image_url": image_url,
-                    "audio_url": audio_url
-                },
-                "parameters": {
-                    "resolution": "480P"
-                }
-            }
-            
-            response = requests.post(url, headers=headers, json=data)
+            url, headers, data = self._lecture_video_request(image_url, audio_url)
+            response = get_http_session().post(url, headers=headers, json=data, timeout=endpoint_timeout("task"))
             if response.status_code != HTTPStatus.OK:
                 raise Exception(f"视频生成任务提交失败: {response.text}")
-            
-            result = response.json()
-            if "output" not in result or "task_id" not in result["output"]:
-                raise Exception("API响应格式不正确")
-            
-            task_id = result["output"]["task_id"]
-            progress_html = f"<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #fffbe6;'><p>视频生成任务已提交，任务ID: {task_id}，正在等待生成完成...</p></div>"
-            print(progress_html)
-            sys.stdout.flush()  # 强制刷新输出缓冲区
+            task_id = self._lecture_video_task_id(response.json())
             
             # 轮询任务状态
-            poll_url = f"https://dashscope.aliyuncs.com/api/v1/tasks/{task_id}"
+            poll_url = f"{DASHSCOPE_API_BASE}/tasks/{task_id}"
             poll_headers = {"Authorization": f"Bearer {self.dashscope_api_key}"}
             
             for i in range(600):  # 最多等待10分钟(600秒)
                 time.sleep(5)
-                poll_response = requests.get(poll_url, headers=poll_headers)
-                poll_result = poll_response.json()
-                
-                # 每隔一定时间输出进度信息，让用户知道仍在工作中
-                if i % 12 == 0:  # 每分钟输出一次进度（5秒*12=60秒）
-                    elapsed_minutes = (i * 5) // 60
-                    progress_html = f"<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #fffbe6;'><p>视频生成中，已用时约 {elapsed_minutes} 分钟，请耐心等待...</p></div>"
-                    print(progress_html)
-                    sys.stdout.flush()  # 强制刷新输出缓冲区
-                
-                # 检查任务状态
-                if "output" not in poll_result or "task_status" not in poll_result["output"]:
-                    raise Exception(f"轮询响应格式不正确: {poll_result}")
-                    
-                task_status = poll_result["output"]["task_status"]
-                
-                if task_status == "SUCCEEDED":
-                    # 注意：这里的键名是"results"而不是"result"
-                    if "results" not in poll_result["output"] or "video_url" not in poll_result["output"]["results"]:
-                        raise Exception(f"任务成功但未返回video_url: {poll_result}")
-                        
-                    video_url = poll_result["output"]["results"]["video_url"]
-                    progress_html = "<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #f6ffed;'><p>✅ 视频生成完成，正在下载...</p></div>"
-                    print(progress_html)
-                    sys.stdout.flush()  # 强制刷新输出缓冲区
+                poll_response = get_http_session().get(poll_url, headers=poll_headers, timeout=endpoint_timeout("task"))
+                video_url = self._check_lecture_video_task(poll_response.json(), i)
+                if video_url:
                     break
-                elif task_status in ["FAILED", "CANCELLED"]:
-                    # 获取错误信息
-                    error_message = poll_result.get("output", {}).get("message", "未知错误")
-                    raise Exception(f"视频生成失败: {error_message}")
             else:
                 raise Exception("视频生成超时")
             
             # 下载并保存视频
-            output_dir = os.path.join(self.logged_in_name, "videooutput")
-            os.makedirs(output_dir, exist_ok=True)
-            
-            current_time = time.strftime('%Y%m%d%H%M%S')
-            file_name = f"lecture_{current_time}.mp4"
-            file_path = os.path.join(output_dir, file_name)
-            
-            # 将路径中的反斜杠替换为正斜杠，确保在Web环境中能正确解析
-            file_path = file_path.replace("\\", "/")
-            
-            video_response = requests.get(video_url)
+            video_response = get_http_session().get(video_url, timeout=endpoint_timeout("download"))
             if video_response.status_code == HTTPStatus.OK:
-                with open(file_path, 'wb') as f:
-                    f.write(video_response.content)
-                # 视频居中显示，模仿generate_video_show的输出方式
-                htmlstr=f"<p style='text-align: center;'> <video controls><source src='/gradio_api/file={file_path}' type='video/mp4'></video></p>"
-                print(htmlstr)
-                sys.stdout.flush()  # 强制刷新输出缓冲区
+                self._save_lecture_video(video_response.content)
                 return audio_url
             else:
                 raise Exception(f"视频下载失败: {video_response.status_code}")
@@ -1379,6 +1734,140 @@ class AgentRagService:
         except Exception as e:
             raise Exception(f"生成视频时出错: {str(e)}")
 
+    async def agenerate_lecture_video(self, image_path: str, audio_path: str) -> str:
+        """generate_lecture_video 的异步版本：上传、提交与轮询都通过共享异步 HTTP 客户端，轮询用 asyncio.sleep"""
+        client = get_async_client()
+        try:
+            async def upload_file_to_oss(file_path: str, model_name: str) -> str:
+                response = await client.get(f"{DASHSCOPE_API_BASE}/uploads", headers=self._dashscope_headers(),
+                                            params={"action": "getPolicy", "model": model_name})
+                if response.status_code != 200:
+                    raise Exception(f"Failed to get upload policy: {response.text}")
+                policy_data = response.json()['data']
+                file_name = os.path.basename(file_path)
+                key = f"{policy_data['upload_dir']}/{file_name}"
+                content = await asyncio.to_thread(_read_bytes, file_path)
+                response = await client.post(
+                    policy_data['upload_host'],
+                    data=_oss_form_fields(policy_data, key),
+                    files={'file': (file_name, content, _upload_content_type(file_name))},
+                )
+                if response.status_code != 200:
+                    raise Exception(f"Failed to upload file: {response.text}")
+                return f"oss://{key}"
+
+            image_url, audio_url = await asyncio.gather(
+                upload_file_to_oss(image_path, "wan2.2-s2v"),
+                upload_file_to_oss(audio_path, "wan2.2-s2v"),
+            )
+
+            url, headers, data = self._lecture_video_request(image_url, audio_url)
+            response = await client.post(url, headers=headers, json=data)
+            if response.status_code != HTTPStatus.OK:
+                raise Exception(f"视频生成任务提交失败: {response.text}")
+            task_id = self._lecture_video_task_id(response.json())
+
+            poll_url = f"{DASHSCOPE_API_BASE}/tasks/{task_id}"
+            poll_headers = {"Authorization": f"Bearer {self.dashscope_api_key}"}
+            for i in range(600):  # 最多等待10分钟(600秒)
+                await asyncio.sleep(5)
+                poll_response = await client.get(poll_url, headers=poll_headers)
+                video_url = self._check_lecture_video_task(poll_response.json(), i)
+                if video_url:
+                    break
+            else:
+                raise Exception("视频生成超时")
+
+            video_response = await client.get(video_url)
+            if video_response.status_code != HTTPStatus.OK:
+                raise Exception(f"视频下载失败: {video_response.status_code}")
+            await asyncio.to_thread(self._save_lecture_video, video_response.content)
+            return audio_url
+
+        except Exception as e:
+            raise Exception(f"生成视频时出错: {str(e)}")
+
+    def _dashscope_headers(self) -> dict:
+        return {
+            "Authorization": f"Bearer {self.dashscope_api_key}",
+            "Content-Type": "application/json"
+        }
+
+    def _lecture_video_request(self, image_url: str, audio_url: str):
+        """返回提交讲解视频任务的 (url, headers, data)"""
+        url = f"{DASHSCOPE_API_BASE}/services/aigc/image2video/video-synthesis"
+        headers = dict(self._dashscope_headers(), **{
+            "X-DashScope-Async": "enable",
+            "X-DashScope-OssResourceResolve": "enable"
+        })
+        data = {
+            "model": "wan2.2-s2v",
+            "input": {
+                "image_url": image_url,
+                "audio_url": audio_url
+            },
+            "parameters": {
+                "resolution": "480P"
+            }
+        }
+        return url, headers, data
+
+    def _lecture_video_task_id(self, result: dict) -> str:
+        """从任务提交响应中取出任务ID，并输出提交提示"""
+        if "output" not in result or "task_id" not in result["output"]:
+            raise Exception("API响应格式不正确")
+        
+        task_id = result["output"]["task_id"]
+        progress_html = f"<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #fffbe6;'><p>视频生成任务已提交，任务ID: {task_id}，正在等待生成完成...</p></div>"
+        emit(progress_html)
+        return task_id
+
+    def _check_lecture_video_task(self, poll_result: dict, i: int):
+        """检查第 i 次轮询结果：成功返回 video_url，未完成返回 None，失败抛出异常"""
+        # 每隔一定时间输出进度信息，让用户知道仍在工作中
+        if i % 12 == 0:  # 每分钟输出一次进度（5秒*12=60秒）
+            elapsed_minutes = (i * 5) // 60
+            progress_html = f"<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #fffbe6;'><p>视频生成中，已用时约 {elapsed_minutes} 分钟，请耐心等待...</p></div>"
+            emit(progress_html)
+        
+        # 检查任务状态
+        if "output" not in poll_result or "task_status" not in poll_result["output"]:
+            raise Exception(f"轮询响应格式不正确: {poll_result}")
+            
+        task_status = poll_result["output"]["task_status"]
+        
+        if task_status == "SUCCEEDED":
+            # 注意：这里的键名是"results"而不是"result"
+            if "results" not in poll_result["output"] or "video_url" not in poll_result["output"]["results"]:
+                raise Exception(f"任务成功但未返回video_url: {poll_result}")
+                
+            progress_html = "<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #f6ffed;'><p>✅ 视频生成完成，正在下载...</p></div>"
+            emit(progress_html)
+            return poll_result["output"]["results"]["video_url"]
+        elif task_status in ["FAILED", "CANCELLED"]:
+            # 获取错误信息
+            error_message = poll_result.get("output", {}).get("message", "未知错误")
+            raise Exception(f"视频生成失败: {error_message}")
+        return None
+
+    def _save_lecture_video(self, content: bytes) -> str:
+        """保存讲解视频并在界面中显示，返回文件路径"""
+        output_dir = os.path.join(self.logged_in_name, "videooutput")
+        os.makedirs(output_dir, exist_ok=True)
+        
+        current_time = time.strftime('%Y%m%d%H%M%S')
+        file_name = f"lecture_{current_time}.mp4"
+        file_path = os.path.join(output_dir, file_name)
+        
+        # 将路径中的反斜杠替换为正斜杠，确保在Web环境中能正确解析
+        file_path = file_path.replace("\\", "/")
+        
+        _write_bytes(file_path, content)
+        # 视频居中显示，模仿generate_video_show的输出方式
+        htmlstr=f"<p style='text-align: center;'> <video controls><source src='/gradio_api/file={file_path}' type='video/mp4'></video></p>"
+        emit(htmlstr)
+        return file_path
+
 
     def generate_lecture_video_by_topic(self, topic: str) -> dict[str, Any]: # type: ignore
         """
@@ -1393,46 +1882,45 @@ class AgentRagService:
         """
         try:
             progress_html = f"<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #e6f7ff;'><p><strong>开始生成'{topic}'的讲解视频...</strong></p></div>"
-            print(progress_html)
-            sys.stdout.flush()  # 强制刷新输出缓冲区
+            emit(progress_html)
             
-            # 1. 生成教师形象
-            progress_html = "<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #fffbe6;'><p>第1步：正在生成教师形象...</p></div>"
-            print(progress_html)
-            sys.stdout.flush()  # 强制刷新输出缓冲区
-            image_path, teacher_gender = self.generate_teacher_image(topic)
-            progress_html = f"<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #f6ffed;'><p>✅ 第1步完成：{teacher_gender}教师形象已生成</p></div>"
-            print(progress_html)
-            sys.stdout.flush()  # 强制刷新输出缓冲区
+            # 1~3. 生成教师形象、讲解稿与讲解音频
+            image_path, teacher_gender, script, audio_path = self._generate_lecture_assets(topic)
             
-            # 2. 生成讲解稿
-            progress_html = "<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #fffbe6;'><p>第2步：正在生成讲解稿...</p></div>"
-            print(progress_html)
-            sys.stdout.flush()  # 强制刷新输出缓冲区
-            script = self.generate_lecture_script(topic)
-            progress_html = "<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #f6ffed;'><p>✅ 第2步完成：讲解稿已生成</p></div>"
-            print(progress_html)
-            sys.stdout.flush()  # 强制刷新输出缓冲区
+            # 4. 生成讲解视频
+            progress_html = "<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #fffbe6;'><p>第4步：正在生成讲解视频...</p></div>"
+            emit(progress_html)
+            video_path = self.generate_lecture_video(image_path, audio_path)
+            progress_html = "<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #f6ffed;'><p>✅ 第4步完成：讲解视频已生成</p></div>"
+            emit(progress_html)
+            
+            return {
+                "image_path": image_path,
+                "teacher_gender": teacher_gender,
+                "script": script,
+                "audio_path": audio_path,
+                "video_path": video_path
+            }
+            
+        except Exception as e:
+            error_html = f"<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #fff2f0; color: #ff4d4f;'><p><strong>❌ 生成讲解视频过程中出错: {str(e)}</strong></p></div>"
+            emit(error_html, kind="error")
+            raise
+
+    async def agenerate_lecture_video_by_topic(self, topic: str) -> dict[str, Any]: # type: ignore
+        """generate_lecture_video_by_topic 的异步版本：前三步在线程池中执行，视频任务异步提交与轮询"""
+        try:
+            progress_html = f"<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #e6f7ff;'><p><strong>开始生成'{topic}'的讲解视频...</strong></p></div>"
+            emit(progress_html)
             
-            # 3. 生成讲解音频（使用与教师形象匹配的性别）
-            progress_html = "<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #fffbe6;'><p>第3步：正在生成讲解音频...</p></div>"
-            print(progress_html)
-            sys.stdout.flush()  # 强制刷新输出缓冲区
-            # 根据教师形象性别确定音色性别
-            audio_gender = "male" if teacher_gender == "男" else "female"
-            audio_path = self.generate_lecture_audio(script, audio_gender)
-            progress_html = "<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #f6ffed;'><p>✅ 第3步完成：讲解音频已生成</p></div>"
-            print(progress_html)
-            sys.stdout.flush()  # 强制刷新输出缓冲区
+            image_path, teacher_gender, script, audio_path = await asyncio.to_thread(self._generate_lecture_assets, topic)
             
             # 4. 生成讲解视频
             progress_html = "<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #fffbe6;'><p>第4步：正在生成讲解视频...</p></div>"
-            print(progress_html)
-            sys.stdout.flush()  # 强制刷新输出缓冲区
-            video_path = self.generate_lecture_video(image_path, audio_path)
+            emit(progress_html)
+            video_path = await self.agenerate_lecture_video(image_path, audio_path)
             progress_html = "<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #f6ffed;'><p>✅ 第4步完成：讲解视频已生成</p></div>"
-            print(progress_html)
-            sys.stdout.flush()  # 强制刷新输出缓冲区
+            emit(progress_html)
             
             return {
                 "image_path": image_path,
@@ -1444,10 +1932,36 @@ class AgentRagService:
             
         except Exception as e:
             error_html = f"<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #fff2f0; color: #ff4d4f;'><p><strong>❌ 生成讲解视频过程中出错: {str(e)}</strong></p></div>"
-            print(error_html)
-            sys.stdout.flush()  # 强制刷新输出缓冲区
+            emit(error_html, kind="error")
             raise
 
+    def _generate_lecture_assets(self, topic: str):
+        """讲解视频的前三步：生成教师形象、讲解稿与讲解音频，返回 (image_path, teacher_gender, script, audio_path)"""
+        # 1. 生成教师形象
+        progress_html = "<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #fffbe6;'><p>第1步：正在生成教师形象...</p></div>"
+        emit(progress_html)
+        image_path, teacher_gender = self.generate_teacher_image(topic)
+        progress_html = f"<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #f6ffed;'><p>✅ 第1步完成：{teacher_gender}教师形象已生成</p></div>"
+        emit(progress_html)
+        
+        # 2. 生成讲解稿
+        progress_html = "<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #fffbe6;'><p>第2步：正在生成讲解稿...</p></div>"
+        emit(progress_html)
+        script = self.generate_lecture_script(topic)
+        progress_html = "<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #f6ffed;'><p>✅ 第2步完成：讲解稿已生成</p></div>"
+        emit(progress_html)
+        
+        # 3. 生成讲解音频（使用与教师形象匹配的性别）
+        progress_html = "<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #fffbe6;'><p>第3步：正在生成讲解音频...</p></div>"
+        emit(progress_html)
+        # 根据教师形象性别确定音色性别
+        audio_gender = "male" if teacher_gender == "男" else "female"
+        audio_path = self.generate_lecture_audio(script, audio_gender)
+        progress_html = "<div style='text-align: center; margin: 10px 0; padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #f6ffed;'><p>✅ 第3步完成：讲解音频已生成</p></div>"
+        emit(progress_html)
+        
+        return image_path, teacher_gender, script, audio_path
+
     #保存日志
     def save_log(self, prompt, response):
         """
@@ -1471,26 +1985,35 @@ class AgentRagService:
             log_file.write("-" * 50 + "\n")  # 分隔线
             
     #定义一个函数，用于执行workflow工作流程。
-    async def runworkflow_image(self, prompt):  
+    async def runworkflow_image(self, prompt, memory=None):  
         """
         功能：执行workflow工作流程。
         参数：prompt：提示文本内容。
+        memory：会话的对话记忆，默认使用实例自带的记忆。
         ctx_dict：上下文字典。
         返回值：ctx_dict：上下文字典。
         说明：执行workflow工作流程。
         """
         
-        # 流式输出响应    #和上下文处理有bug
-        response=self.iva_workflow.run(prompt,memory=self.memory)
-        full_response = ""
-        
-
-        
-        async for event in response.stream_events():
-            if isinstance(event, AgentStream):
-                full_response += event.delta
-                # 输出内容
-                print(event.delta, end="", flush=True)     
+        # 提示词命中联网搜索触发词时，提前并行启动知识库查询与联网搜索
+        # （推测任务须在设置上下文变量之前创建，工作流内的工具调用会继承上下文变量并取用结果）
+        speculation = SpeculativeSearch(self, prompt) if SPECULATIVE_SEARCH and matches_web_search_triggers(prompt) else None
+        token = current_speculation.set(speculation)
+        try:
+            # 流式输出响应    #和上下文处理有bug
+            response=self.iva_workflow.run(prompt,memory=memory or self.memory)
+            full_response = ""
+            
+            async for event in response.stream_events():
+                if isinstance(event, AgentStream):
+                    full_response += event.delta
+                    # 输出内容
+                    emit(event.delta, end="", kind="delta")     
+        finally:
+            current_speculation.reset(token)
+            # 取消智能体没有用到的推测任务
+            if speculation is not None:
+                speculation.cancel_pending()
                 
         # self.save_log(prompt, full_response)
         
@@ -1502,7 +2025,7 @@ class AgentRagService:
             description="获取摄像头的视频，并返回视频的video_file_path。",
             system_prompt=("1、你可以使用get_camera_video()函数获取摄像头的视频,并返回视频的video_file_path。"),
             llm=self.llm,
-            tools=[self.get_camera_video],
+            tools=[_threaded_tool(self.get_camera_video)],
             can_handoff_to=["vision_query_video_agent"],
         )
 
@@ -1512,7 +2035,7 @@ class AgentRagService:
             description="vision_query_video()函数描述视频的具体过程，接收 get_camera_video() 函数返回的video_file_path作为参数。",
             system_prompt=("接收 get_camera_video() 函数返回的video_file_path作为参数，描述视频的具体过程。"),
             llm=self.llm,
-            tools=[self.vision_query_video],
+            tools=[FunctionTool.from_defaults(fn=self.vision_query_video, async_fn=self.avision_query_video)],
             can_handoff_to=["write_agent"],
         )
 
@@ -1539,10 +2062,11 @@ class AgentRagService:
         return agent_workflow
 
     #定义一个函数，用于执行agent_workflow工作流程。
-    async def runworkflow_video(self, prompt):  
+    async def runworkflow_video(self, prompt, memory=None):  
         """
         功能：执行agent_workflow工作流程。
         参数：prompt：提示文本内容。
+        memory：会话的对话记忆，默认使用实例自带的记忆。
         ctx_dict：上下文字典。
         返回值：ctx_dict：上下文字典。
         说明：执行agent_workflow工作流程。
@@ -1552,105 +2076,194 @@ class AgentRagService:
         # 流式输出响应        
         response= self.create_video_workflow().run(
             user_msg=prompt,
-            memory=self.memory,
+            memory=memory or self.memory,
             )
         full_response = ""
         async for event in response.stream_events():
             if isinstance(event, AgentStream):
                 full_response += event.delta
-                print(event.delta, end="", flush=True)    
+                emit(event.delta, end="", kind="delta")    
         # self.save_log(prompt,full_response)
 
 
     # 主执行函数
-    async def run_agent_workflow(self, prompt):
+    async def run_agent_workflow(self, prompt, memory=None):
         """
         根据提示词内容执行相应的工作流
         参数：prompt：提示文本内容
-        ctx_dict：上下文字典
+        memory：会话的对话记忆，默认使用实例自带的记忆
         返回：执行结果
         """
         if "远程视频" in prompt:
-            return await self.runworkflow_video(prompt)
+            return await self.runworkflow_video(prompt, memory)
         else:
-            return await self.runworkflow_image(prompt)
+            return await self.runworkflow_image(prompt, memory)
+
+
+class ServiceCache:
+    """线程安全的智能体服务实例缓存，LRU + 最大实例数 + 空闲超时淘汰"""
+
+    def __init__(self, max_entries: int = SERVICE_CACHE_MAX_ENTRIES, idle_seconds: float = SERVICE_CACHE_IDLE_SECONDS):
+        self.max_entries = max_entries
+        self.idle_seconds = idle_seconds
+        self._services = OrderedDict()
+        self._lock = threading.Lock()
+        self._evictions = 0
+
+    def get(self, key: tuple, factory) -> AgentRagService:
+        """获取缓存的服务实例，不存在时调用 factory() 创建；每次访问都淘汰空闲或超出数量的实例"""
+        with self._lock:
+            service = self._services.get(key)
+            if service is not None:
+                self._services.move_to_end(key)
+                service.touch()
+                # 每次访问都检查空闲超时（实例数很少，遍历开销可以忽略）
+                self._evict(key)
+                return service
+        # 创建实例（编译工作流、创建LLM客户端）较慢，放在锁外进行
+        service = factory()
+        with self._lock:
+            existing = self._services.get(key)
+            if existing is not None:
+                service = existing
+            else:
+                self._services[key] = service
+            self._services.move_to_end(key)
+            service.touch()
+            self._evict(key)
+        stats = self.stats()
+        logger.info("智能体服务缓存：常驻 %d 个，估算内存 %.1f MB（其中知识库 %.1f MB），累计淘汰 %d 个",
+                    stats["resident"], stats["memory_mb"], stats["kb_memory_mb"], stats["evictions"])
+        return service
+
+    def _evict(self, current):
+        """淘汰实例（调用方持有锁）：空闲超时的，以及超出数量上限时最久未用的。
+        正在处理请求的实例由调用方持有引用，淘汰后仍可完成本次请求"""
+        now = time.time()
+        evicted = [key for key, service in self._services.items()
+                   if key != current and now - service.last_used > self.idle_seconds]
+        overflow = len(self._services) - len(evicted) - self.max_entries
+        for key in self._services:
+            if overflow <= 0:
+                break
+            if key != current and key not in evicted:
+                evicted.append(key)
+                overflow -= 1
+        for key in evicted:
+            del self._services[key]
+        self._evictions += len(evicted)
+        if evicted:
+            logger.info("淘汰智能体服务 %d 个，剩余 %d 个", len(evicted), len(self._services))
+
+    def evict_idle(self):
+        """淘汰所有空闲超时的实例"""
+        with self._lock:
+            self._evict(None)
+
+    def __contains__(self, key) -> bool:
+        return key in self._services
+
+    def __len__(self) -> int:
+        return len(self._services)
+
+    def stats(self) -> dict:
+        """
+        功能：返回常驻实例数、各实例估算内存与淘汰次数。
+        返回：memory_mb 为各实例自身估算内存（固定开销、对话记忆、系统提示词）加上所用知识库句柄的估算内存；
+              知识库句柄由多个实例共享，合计时每个知识库只计一次。
+        """
+        with self._lock:
+            services = list(self._services.items())
+            evictions = self._evictions
+        now = time.time()
+        entries = []
+        kb_bytes = {}
+        own_total = 0
+        for _, service in services:
+            own = service.estimated_bytes()
+            handle = service.kb_handle()
+            kb_size = handle.estimated_bytes() if handle is not None else 0
+            if handle is not None:
+                kb_bytes[handle.kbname] = kb_size
+            own_total += own
+            entries.append({
+                "logged_in_name": service.logged_in_name,
+                "model_name": service.model_name,
+                "memory_mb": round((own + kb_size) / 1024 / 1024, 2),
+                "kb": handle.kbname if handle is not None else None,
+                "history_messages": service.history_messages(),
+                "idle_seconds": round(now - service.last_used),
+            })
+        return {
+            "resident": len(entries),
+            "memory_mb": round((own_total + sum(kb_bytes.values())) / 1024 / 1024, 1),
+            "kb_memory_mb": round(sum(kb_bytes.values()) / 1024 / 1024, 1),
+            "evictions": evictions,
+            "services": entries,
+        }
 
 
 # 实例缓存（模块内全局）
-service_cache = {}
+service_cache = ServiceCache()
 
-def get_agent_rag_service(model_name, embedding_model_name, logged_in_name, nvr1_url="", nvr2_url="", size="1024*768", isplus="False", voice="严肃男"):
+def get_agent_rag_service(model_name, embedding_model_name, logged_in_name, nvr1_url="", nvr2_url="", size="1024*768", isplus="False", voice="严肃男", kb_mode=DEFAULT_KB_TOOL_MODE):
     """获取或创建一个AgentRagService实例"""
-    key = (model_name, embedding_model_name, logged_in_name, nvr1_url, nvr2_url, size, isplus, voice)
-    if key not in service_cache:
-        service_cache[key] = AgentRagService(model_name, embedding_model_name, logged_in_name, nvr1_url, nvr2_url, size, isplus, voice)
-    return service_cache[key]
+    key = (model_name, embedding_model_name, logged_in_name, nvr1_url, nvr2_url, size, isplus, voice, kb_mode)
+    return service_cache.get(key, lambda: AgentRagService(model_name, embedding_model_name, logged_in_name, nvr1_url, nvr2_url, size, isplus, voice, kb_mode))
+
+
+def get_service_cache_stats() -> dict:
+    """返回智能体服务缓存统计"""
+    return service_cache.stats()
 
 
-async def run_agent_workflow_stream(prompt, session_state, model_name, embedding_model_name, size="1024*768", isplus="False", voice="严肃男"):
+async def run_agent_workflow_stream(prompt, session_state, model_name, embedding_model_name, size="1024*768", isplus="False", voice="严肃男", kb_mode=DEFAULT_KB_TOOL_MODE):
     """
     流式运行agent工作流的函数，用于agent_chativ函数调用
     """
 
 
-    # 从 session_state 获取登录用户
+    # 从 session_state 获取登录用户与会话ID
     logged_in_name = session_state.get("logged_in_name", "root") if session_state and isinstance(session_state, dict) else "root"
+    session_id = session_state.get("session_id") if session_state and isinstance(session_state, dict) else None
     
-    # 获取NVR URLs
-    nvr1_url, nvr2_url = getnvr_url(logged_in_name)
+    # 获取NVR URLs（查询与首次创建服务都是阻塞调用，放到线程中执行，不阻塞共享的事件循环线程）
+    nvr1_url, nvr2_url = await asyncio.to_thread(getnvr_url, logged_in_name)
     
-    service = get_agent_rag_service(model_name, embedding_model_name, logged_in_name, nvr1_url, nvr2_url, size, isplus, voice) # type: ignore
+    service = await asyncio.to_thread(get_agent_rag_service, model_name, embedding_model_name, logged_in_name, nvr1_url, nvr2_url, size, isplus, voice, kb_mode) # type: ignore
     
-    # 创建队列用于线程间通信
-    output_queue = Queue()
-    
-    def run_workflow_in_thread():
-        original_stdout = sys.stdout
+    # 每次运行使用独立的输出通道，工作流任务及其工具线程通过上下文变量写入，并发请求互不干扰
+    channel = OutputChannel()
+
+    async def run_workflow():
+        current_channel.set(channel)
         try:
-            class QueueWriter:
-                def write(self, s):
-                    if s and s.strip():  # 避免发送空白字符
-                        output_queue.put(s)
-                def flush(self):
-                    pass
-            
-            # 重定向标准输出
-            sys.stdout = QueueWriter()
-            
-            # 运行工作流
-            if "远程视频" in prompt:
-                asyncio.run(service.runworkflow_video(prompt))
-            else:
-                asyncio.run(service.runworkflow_image(prompt))
+            # 按会话取对话记忆（可能需要从磁盘加载），没有会话ID时使用服务实例自带的记忆
+            memory = await asyncio.to_thread(session_memories.acquire, session_id) if session_id else None
+            try:
+                # 运行工作流
+                await service.run_agent_workflow(prompt, memory)
+            finally:
+                if session_id:
+                    await asyncio.to_thread(session_memories.release, session_id)
         except Exception as e:
-            output_queue.put(f"\n错误: {str(e)}")
+            emit(f"\n错误: {str(e)}", end="", kind="error")
         finally:
-            # 恢复原始stdout
-            sys.stdout = original_stdout
             # 发送结束标记
-            output_queue.put(None)  # None作为结束标记
+            channel.close()
+
+    # create_task 复制当前上下文，通道只绑定在该任务上
+    task = asyncio.create_task(run_workflow())
 
-    # 启动工作流线程
-    thread = threading.Thread(target=run_workflow_in_thread)
-    thread.start()
-    
     # 累积输出内容
     full_output = ""
-    
-    # 持续从队列读取并输出
-    while True:
-        try:
-            # 等待最多2秒获取输出
-            item = output_queue.get(timeout=2)
-            if item is None:  # 结束标记
-                break
-            full_output += item
+    try:
+        # 按帧合并输出，避免每个 token 都向界面推送一次完整的累积内容
+        async for frame in channel.frames():
+            full_output += frame
             yield full_output  # 流式返回累积内容
-        except Empty:
-            # 检查线程是否仍在运行
-            if not thread.is_alive():
-                break
-            continue
-
-    # 等待线程结束
-    thread.join()
\ No newline at end of file
+    finally:
+        # 调用方提前停止读取时取消工作流
+        if not task.done():
+            task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
\ No newline at end of file
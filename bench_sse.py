@@ -0,0 +1,142 @@
+"""
+SSE 流解析微基准：原来的按分块解析、按行解析（iter_lines）对比增量解析器 SSEParser
+
+用合成的 DashScope 流式响应（每个事件一个增量 token），分别按“每个分块一个事件”和“随机 TCP 分块”两种切分方式
+喂给各解析方式，统计每个 token 的解析开销（微秒）以及正确恢复的 token 比例。
+
+用法：
+    python bench_sse.py [--tokens 20000] [--max-chunk 1460] [--repeat 5] [--seed 0]
+"""
+import sys
+import json
+import time
+import random
+import argparse
+
+from sse_parser import iter_sse
+
+
+def build_stream(tokens: int, rng: random.Random) -> tuple:
+    """生成合成流：返回 (事件字节列表, token 列表)"""
+    vocab = ["知识", "库", "检索", "的", "结果", "表明", "，", "。", "模型", "token", " stream", "数据"]
+    texts = [rng.choice(vocab) for _ in range(tokens)]
+    events = []
+    for i, text in enumerate(texts):
+        payload = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 0, "model": "qwen3-max",
+                   "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}]}
+        events.append(b"data: " + json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n\n")
+    events.append(b'data: {"choices":[],"usage":{"prompt_tokens":10,"completion_tokens":%d,"total_tokens":%d}}\n\n'
+                  % (tokens, tokens + 10))
+    events.append(b"data: [DONE]\n\n")
+    return events, texts
+
+
+def split_random(data: bytes, max_chunk: int, rng: random.Random) -> list:
+    chunks, pos = [], 0
+    while pos < len(data):
+        size = rng.randint(1, max_chunk)
+        chunks.append(data[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def parse_chunk_decode(chunks) -> list:
+    """原 vision_query_image / agent_chat_with_image 的方式：每个分块 decode，假设以 data: 开头"""
+    texts = []
+    for chunk in chunks:
+        try:
+            chunk_str = chunk.decode("utf-8")
+            if chunk_str.startswith("data:"):
+                data = json.loads(chunk_str[5:])
+                if data.get("choices") and data["choices"][0].get("delta", {}).get("content"):
+                    texts.append(data["choices"][0]["delta"]["content"])
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            continue
+    return texts
+
+
+def iter_lines(chunks):
+    """与 requests.Response.iter_lines 相同的按行切分"""
+    pending = None
+    for chunk in chunks:
+        if pending is not None:
+            chunk = pending + chunk
+        lines = chunk.splitlines()
+        if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
+            pending = lines.pop()
+        else:
+            pending = None
+        yield from lines
+    if pending is not None:
+        yield pending
+
+
+def parse_iter_lines(chunks) -> list:
+    """原 web_search / agent_chat_with_document 的方式：iter_lines 后逐行 decode 和解析"""
+    texts = []
+    for line in iter_lines(chunks):
+        if not line:
+            continue
+        try:
+            line_str = line.decode("utf-8")
+            if line_str.startswith("data:"):
+                line_str = line_str[5:].strip()
+                if line_str == "[DONE]":
+                    continue
+                data = json.loads(line_str)
+                if data.get("choices") and data["choices"][0].get("delta", {}).get("content"):
+                    texts.append(data["choices"][0]["delta"]["content"])
+        except json.JSONDecodeError:
+            continue
+    return texts
+
+
+def parse_sse_parser(chunks) -> list:
+    return [event.text for event in iter_sse(chunks) if event.kind == "delta"]
+
+
+PARSERS = {
+    "chunk_decode": parse_chunk_decode,
+    "iter_lines": parse_iter_lines,
+    "sse_parser": parse_sse_parser,
+}
+
+
+def run(parse, chunks, expected, repeat: int) -> dict:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        texts = parse(chunks)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        "us_per_token": best * 1e6 / len(expected),
+        "recovered": min(len(texts), len(expected)) / len(expected),
+        "exact": texts == expected,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SSE 流解析微基准")
+    parser.add_argument("--tokens", type=int, default=20000, help="合成流中的 token 数")
+    parser.add_argument("--max-chunk", type=int, default=1460, help="随机分块的最大字节数")
+    parser.add_argument("--repeat", type=int, default=5, help="重复次数（取最快一次）")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    events, expected = build_stream(args.tokens, rng)
+    layouts = {
+        "每分块一个事件": events,
+        "随机TCP分块": split_random(b"".join(events), args.max_chunk, rng),
+    }
+    print(f"{'分块方式':<12}{'解析方式':<14}{'每token(微秒)':>14}{'恢复比例':>10}{'完全一致':>10}")
+    for layout, chunks in layouts.items():
+        for name, parse in PARSERS.items():
+            result = run(parse, chunks, expected, args.repeat)
+            print(f"{layout:<12}{name:<14}{result['us_per_token']:>14.2f}{result['recovered']:>10.1%}{str(result['exact']):>10}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
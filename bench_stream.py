@@ -0,0 +1,104 @@
+"""
+流式输出推送开销测量：逐 token 推送完整内容 对比 按帧合并 + 只追加的增量推送
+
+模拟一次回答：后端每个 token 产出一次累积文本，chat_with_history 把对话历史拼在前面推送给 Gradio。
+Gradio 对生成器的连续输出按差异发送：新值以旧值为前缀时发送追加部分，否则发送完整新值。
+分别统计两种方式下一次回答推送的帧数、发送字节数（按 JSON 编码后的消息计算）和服务端 CPU 时间。
+token 到达时间用模拟时钟，不需要真实等待。
+
+用法：
+    python bench_stream.py [--tokens 4000] [--token-ms 25] [--history-chars 4000] [--interval-ms 80]
+"""
+import sys
+import json
+import time
+import random
+import argparse
+
+from stream_frames import FrameCoalescer
+
+
+def gradio_diff(old: str, new: str) -> list:
+    """与 Gradio 流式差异相同的字符串比较：追加或整体替换"""
+    if old is not None and new.startswith(old):
+        return [["append", [], new[len(old):]]]
+    return [["replace", [], new]]
+
+
+def backend_stream(tokens: list, token_seconds: float, clock: list):
+    """模拟后端：每个 token 产出一次累积文本，并推进模拟时钟"""
+    full = ""
+    for token in tokens:
+        clock[0] += token_seconds
+        full += token
+        yield full
+
+
+def simulated_frames(stream, interval: float, clock: list):
+    """用模拟时钟驱动与 coalesce_frames 相同的合并逻辑：下一个 token 到达前已过帧时刻的挂起结果按帧时刻转发"""
+    coalescer = FrameCoalescer(interval)
+    for item in stream:
+        deadline = coalescer.deadline()
+        if deadline is not None and deadline <= clock[0]:
+            yield from coalescer.flush(deadline)
+        yield from coalescer.offer(item, clock[0])
+    yield from coalescer.flush(clock[0])
+
+
+def measure(tokens, history_text: str, token_seconds: float, interval: float, coalesced: bool) -> dict:
+    clock = [0.0]
+    stream = backend_stream(tokens, token_seconds, clock)
+    if coalesced:
+        stream = simulated_frames(stream, interval, clock)
+    frames = 0
+    sent = 0
+    previous = None
+    start = time.process_time()
+    for ai_response in stream:
+        if coalesced:
+            value = history_text + f"<div class='ai-message'>{ai_response}"
+        else:
+            value = history_text + f"<div class='ai-message'>{ai_response}</div>\n\n"
+        message = json.dumps({"msg": "process_generating", "output": {"data": [gradio_diff(previous, value)]}},
+                             ensure_ascii=False)
+        sent += len(message.encode("utf-8"))
+        previous = value
+        frames += 1
+    # 最后一帧：闭合的完整历史
+    final = history_text + f"<div class='ai-message'>{ai_response}</div>\n\n"
+    message = json.dumps({"msg": "process_generating", "output": {"data": [gradio_diff(previous, final)]}},
+                         ensure_ascii=False)
+    sent += len(message.encode("utf-8"))
+    cpu = time.process_time() - start
+    return {"frames": frames + 1, "bytes": sent, "cpu_ms": cpu * 1000}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="流式输出推送开销测量")
+    parser.add_argument("--tokens", type=int, default=4000, help="回答的 token 数")
+    parser.add_argument("--token-ms", type=float, default=25, help="token 间隔（毫秒）")
+    parser.add_argument("--history-chars", type=int, default=4000, help="之前对话历史的字符数")
+    parser.add_argument("--interval-ms", type=float, default=80, help="帧间隔（毫秒）")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    vocab = ["知识", "库", "检索", "的", "结果", "表明", "，", "。", "模型", "学生", "信息", "技术"]
+    tokens = [rng.choice(vocab) for _ in range(args.tokens)]
+    history_text = "".join(rng.choice(vocab) for _ in range(args.history_chars // 2))
+    history_text = f"<div class='user-message'>{history_text}</div>\n\n"
+
+    results = {
+        "逐token完整推送": measure(tokens, history_text, args.token_ms / 1000, args.interval_ms / 1000, False),
+        "按帧增量推送": measure(tokens, history_text, args.token_ms / 1000, args.interval_ms / 1000, True),
+    }
+    print(f"{'方式':<14}{'帧数':>8}{'发送字节':>16}{'CPU(毫秒)':>12}")
+    for name, result in results.items():
+        print(f"{name:<14}{result['frames']:>8}{result['bytes']:>16,}{result['cpu_ms']:>12.1f}")
+    before, after = results["逐token完整推送"], results["按帧增量推送"]
+    print(f"发送字节减少 {before['bytes'] / max(after['bytes'], 1):.0f} 倍，CPU 减少 {before['cpu_ms'] / max(after['cpu_ms'], 1e-3):.0f} 倍")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+向量检索后端基准测试：HNSW（construction_ef=200, search_ef=100, M=32）对比内存映射 float16 / int8 暴力检索
+
+以 float32 精确检索结果为基准计算 recall@k，并统计各后端的查询延迟。
+查询向量默认从集合中随机抽取（加少量噪声），也可以用 --queries 指定问题文件（每行一个问题）通过嵌入模型生成。
+
+用法：
+    python bench_vector_index.py [--kb root] [--top-k 10] [--samples 200] [--queries 问题文件]
+"""
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from kb_pool import kb_lease, get_embed_model
+from vector_index import load_or_build_vector_index, iter_collection_vectors
+
+
+DEFAULT_EMBEDDING_MODEL_NAME = "quentinz/bge-large-zh-v1.5:latest"
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def run_backend(name, search, queries, truth, top_k):
+    """执行一个后端的所有查询，返回 recall@k 与延迟分位数"""
+    latencies = []
+    recalls = []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        ids = search(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+        recalls.append(len(set(ids[:top_k]) & expected) / max(len(expected), 1))
+    return {
+        "backend": name,
+        "recall": float(np.mean(recalls)) if recalls else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="向量检索后端基准测试")
+    parser.add_argument("--kb", default="root", help="知识库名称（默认 root）")
+    parser.add_argument("--top-k", type=int, default=10, help="检索数量")
+    parser.add_argument("--samples", type=int, default=200, help="随机抽取的查询数量")
+    parser.add_argument("--queries", default=None, help="问题文件，每行一个问题")
+    parser.add_argument("--embedding-model", default=DEFAULT_EMBEDDING_MODEL_NAME, help="嵌入模型名称")
+    args = parser.parse_args(argv)
+
+    # 测量期间租用句柄，避免知识库被空闲回收或淘汰关闭
+    with kb_lease(args.kb) as kb:
+        if kb.count() == 0:
+            print("知识库为空")
+            return 1
+
+        start = time.perf_counter()
+        indexes = {dtype: load_or_build_vector_index(kb, dtype) for dtype in ("float16", "int8")}
+        print(f"旁路索引加载/构建用时 {time.perf_counter() - start:.2f} 秒，向量数 {len(indexes['float16'])}")
+
+        # 基准用的 float32 原始向量（旁路索引默认不保存 float32 副本，从集合读取）
+        pages = list(iter_collection_vectors(kb.collection))
+        ids = [doc_id for page_ids, _ in pages for doc_id in page_ids]
+        exact = np.concatenate([batch for _, batch in pages])
+        rng = np.random.default_rng(0)
+        if args.queries:
+            with open(args.queries, "r", encoding="utf-8") as f:
+                questions = [line.strip() for line in f if line.strip()]
+            embed_model = get_embed_model(args.embedding_model)
+            queries = [np.asarray(embed_model.get_query_embedding(q), dtype=np.float32) for q in questions]
+        else:
+            rows = rng.choice(len(exact), size=min(args.samples, len(exact)), replace=False)
+            queries = [exact[i] + rng.normal(0, 0.02, exact.shape[1]).astype(np.float32) for i in rows]
+        queries = [q / (np.linalg.norm(q) or 1.0) for q in queries]
+
+        # 基准：float32 精确检索
+        truth = [set(ids[i] for i in np.argsort(-(exact @ q))[:args.top_k]) for q in queries]
+
+        def hnsw_search(query):
+            result = kb.collection.query(query_embeddings=[query.tolist()], n_results=args.top_k, include=[])
+            return result["ids"][0]
+
+        results = [run_backend("hnsw", hnsw_search, queries, truth, args.top_k)]
+        for dtype, index in indexes.items():
+            results.append(run_backend(
+                dtype, lambda query, index=index: [doc_id for doc_id, _ in index.search(query, args.top_k)],
+                queries, truth, args.top_k
+            ))
+
+    print(f"{'后端':<10}{'recall@' + str(args.top_k):>12}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+    for r in results:
+        print(f"{r['backend']:<10}{r['recall']:>12.4f}{r['p50']:>10.2f}{r['p95']:>10.2f}{r['p99']:>10.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
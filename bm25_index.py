@@ -0,0 +1,133 @@
+"""
+进程内 BM25 倒排索引
+
+与 Chroma 集合中的分块保持一致的关键词索引，用于真正的混合检索。
+分词：英文/数字按单词切分（如 IPv6、ASCII），中文按字二元组切分；安装了 jieba 时改用 jieba 搜索模式分词。
+倒排表使用 array 连续存储（文档号 + 词频），查询时用 NumPy 累加得分。
+"""
+import re
+import math
+from array import array
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+try:
+    import jieba
+except ImportError:  # jieba 为可选依赖
+    jieba = None
+
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60
+
+_cjk_pattern = re.compile(r"[一-鿿]+")
+_token_pattern = re.compile(r"[a-z0-9][a-z0-9_.+#-]*|[一-鿿]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """分词：英文数字整词，中文字二元组（或 jieba 搜索模式）"""
+    tokens = []
+    for piece in _token_pattern.findall((text or "").lower()):
+        if not _cjk_pattern.fullmatch(piece):
+            tokens.append(piece.rstrip(".-"))
+        elif jieba is not None:
+            tokens.extend(w for w in jieba.lcut_for_search(piece) if w.strip())
+        elif len(piece) == 1:
+            tokens.append(piece)
+        else:
+            tokens.extend(piece[i:i + 2] for i in range(len(piece) - 1))
+    return tokens
+
+
+class BM25Index:
+    """基于 array 存储倒排表的 BM25 索引"""
+
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.doc_ids: List[str] = []
+        self.doc_lengths = array("I")
+        self.vocab: Dict[str, int] = {}
+        self.postings_docs: List[array] = []
+        self.postings_tfs: List[array] = []
+        self.avgdl = 0.0
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def add(self, doc_id: str, text: str):
+        """添加一个分块"""
+        tokens = tokenize(text)
+        doc_index = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self.doc_lengths.append(len(tokens))
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, tf in counts.items():
+            term_id = self.vocab.get(token)
+            if term_id is None:
+                term_id = len(self.postings_docs)
+                self.vocab[token] = term_id
+                self.postings_docs.append(array("I"))
+                self.postings_tfs.append(array("H"))
+            self.postings_docs[term_id].append(doc_index)
+            self.postings_tfs[term_id].append(min(tf, 65535))
+
+    def finalize(self):
+        """添加完成后计算平均文档长度"""
+        total = sum(self.doc_lengths)
+        self.avgdl = total / len(self.doc_lengths) if self.doc_lengths else 0.0
+
+    def search(self, query: str, top_k: int = 10) -> List[Tuple[str, float]]:
+        """返回 [(分块ID, BM25得分)]，按得分降序"""
+        n = len(self.doc_ids)
+        if n == 0:
+            return []
+        scores = np.zeros(n, dtype=np.float32)
+        lengths = np.frombuffer(self.doc_lengths, dtype=np.uint32)
+        norm = self.k1 * (1 - self.b + self.b * lengths / (self.avgdl or 1.0))
+        for token in set(tokenize(query)):
+            term_id = self.vocab.get(token)
+            if term_id is None:
+                continue
+            docs = np.frombuffer(self.postings_docs[term_id], dtype=np.uint32)
+            tfs = np.frombuffer(self.postings_tfs[term_id], dtype=np.uint16).astype(np.float32)
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + norm[docs])
+        hits = np.flatnonzero(scores)
+        if len(hits) == 0:
+            return []
+        if len(hits) > top_k:
+            hits = hits[np.argpartition(-scores[hits], top_k - 1)[:top_k]]
+        hits = hits[np.argsort(-scores[hits])]
+        return [(self.doc_ids[i], float(scores[i])) for i in hits]
+
+
+def build_bm25_from_collection(collection, page_size: int = 1000) -> BM25Index:
+    """从 Chroma 集合分页读取分块文本构建 BM25 索引"""
+    index = BM25Index()
+    offset = 0
+    while True:
+        result = collection.get(include=["documents"], limit=page_size, offset=offset)
+        ids = result.get("ids") or []
+        if not ids:
+            break
+        for doc_id, text in zip(ids, result.get("documents") or []):
+            index.add(doc_id, text or "")
+        offset += len(ids)
+    index.finalize()
+    return index
+
+
+def reciprocal_rank_fusion(ranked_lists: List[List[str]], weights: List[float], k: int = RRF_K) -> List[Tuple[str, float]]:
+    """加权倒数排名融合，得分归一化到 [0, 1]（在所有列表中都排第一时为 1）"""
+    total_weight = sum(weights) or 1.0
+    fused = {}
+    for ranked, weight in zip(ranked_lists, weights):
+        for rank, doc_id in enumerate(ranked, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + weight / (k + rank)
+    scale = (k + 1) / total_weight
+    return sorted(((doc_id, score * scale) for doc_id, score in fused.items()), key=lambda x: x[1], reverse=True)
@@ -0,0 +1,151 @@
+"""
+检索上下文压缩
+
+重排序后的分块送入 ContextChatEngine 之前：
+1. 用字符 shingle + MinHash 估算相似度，丢弃与更高分分块近似重复的分块；
+2. 合并同一来源中相邻（首尾重叠）的分块，去掉重叠部分；
+3. 按分数顺序装入，超出 token 预算的部分截断。
+每次查询记录节省的 token 数。
+"""
+import copy
+import zlib
+import logging
+import threading
+from typing import List
+
+import numpy as np
+from llama_index.core.schema import NodeWithScore
+
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_TOKEN_BUDGET = 2048
+SHINGLE_SIZE = 5
+MINHASH_PERMUTATIONS = 64
+DUPLICATE_THRESHOLD = 0.8
+# 判定为相邻分块所需的最小首尾重叠字符数
+MIN_MERGE_OVERLAP = 20
+MAX_MERGE_OVERLAP = 256
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_rng = np.random.default_rng(20240601)
+_perm_a = _rng.integers(1, 1 << 32, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+_perm_b = _rng.integers(0, 1 << 32, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def count_tokens(text: str) -> int:
+    """用 llama_index 的全局分词器计数（进程内只加载一次）"""
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                from llama_index.core.utils import get_tokenizer
+                _tokenizer = get_tokenizer()
+    return len(_tokenizer(text))
+
+
+def minhash_signature(text: str) -> np.ndarray:
+    """字符 shingle 的 MinHash 签名"""
+    text = "".join(text.split())
+    shingles = {text[i:i + SHINGLE_SIZE] for i in range(max(1, len(text) - SHINGLE_SIZE + 1))}
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    # 每个排列：(a * x + b) mod p，x、a、b 均为 32 位，乘积不超过 64 位
+    values = (hashes[:, None] * _perm_a[None, :] + _perm_b[None, :]) % _MERSENNE_PRIME
+    return values.min(axis=0)
+
+
+def estimate_similarity(sig_a: np.ndarray, sig_b: np.ndarray) -> float:
+    """由 MinHash 签名估算 Jaccard 相似度"""
+    return float(np.mean(sig_a == sig_b))
+
+
+def _source(node) -> str:
+    metadata = node.metadata or {}
+    return metadata.get("file_path") or metadata.get("file_name") or ""
+
+
+def _overlap(left: str, right: str) -> int:
+    """left 的结尾与 right 的开头重叠的字符数"""
+    for size in range(min(len(left), len(right), MAX_MERGE_OVERLAP), MIN_MERGE_OVERLAP - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def _merge_adjacent(items: List[NodeWithScore]) -> List[NodeWithScore]:
+    """合并同一来源中首尾重叠的分块，合并后的分数取两者较高者，位置取较高分者的位置"""
+    merged = []
+    for item in items:
+        text = item.node.get_content()
+        for target in merged:
+            if _source(target.node) != _source(item.node) or not _source(item.node):
+                continue
+            target_text = target.node.get_content()
+            if (size := _overlap(target_text, text)):
+                target.node.set_content(target_text + text[size:])
+                break
+            if (size := _overlap(text, target_text)):
+                target.node.set_content(text + target_text[size:])
+                break
+        else:
+            node = copy.copy(item.node)
+            node.metadata = dict(item.node.metadata or {})
+            merged.append(NodeWithScore(node=node, score=item.score))
+    return merged
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """截断文本到 max_tokens 以内（按字符二分）"""
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(text[:mid]) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low]
+
+
+def pack_context(nodes: List[NodeWithScore], token_budget: int = CONTEXT_TOKEN_BUDGET,
+                 duplicate_threshold: float = DUPLICATE_THRESHOLD) -> List[NodeWithScore]:
+    """
+    功能：对按相关性排好序的分块去重、合并相邻分块并裁剪到 token 预算。
+    参数：nodes：重排序后的分块；token_budget：上下文 token 上限；duplicate_threshold：MinHash 相似度阈值。
+    返回：压缩后的分块（不修改传入的节点）。
+    """
+    if not nodes:
+        return nodes
+    original_tokens = sum(count_tokens(item.node.get_content()) for item in nodes)
+
+    # 1. 近似重复去重：保留分数更高（排在前面）的分块
+    kept, signatures = [], []
+    for item in nodes:
+        signature = minhash_signature(item.node.get_content())
+        if any(estimate_similarity(signature, other) >= duplicate_threshold for other in signatures):
+            continue
+        kept.append(item)
+        signatures.append(signature)
+
+    # 2. 合并相邻分块
+    merged = _merge_adjacent(kept)
+
+    # 3. 按 token 预算装入
+    packed, used = [], 0
+    for item in merged:
+        text = item.node.get_content()
+        tokens = count_tokens(text)
+        if used + tokens > token_budget:
+            remaining = token_budget - used
+            if remaining <= 0:
+                break
+            item.node.set_content(_truncate(text, remaining))
+            tokens = remaining
+        packed.append(item)
+        used += tokens
+
+    logger.info("上下文压缩: %d 个分块 %d tokens -> %d 个分块 %d tokens，节省 %d tokens",
+                len(nodes), original_tokens, len(packed), used, original_tokens - used)
+    return packed
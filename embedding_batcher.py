@@ -0,0 +1,133 @@
+"""
+嵌入请求微批合并
+
+并发的单条嵌入请求在一个很短的时间窗口内（默认几毫秒）或凑满 N 条后，
+合并为一次批量嵌入调用，再把向量分发回各个等待的调用方。
+课堂并发提问时可显著减少对 Ollama 的请求次数。
+"""
+import time
+import asyncio
+import threading
+from concurrent.futures import Future
+from queue import Queue, Empty
+from typing import Any, List
+
+from pydantic import PrivateAttr
+from llama_index.core.base.embeddings.base import BaseEmbedding
+
+
+BATCH_WINDOW_MS = 5
+BATCH_MAX_SIZE = 32
+
+
+class EmbeddingBatcher:
+    """后台线程收集嵌入请求，按时间窗口或数量上限合并成一次批量调用"""
+
+    def __init__(self, embed_batch_fn, window_ms: float = BATCH_WINDOW_MS, max_batch_size: int = BATCH_MAX_SIZE):
+        self.embed_batch_fn = embed_batch_fn
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self._queue = Queue()
+        self.batches = 0
+        self.texts = 0
+        self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, text: str) -> Future:
+        """提交一条文本，返回可等待的 Future"""
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def embed(self, text: str) -> List[float]:
+        """同步获取单条文本的嵌入向量"""
+        return self.submit(text).result()
+
+    async def aembed(self, text: str) -> List[float]:
+        """异步获取单条文本的嵌入向量"""
+        return await asyncio.wrap_future(self.submit(text))
+
+    def _collect(self):
+        """阻塞等待第一条请求，然后在时间窗口内继续收集，直到凑满批次"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [text for text, _ in batch]
+            try:
+                embeddings = self.embed_batch_fn(texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.texts += len(texts)
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+
+    def stats(self) -> dict:
+        """返回批次数量与平均批大小"""
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "avg_batch_size": self.texts / self.batches if self.batches else 0.0,
+        }
+
+
+class BatchedEmbedding(BaseEmbedding):
+    """把单条嵌入请求交给微批合并器的嵌入模型包装，接口与 BaseEmbedding 一致"""
+
+    _inner: Any = PrivateAttr()
+    _batcher: Any = PrivateAttr()
+
+    def __init__(self, inner: BaseEmbedding, window_ms: float = BATCH_WINDOW_MS, max_batch_size: int = BATCH_MAX_SIZE, **kwargs: Any):
+        super().__init__(
+            model_name=inner.model_name,
+            embed_batch_size=inner.embed_batch_size,
+            **kwargs
+        )
+        self._inner = inner
+        self._batcher = EmbeddingBatcher(inner.get_text_embedding_batch, window_ms, max_batch_size)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "BatchedEmbedding"
+
+    @property
+    def batcher(self) -> EmbeddingBatcher:
+        return self._batcher
+
+    def _format_query(self, query: str) -> str:
+        # 查询与文档共用一次批量调用，查询指令（如有）在提交前拼接
+        instruction = getattr(self._inner, "query_instruction", None)
+        return f"{instruction.strip()} {query.strip()}".strip() if instruction else query
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._batcher.embed(self._format_query(query))
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return await self._batcher.aembed(self._format_query(query))
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._batcher.embed(text)
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return await self._batcher.aembed(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        # 本身已是批量请求，直接调用底层模型
+        return self._inner.get_text_embedding_batch(texts)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return await self._inner.aget_text_embedding_batch(texts)
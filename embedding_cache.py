@@ -0,0 +1,195 @@
+"""
+嵌入向量缓存
+
+两级缓存：内存 LRU + SQLite 持久化（float16 存储）。
+缓存键由嵌入模型名称与规范化后的文本组成，命中时跳过 Ollama 调用。
+"""
+import os
+import re
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+import numpy as np
+from pydantic import PrivateAttr
+from llama_index.core.base.embeddings.base import BaseEmbedding
+
+
+EMBEDDING_CACHE_PATH = os.path.join("root", "embedding_cache.db")
+EMBEDDING_CACHE_MEMORY_SIZE = 4096
+
+
+def normalize_text(text: str) -> str:
+    """规范化文本：全角转半角、合并空白、去除首尾空白"""
+    text = unicodedata.normalize("NFKC", text or "")
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def make_cache_key(model_name: str, kind: str, text: str) -> str:
+    """生成缓存键：模型名称 + 嵌入类型(query/text) + 规范化文本"""
+    raw = f"{model_name}\0{kind}\0{normalize_text(text)}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """两级嵌入缓存：内存 LRU 与 SQLite 持久层"""
+
+    def __init__(self, db_path: Optional[str] = EMBEDDING_CACHE_PATH, max_memory_items: int = EMBEDDING_CACHE_MEMORY_SIZE):
+        self.max_memory_items = max_memory_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._conn = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS embeddings
+                                  (key TEXT PRIMARY KEY, model TEXT, dim INTEGER, vector BLOB)''')
+            self._conn.commit()
+
+    def _remember(self, key: str, vector: np.ndarray):
+        """写入内存层（调用方持有锁）"""
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[List[float]]:
+        """查询缓存，依次检查内存层和持久层"""
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector.tolist()
+
+            if self._conn is not None:
+                row = self._conn.execute("SELECT vector FROM embeddings WHERE key=?", (key,)).fetchone()
+                if row:
+                    vector = np.frombuffer(row[0], dtype=np.float16).astype(np.float32)
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+                    return vector.tolist()
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, model_name: str, embedding: List[float]):
+        """写入缓存（内存层 + 持久层）"""
+        vector = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            self._remember(key, vector)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, model, dim, vector) VALUES (?, ?, ?, ?)",
+                    (key, model_name, int(vector.shape[0]), vector.astype(np.float16).tobytes())
+                )
+                self._conn.commit()
+
+    def stats(self) -> dict:
+        """返回命中/未命中计数"""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            hits = self.memory_hits + self.disk_hits
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_items": len(self._memory),
+            }
+
+
+class CachedEmbedding(BaseEmbedding):
+    """在任意嵌入模型前加一层缓存，接口与 BaseEmbedding 一致"""
+
+    _inner: Any = PrivateAttr()
+    _cache: Any = PrivateAttr()
+
+    def __init__(self, inner: BaseEmbedding, cache: EmbeddingCache, **kwargs: Any):
+        super().__init__(
+            model_name=inner.model_name,
+            embed_batch_size=inner.embed_batch_size,
+            **kwargs
+        )
+        self._inner = inner
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def cache(self) -> EmbeddingCache:
+        return self._cache
+
+    def _lookup(self, kind: str, texts: List[str]):
+        """返回 (缓存键列表, 结果列表, 未命中下标列表)"""
+        keys = [make_cache_key(self.model_name, kind, t) for t in texts]
+        results = [self._cache.get(k) for k in keys]
+        missing = [i for i, r in enumerate(results) if r is None]
+        return keys, results, missing
+
+    def _fill(self, keys, results, missing, embeddings):
+        for i, embedding in zip(missing, embeddings):
+            results[i] = embedding
+            self._cache.put(keys[i], self.model_name, embedding)
+        return results
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        keys, results, missing = self._lookup("query", [query])
+        if missing:
+            self._fill(keys, results, missing, [self._inner.get_query_embedding(query)])
+        return results[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        keys, results, missing = self._lookup("query", [query])
+        if missing:
+            self._fill(keys, results, missing, [await self._inner.aget_query_embedding(query)])
+        return results[0]
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        keys, results, missing = self._lookup("text", texts)
+        if missing:
+            embeddings = self._inner.get_text_embedding_batch([texts[i] for i in missing])
+            self._fill(keys, results, missing, embeddings)
+        return results
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        keys, results, missing = self._lookup("text", texts)
+        if missing:
+            embeddings = await self._inner.aget_text_embedding_batch([texts[i] for i in missing])
+            self._fill(keys, results, missing, embeddings)
+        return results
+
+
+# 进程内共享的嵌入缓存（首次使用时创建）
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """获取进程内共享的嵌入缓存"""
+    global _embedding_cache
+    if _embedding_cache is None:
+        with _embedding_cache_lock:
+            if _embedding_cache is None:
+                _embedding_cache = EmbeddingCache()
+    return _embedding_cache
+
+
+def get_embedding_cache_stats() -> dict:
+    """返回嵌入缓存的命中统计"""
+    return get_embedding_cache().stats()
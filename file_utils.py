@@ -0,0 +1,14 @@
+"""
+文件相关的通用工具函数
+"""
+import hashlib
+
+
+# 计算文件内容的MD5哈希值
+def calculate_file_hash(file_path):
+    """计算文件内容的MD5哈希值，用于判断文件是否相同"""
+    hash_md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(4096), b""):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
@@ -0,0 +1,84 @@
+"""
+共享 HTTP 客户端
+
+同步调用共用一个带连接池的 requests.Session（urllib3 连接池线程安全），异步工具共用 httpx.AsyncClient，
+都复用到 DashScope 的 TCP/TLS 连接，避免每次调用（包括视频任务每 5 秒一次的轮询）重新握手。
+httpx 的连接绑定在创建它的事件循环上，因此按事件循环各保留一个客户端。
+HTTP/2 只有 httpx 支持（需要安装 h2），通过 http_client_http2=1 对异步客户端开启；requests 只支持 HTTP/1.1 keep-alive。
+"""
+import os
+import asyncio
+import threading
+import weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+
+HTTP_MAX_CONNECTIONS = 64
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 16
+HTTP_KEEPALIVE_EXPIRY = 60
+HTTP_POOL_MAXSIZE = int(os.getenv("http_client_pool_size", "32"))
+HTTP2 = os.getenv("http_client_http2", "0") == "1"
+# 连接超时较短；读超时按流式生成的最长间隔设置
+HTTP_TIMEOUT = httpx.Timeout(connect=10.0, read=120.0, write=60.0, pool=30.0)
+# 各类端点的 (连接超时, 读超时)，单位秒
+ENDPOINT_TIMEOUTS = {
+    "chat": (10, 120),      # 对话/视觉理解（含流式输出）
+    "upload": (10, 300),    # 上传凭证与 OSS 表单上传
+    "task": (10, 30),       # 异步任务提交与轮询
+    "download": (10, 300),  # 下载生成的图像、视频
+}
+
+_session = None
+_session_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+_async_lock = threading.Lock()
+
+
+def endpoint_timeout(kind: str) -> tuple:
+    """返回某类端点的 (连接超时, 读超时)，用作 requests 的 timeout 参数"""
+    return ENDPOINT_TIMEOUTS.get(kind, ENDPOINT_TIMEOUTS["chat"])
+
+
+def get_http_session() -> requests.Session:
+    """获取进程内共享的同步 HTTP 会话（keep-alive 连接池，线程间共享）"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """获取当前事件循环共享的异步 HTTP 客户端（必须在协程中调用）"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        with _async_lock:
+            client = _async_clients.get(loop)
+            if client is None or client.is_closed:
+                client = httpx.AsyncClient(
+                    timeout=HTTP_TIMEOUT,
+                    http2=HTTP2,
+                    limits=httpx.Limits(
+                        max_connections=HTTP_MAX_CONNECTIONS,
+                        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                    ),
+                )
+                _async_clients[loop] = client
+    return client
+
+
+async def aclose_async_client():
+    """关闭当前事件循环的异步客户端（事件循环结束前调用）"""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
@@ -0,0 +1,225 @@
+"""
+知识库检索质量与延迟基准测试
+
+用标注好的问题集（问题 -> 期望命中的分块ID）走 query_knowledge_base 的同一检索路径（不调用LLM），
+统计 recall@k、MRR，以及嵌入、检索、重排序各阶段和总耗时的 p50/p95/p99，并支持参数网格扫描。
+可以保存结果，之后与基线对比，召回率下降超过阈值时以非零状态退出，用于离线回归检查。
+--compare-kb-modes N 用前 N 个问题完整运行智能体工作流，对比知识库工具 generate（两次LLM生成）
+与 passages（只返回片段）两种模式的首字延迟和总耗时（会调用LLM）。
+
+问题集为 JSONL，每行：{"question": "...", "expected_ids": ["分块ID", ...]}
+
+用法：
+    python kb_benchmark.py golden.jsonl [--kb root] [--top-k 10,20] [--rerank-top-k 5] [--alpha 0.3,0.5]
+                           [--backend hnsw,float16] [--no-rerank] [--output result.json] [--baseline base.json]
+                           [--compare-kb-modes 5]
+"""
+import sys
+import json
+import time
+import asyncio
+import itertools
+import argparse
+import contextlib
+
+import numpy as np
+
+from kb_pool import kb_lease, resolve_kbname
+
+
+DEFAULT_MODEL_NAME = "qwen3-max"
+DEFAULT_EMBEDDING_MODEL_NAME = "quentinz/bge-large-zh-v1.5:latest"
+# 与基线相比召回率/MRR 允许的最大下降
+REGRESSION_TOLERANCE = 0.02
+STAGES = ("embed", "search", "rerank", "total")
+
+
+def load_golden_set(path: str) -> list:
+    """读取问题集"""
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            items.append({"question": item["question"], "expected_ids": set(item["expected_ids"])})
+    return items
+
+
+def percentiles(values) -> dict:
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0}
+    return {f"p{q}": round(float(np.percentile(values, q)), 2) for q in (50, 95, 99)}
+
+
+def evaluate(service, kb, golden, params: dict) -> dict:
+    """用一组参数跑完整个问题集，返回质量与延迟指标"""
+    recalls, reciprocal_ranks = [], []
+    latencies = {stage: [] for stage in STAGES}
+    k = params["rerank_top_k"]
+    for item in golden:
+        timings = {}
+        start = time.perf_counter()
+        nodes = service.retrieve_knowledge_base(
+            item["question"], kb,
+            similarity_top_k=params["top_k"],
+            rerank_top_k=k,
+            alpha=params["alpha"],
+            vector_backend=params["backend"],
+            use_rerank=params["rerank"],
+            use_rerank_cache=False,
+            timings=timings
+        )
+        timings["total"] = (time.perf_counter() - start) * 1000
+        for stage in STAGES:
+            latencies[stage].append(timings[stage])
+
+        ids = [node.node.node_id for node in nodes][:k]
+        expected = item["expected_ids"]
+        recalls.append(len(set(ids) & expected) / max(len(expected), 1))
+        rank = next((i for i, node_id in enumerate(ids, start=1) if node_id in expected), None)
+        reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+
+    return {
+        "params": params,
+        "recall@k": round(float(np.mean(recalls)), 4) if recalls else 0.0,
+        "mrr": round(float(np.mean(reciprocal_ranks)), 4) if reciprocal_ranks else 0.0,
+        "latency_ms": {stage: percentiles(values) for stage, values in latencies.items()},
+    }
+
+
+class _FirstOutputWriter:
+    """替代 stdout，记录第一次有内容输出的时间"""
+
+    def __init__(self):
+        self.first_output = None
+
+    def write(self, s):
+        if self.first_output is None and s and s.strip():
+            self.first_output = time.perf_counter()
+        return len(s)
+
+    def flush(self):
+        pass
+
+
+def compare_kb_modes(golden, model_name: str, embedding_model_name: str, user: str, count: int) -> dict:
+    """用前 count 个问题完整运行智能体工作流，返回各知识库工具模式的首字延迟与总耗时（毫秒）"""
+    from shared_utils import getnvr_url
+    from agent_rag_service import get_agent_rag_service, KB_TOOL_MODES
+
+    nvr1_url, nvr2_url = getnvr_url(user)
+    questions = [item["question"] for item in golden[:count]]
+    results = {}
+    for kb_mode in KB_TOOL_MODES:
+        service = get_agent_rag_service(model_name, embedding_model_name, user, nvr1_url, nvr2_url, kb_mode=kb_mode)
+        first, total = [], []
+        for question in questions:
+            # 每个问题使用全新记忆，避免对话历史影响耗时
+            service.memory.reset()
+            writer = _FirstOutputWriter()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(writer):
+                asyncio.run(service.run_agent_workflow(question))
+            end = time.perf_counter()
+            first.append(((writer.first_output or end) - start) * 1000)
+            total.append((end - start) * 1000)
+        results[kb_mode] = {"first_output": percentiles(first), "total": percentiles(total)}
+    return results
+
+
+def parse_list(value: str, cast):
+    return [cast(v) for v in value.split(",") if v.strip()]
+
+
+def params_key(params: dict) -> str:
+    return json.dumps(params, sort_keys=True)
+
+
+def check_regressions(results: list, baseline_path: str, tolerance: float = REGRESSION_TOLERANCE) -> list:
+    """与基线结果对比，返回召回率或MRR下降超过阈值的参数组合"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {params_key(r["params"]): r for r in json.load(f)}
+    regressions = []
+    for result in results:
+        base = baseline.get(params_key(result["params"]))
+        if base is None:
+            continue
+        for metric in ("recall@k", "mrr"):
+            if result[metric] < base[metric] - tolerance:
+                regressions.append((result["params"], metric, base[metric], result[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="知识库检索质量与延迟基准测试")
+    parser.add_argument("golden", help="问题集 JSONL 文件")
+    parser.add_argument("--kb", default=None, help="知识库名称（默认按 --user 解析，无用户知识库时为 root）")
+    parser.add_argument("--user", default="root", help="模拟的登录用户")
+    parser.add_argument("--model", default=DEFAULT_MODEL_NAME, help="LLM 模型名称（检索评测不调用LLM，仅 --compare-kb-modes 使用）")
+    parser.add_argument("--embedding-model", default=DEFAULT_EMBEDDING_MODEL_NAME, help="嵌入模型名称")
+    parser.add_argument("--top-k", default="10", help="初始检索数量，逗号分隔")
+    parser.add_argument("--rerank-top-k", default="5", help="重排序后保留数量（即 recall@k 的 k），逗号分隔")
+    parser.add_argument("--alpha", default="0.3", help="混合检索中向量检索权重，逗号分隔")
+    parser.add_argument("--backend", default="hnsw", help="向量检索后端 hnsw/float16/int8，逗号分隔")
+    parser.add_argument("--no-rerank", action="store_true", help="同时测试不重排序的情况")
+    parser.add_argument("--output", default=None, help="保存结果的 JSON 文件")
+    parser.add_argument("--baseline", default=None, help="基线结果 JSON 文件，用于回归检查")
+    parser.add_argument("--compare-kb-modes", type=int, default=0, help="用前 N 个问题对比知识库工具两种模式的端到端耗时")
+    args = parser.parse_args(argv)
+
+    from shared_utils import getnvr_url
+    from agent_rag_service import get_agent_rag_service
+
+    golden = load_golden_set(args.golden)
+    kbname = args.kb or resolve_kbname(args.user)
+    # 整个评测期间租用句柄，避免知识库被空闲回收或淘汰关闭
+    with kb_lease(kbname) as kb:
+        nvr1_url, nvr2_url = getnvr_url(args.user)
+        service = get_agent_rag_service(args.model, args.embedding_model, args.user, nvr1_url, nvr2_url)
+        print(f"知识库 {kbname}：{kb.count()} 个分块，问题 {len(golden)} 个")
+
+        grid = itertools.product(
+            parse_list(args.top_k, int),
+            parse_list(args.rerank_top_k, int),
+            parse_list(args.alpha, float),
+            parse_list(args.backend, str),
+            [True, False] if args.no_rerank else [True],
+        )
+        results = []
+        print(f"{'top_k':>6}{'rr_k':>6}{'alpha':>7}{'backend':>9}{'rerank':>8}{'recall@k':>10}{'MRR':>8}"
+              f"{'embed p50':>11}{'search p50':>12}{'rerank p50':>12}{'total p50/p95/p99':>22}")
+        for top_k, rerank_top_k, alpha, backend, rerank in grid:
+            params = {"top_k": top_k, "rerank_top_k": rerank_top_k, "alpha": alpha, "backend": backend, "rerank": rerank}
+            result = evaluate(service, kb, golden, params)
+            results.append(result)
+            latency = result["latency_ms"]
+            total = latency["total"]
+            print(f"{top_k:>6}{rerank_top_k:>6}{alpha:>7}{backend:>9}{str(rerank):>8}{result['recall@k']:>10.4f}{result['mrr']:>8.4f}"
+                  f"{latency['embed']['p50']:>11}{latency['search']['p50']:>12}{latency['rerank']['p50']:>12}"
+                  f"{total['p50']:>9}/{total['p95']}/{total['p99']}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+        print(f"结果已保存: {args.output}")
+
+    if args.compare_kb_modes:
+        print(f"{'知识库工具模式':<14}{'首字 p50/p95':>18}{'总耗时 p50/p95':>20}")
+        for kb_mode, latency in compare_kb_modes(golden, args.model, args.embedding_model, args.user, args.compare_kb_modes).items():
+            first, total = latency["first_output"], latency["total"]
+            print(f"{kb_mode:<14}{first['p50']:>10}/{first['p95']:<8}{total['p50']:>11}/{total['p95']}")
+
+    if args.baseline:
+        regressions = check_regressions(results, args.baseline)
+        for params, metric, before, after in regressions:
+            print(f"回归: {params} {metric} {before} -> {after}")
+        if regressions:
+            return 1
+        print("与基线相比无回归")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+"""
+知识库增量导入
+
+维护导入清单（文件路径 -> 内容哈希、分块ID），每次同步只重新解析、分块、嵌入发生变化的文件，
+并删除已移除文件对应的分块。文件大小和修改时间未变时不重新计算哈希。
+变化的文件交给 kb_pipeline 并行解析、分块和批量嵌入；超大文件（或指定 --streaming）逐页流式导入，
+内存占用与文档大小无关，每批写入后记录断点，中断后从最后提交的页继续。
+
+用法：
+    python kb_ingest.py <文档目录> [--kb root] [--embedding-model 模型名称] [--workers 进程数] [--streaming]
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+
+from llama_index.core.schema import TextNode
+
+from file_utils import calculate_file_hash
+from kb_parsers import parse_document, chunk_pages, is_kb_document, iter_document_pages, TextChunker
+from kb_pool import kb_lease, get_embed_model, reload_kb
+from kb_pipeline import IngestPipeline
+
+
+DEFAULT_EMBEDDING_MODEL_NAME = "quentinz/bge-large-zh-v1.5:latest"
+MANIFEST_FILE_NAME = "kb_manifest.json"
+EMBED_BATCH_SIZE = 64
+DELETE_BATCH_SIZE = 500
+# 超过该大小的文件使用流式导入
+STREAMING_FILE_SIZE = 64 * 1024 * 1024
+
+
+def get_manifest_path(kbname: str) -> str:
+    """返回知识库导入清单的路径"""
+    return os.path.join(kbname, MANIFEST_FILE_NAME)
+
+
+def load_manifest(kbname: str) -> dict:
+    """读取导入清单，不存在时返回空清单"""
+    manifest_path = get_manifest_path(kbname)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {"files": {}}
+
+
+def save_manifest(kbname: str, manifest: dict):
+    """保存导入清单（先写临时文件再替换，避免中断时损坏）"""
+    manifest_path = get_manifest_path(kbname)
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def make_chunk_id(rel_path: str, file_hash: str, index: int) -> str:
+    """生成确定性的分块ID：文件路径哈希 + 内容哈希 + 序号"""
+    path_hash = hashlib.md5(rel_path.encode("utf-8")).hexdigest()[:16]
+    return f"{path_hash}-{file_hash[:12]}-{index:05d}"
+
+
+def scan_documents(source_dir: str) -> dict:
+    """扫描目录下所有可导入的文档，返回 {相对路径: 绝对路径}"""
+    documents = {}
+    for root, _, files in os.walk(source_dir):
+        for file in files:
+            abs_path = os.path.join(root, file)
+            if is_kb_document(abs_path):
+                rel_path = os.path.relpath(abs_path, source_dir).replace("\\", "/")
+                documents[rel_path] = abs_path
+    return documents
+
+
+def delete_chunks(collection, chunk_ids):
+    """分批删除分块"""
+    for i in range(0, len(chunk_ids), DELETE_BATCH_SIZE):
+        collection.delete(ids=chunk_ids[i:i + DELETE_BATCH_SIZE])
+
+
+def build_nodes(rel_path: str, file_hash: str, chunks, embeddings, start_index: int = 0):
+    """把分块与嵌入向量组装为节点，start_index 为第一个分块在文件中的序号"""
+    nodes = []
+    for i, ((text, page), embedding) in enumerate(zip(chunks, embeddings), start=start_index):
+        nodes.append(TextNode(
+            id_=make_chunk_id(rel_path, file_hash, i),
+            text=text,
+            embedding=embedding,
+            metadata={
+                "file_path": rel_path,
+                "file_name": os.path.basename(rel_path),
+                "page_label": page,
+            },
+            excluded_embed_metadata_keys=["file_path", "file_name", "page_label"],
+            excluded_llm_metadata_keys=["file_path"],
+        ))
+    return nodes
+
+
+def ingest_file(kb, embed_model, rel_path: str, abs_path: str, file_hash: str) -> list:
+    """解析、分块、嵌入并写入单个文件，返回分块ID列表"""
+    chunks = list(chunk_pages(parse_document(abs_path)))
+    chunk_ids = []
+    for i in range(0, len(chunks), EMBED_BATCH_SIZE):
+        batch = chunks[i:i + EMBED_BATCH_SIZE]
+        embeddings = embed_model.get_text_embedding_batch([text for text, _ in batch])
+        nodes = build_nodes(rel_path, file_hash, batch, embeddings, start_index=i)
+        kb.vector_store.add(nodes)
+        chunk_ids.extend(node.node_id for node in nodes)
+    return chunk_ids
+
+
+def ingest_file_streaming(kb, embed_model, rel_path: str, abs_path: str, file_hash: str,
+                          checkpoint: dict = None, chunk_ids: list = None, on_checkpoint=None) -> list:
+    """
+    功能：逐页流式导入单个文件，跨页分块，每攒满一批就嵌入写入 Chroma，峰值内存与文档大小无关。
+    参数：checkpoint：上次中断的断点 {"next_page", "chunker"}；chunk_ids：断点前已写入的分块ID；
+          on_checkpoint(checkpoint, chunk_ids)：每批写入后回调，用于持久化断点。
+    返回：分块ID列表。
+    """
+    checkpoint = checkpoint or {}
+    chunk_ids = list(chunk_ids or [])
+    chunker = TextChunker()
+    chunker.set_state(checkpoint.get("chunker", {}))
+    batch = []
+
+    def flush():
+        if not batch:
+            return
+        embeddings = embed_model.get_text_embedding_batch([text for text, _ in batch])
+        nodes = build_nodes(rel_path, file_hash, batch, embeddings, start_index=len(chunk_ids))
+        kb.vector_store.add(nodes)
+        chunk_ids.extend(node.node_id for node in nodes)
+        batch.clear()
+
+    page_index = checkpoint.get("next_page", 0)
+    for page, text in iter_document_pages(abs_path, page_index):
+        batch.extend(chunker.feed(text, page))
+        page_index += 1
+        # 只在页边界提交，断点记录下一页和分块器中未输出的文本
+        if len(batch) >= EMBED_BATCH_SIZE:
+            flush()
+            if on_checkpoint:
+                on_checkpoint({"next_page": page_index, "chunker": chunker.get_state()}, chunk_ids)
+    batch.extend(chunker.flush())
+    flush()
+    return chunk_ids
+
+
+def _sync_documents(kb, source_dir: str, kbname: str, embedding_model_name: str, workers: int, streaming: bool) -> dict:
+    """sync_knowledge_base 的实现：在已租用的知识库句柄上删除、导入文档并维护清单，返回同步统计"""
+    embed_model = get_embed_model(embedding_model_name)
+    manifest = load_manifest(kbname)
+    # 嵌入模型变化时所有文件都需要重新嵌入
+    if manifest.get("embedding_model") not in (None, embedding_model_name):
+        manifest["files"] = {rel: dict(entry, hash="") for rel, entry in manifest["files"].items()}
+    manifest["embedding_model"] = embedding_model_name
+    files = manifest["files"]
+    stats = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "failed": 0, "chunks": 0}
+
+    documents = scan_documents(source_dir)
+
+    # 删除已移除文件的分块
+    for rel_path in [rel for rel in files if rel not in documents]:
+        delete_chunks(kb.collection, files[rel_path].get("chunk_ids", []))
+        del files[rel_path]
+        stats["removed"] += 1
+    save_manifest(kbname, manifest)
+
+    jobs = []
+    streaming_jobs = []
+    for rel_path, abs_path in sorted(documents.items()):
+        stat = os.stat(abs_path)
+        entry = files.get(rel_path)
+        # 文件大小与修改时间未变，跳过哈希计算
+        if entry and entry.get("hash") and entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime:
+            stats["unchanged"] += 1
+            continue
+
+        file_hash = calculate_file_hash(abs_path)
+        if entry and entry.get("hash") == file_hash:
+            entry.update(size=stat.st_size, mtime=stat.st_mtime)
+            stats["unchanged"] += 1
+            continue
+
+        job = {"rel_path": rel_path, "abs_path": abs_path, "file_hash": file_hash,
+               "size": stat.st_size, "mtime": stat.st_mtime, "is_update": bool(entry and entry.get("chunk_ids"))}
+        checkpoint = (entry or {}).get("checkpoint")
+        if checkpoint and checkpoint.get("hash") == file_hash:
+            # 同一文件上次流式导入中断，从断点继续；断点清单中的 chunk_ids 是本次导入已写入的分块，
+            # 是否为更新沿用开始导入时记录在断点中的标记
+            job.update(checkpoint=checkpoint, chunk_ids=entry.get("chunk_ids", []),
+                       is_update=bool(checkpoint.get("is_update")))
+            streaming_jobs.append(job)
+            continue
+        if entry:
+            delete_chunks(kb.collection, entry.get("chunk_ids", []))
+            # 旧分块已删除，先清空哈希，中断后下次同步会重新导入
+            entry.update(hash="", chunk_ids=[])
+            entry.pop("checkpoint", None)
+        if streaming or stat.st_size >= STREAMING_FILE_SIZE:
+            streaming_jobs.append(job)
+        else:
+            jobs.append(job)
+    save_manifest(kbname, manifest)
+
+    job_map = {job["rel_path"]: job for job in jobs + streaming_jobs}
+    manifest_lock = threading.Lock()
+
+    def on_file_done(rel_path, chunk_ids):
+        job = job_map[rel_path]
+        with manifest_lock:
+            stats["updated" if job["is_update"] else "added"] += 1
+            stats["chunks"] += len(chunk_ids)
+            files[rel_path] = {"hash": job["file_hash"], "size": job["size"], "mtime": job["mtime"], "chunk_ids": chunk_ids}
+            # 每个文件完成后保存清单，中断后可从未完成的文件继续
+            save_manifest(kbname, manifest)
+        print(f"已导入: {rel_path}（{len(chunk_ids)} 个分块）")
+
+    def on_file_failed(rel_path, error):
+        print(f"导入失败: {rel_path}: {error}")
+        with manifest_lock:
+            files.pop(rel_path, None)
+            stats["failed"] += 1
+            save_manifest(kbname, manifest)
+
+    if jobs:
+        pipeline = IngestPipeline(kb, embed_model, build_nodes, workers=workers, embed_batch_size=EMBED_BATCH_SIZE)
+        pipeline_stats = pipeline.run(jobs, on_file_done, on_file_failed)
+        stats["docs_per_sec"] = pipeline_stats["docs_per_sec"]
+        stats["chunks_per_sec"] = pipeline_stats["chunks_per_sec"]
+
+    for job in streaming_jobs:
+        rel_path = job["rel_path"]
+
+        def on_checkpoint(checkpoint, chunk_ids, job=job):
+            with manifest_lock:
+                files[job["rel_path"]] = {"hash": "", "size": job["size"], "mtime": job["mtime"], "chunk_ids": list(chunk_ids),
+                                          "checkpoint": dict(checkpoint, hash=job["file_hash"], is_update=job["is_update"])}
+                save_manifest(kbname, manifest)
+
+        try:
+            chunk_ids = ingest_file_streaming(kb, embed_model, rel_path, job["abs_path"], job["file_hash"],
+                                              job.get("checkpoint"), job.get("chunk_ids"), on_checkpoint)
+        except Exception as e:
+            # 保留断点，下次同步从最后提交的页继续
+            print(f"流式导入中断: {rel_path}: {e}")
+            stats["failed"] += 1
+            continue
+        on_file_done(rel_path, chunk_ids)
+
+    save_manifest(kbname, manifest)
+    return stats
+
+
+def sync_knowledge_base(source_dir: str, kbname: str = "root", embedding_model_name: str = DEFAULT_EMBEDDING_MODEL_NAME,
+                        workers: int = None, streaming: bool = False) -> dict:
+    """
+    功能：把文档目录增量同步到知识库。
+    参数：source_dir：文档目录；kbname：知识库名称；embedding_model_name：嵌入模型名称；
+          workers：解析进程数（默认 CPU 核数）；streaming：所有文件都使用流式导入。
+    返回：同步统计 {"added", "updated", "removed", "unchanged", "failed", "chunks", "seconds"}。
+    """
+    start = time.time()
+    # 整个同步过程都租用句柄，导入期间知识库不会被空闲回收或淘汰关闭
+    with kb_lease(kbname) as kb:
+        stats = _sync_documents(kb, source_dir, kbname, embedding_model_name, workers, streaming)
+    if stats["added"] or stats["updated"] or stats["removed"]:
+        reload_kb(kbname)
+    stats["seconds"] = round(time.time() - start, 2)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="增量同步文档目录到本地知识库")
+    parser.add_argument("source_dir", help="文档目录")
+    parser.add_argument("--kb", default="root", help="知识库名称（默认 root）")
+    parser.add_argument("--embedding-model", default=DEFAULT_EMBEDDING_MODEL_NAME, help="嵌入模型名称")
+    parser.add_argument("--workers", type=int, default=None, help="解析进程数（默认 CPU 核数）")
+    parser.add_argument("--streaming", action="store_true", help="所有文件逐页流式导入（内存受限时使用）")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.source_dir):
+        print(f"目录不存在: {args.source_dir}")
+        return 1
+    stats = sync_knowledge_base(args.source_dir, args.kb, args.embedding_model, args.workers, args.streaming)
+    print(f"同步完成：新增 {stats['added']}，更新 {stats['updated']}，删除 {stats['removed']}，"
+          f"未变 {stats['unchanged']}，失败 {stats['failed']}，分块 {stats['chunks']}，用时 {stats['seconds']} 秒")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
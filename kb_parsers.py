@@ -0,0 +1,209 @@
+"""
+知识库文档解析与分块
+
+按文件格式提取文本（PDF、Word、PowerPoint、Excel、HTML、纯文本），
+并把文本切分为带页码信息的分块，供导入知识库使用。
+"""
+import os
+import re
+from typing import Iterable, Iterator, List, Tuple
+
+
+# 支持导入知识库的文件扩展名
+KB_DOCUMENT_EXTENSIONS = ['.txt', '.md', '.pdf', '.docx', '.xlsx', '.pptx', '.csv', '.json', '.html', '.htm']
+CHUNK_SIZE = 512
+CHUNK_OVERLAP = 64
+
+# 中英文句末标点，分块时优先在这些位置断开
+_sentence_end = re.compile(r"(?<=[。！？；!?;\n])|(?<=\.\s)")
+
+
+def _read_text_file(file_path: str, page_range=None) -> List[Tuple[str, str]]:
+    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+        return [("1", f.read())]
+
+
+def _read_pdf(file_path: str, page_range=None) -> List[Tuple[str, str]]:
+    try:
+        import fitz  # PyMuPDF
+        with fitz.open(file_path) as doc:
+            start, end = page_range or (0, doc.page_count)
+            return [(str(i + 1), doc[i].get_text()) for i in range(start, min(end, doc.page_count))]
+    except ImportError:
+        from pypdf import PdfReader
+        reader = PdfReader(file_path)
+        start, end = page_range or (0, len(reader.pages))
+        return [(str(i + 1), reader.pages[i].extract_text() or "") for i in range(start, min(end, len(reader.pages)))]
+
+
+def _read_docx(file_path: str, page_range=None) -> List[Tuple[str, str]]:
+    import docx
+    document = docx.Document(file_path)
+    lines = [p.text for p in document.paragraphs if p.text.strip()]
+    for table in document.tables:
+        for row in table.rows:
+            lines.append(" | ".join(cell.text.strip() for cell in row.cells))
+    return [("1", "\n".join(lines))]
+
+
+def _read_pptx(file_path: str, page_range=None) -> List[Tuple[str, str]]:
+    from pptx import Presentation
+    pages = []
+    slides = list(Presentation(file_path).slides)
+    start, end = page_range or (0, len(slides))
+    for i in range(start, min(end, len(slides))):
+        slide = slides[i]
+        texts = [shape.text_frame.text for shape in slide.shapes if shape.has_text_frame and shape.text_frame.text.strip()]
+        pages.append((str(i + 1), "\n".join(texts)))
+    return pages
+
+
+def _read_xlsx(file_path: str, page_range=None) -> List[Tuple[str, str]]:
+    from openpyxl import load_workbook
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    pages = []
+    try:
+        for sheet in workbook.worksheets:
+            rows = []
+            for row in sheet.iter_rows(values_only=True):
+                cells = [str(cell) for cell in row if cell is not None]
+                if cells:
+                    rows.append(" | ".join(cells))
+            pages.append((sheet.title, "\n".join(rows)))
+    finally:
+        workbook.close()
+    return pages
+
+
+def _read_html(file_path: str, page_range=None) -> List[Tuple[str, str]]:
+    from bs4 import BeautifulSoup
+    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+        soup = BeautifulSoup(f.read(), "html.parser")
+    return [("1", soup.get_text("\n"))]
+
+
+_readers = {
+    ".pdf": _read_pdf,
+    ".docx": _read_docx,
+    ".pptx": _read_pptx,
+    ".xlsx": _read_xlsx,
+    ".html": _read_html,
+    ".htm": _read_html,
+}
+
+
+def is_kb_document(file_path: str) -> bool:
+    """判断文件是否可以导入知识库"""
+    return os.path.splitext(file_path.lower())[1] in KB_DOCUMENT_EXTENSIONS
+
+
+def count_pages(file_path: str) -> int:
+    """返回 PDF 的页数，用于按页段拆分解析任务；其他格式返回 0（整文件解析）"""
+    if not file_path.lower().endswith(".pdf"):
+        return 0
+    try:
+        import fitz  # PyMuPDF
+        with fitz.open(file_path) as doc:
+            return doc.page_count
+    except ImportError:
+        from pypdf import PdfReader
+        return len(PdfReader(file_path).pages)
+
+
+def parse_document(file_path: str, page_range=None) -> List[Tuple[str, str]]:
+    """解析文档，返回 [(页码/工作表名, 文本)]；page_range=(起始页, 结束页) 只解析 PDF/PPTX 的部分页面"""
+    ext = os.path.splitext(file_path.lower())[1]
+    reader = _readers.get(ext, _read_text_file)
+    return reader(file_path, page_range)
+
+
+def iter_document_pages(file_path: str, start_page: int = 0) -> Iterator[Tuple[str, str]]:
+    """逐页读取文档，产出 (页码, 文本)，从第 start_page 页（从 0 开始）开始；PDF/PPTX 每次只持有一页文本"""
+    ext = os.path.splitext(file_path.lower())[1]
+    if ext == ".pdf":
+        try:
+            import fitz  # PyMuPDF
+        except ImportError:
+            fitz = None
+        if fitz is not None:
+            with fitz.open(file_path) as doc:
+                for i in range(start_page, doc.page_count):
+                    yield str(i + 1), doc.load_page(i).get_text()
+        else:
+            from pypdf import PdfReader
+            reader = PdfReader(file_path)
+            for i in range(start_page, len(reader.pages)):
+                yield str(i + 1), reader.pages[i].extract_text() or ""
+    elif ext == ".pptx":
+        from pptx import Presentation
+        for i, slide in enumerate(Presentation(file_path).slides):
+            if i < start_page:
+                continue
+            texts = [shape.text_frame.text for shape in slide.shapes if shape.has_text_frame and shape.text_frame.text.strip()]
+            yield str(i + 1), "\n".join(texts)
+    else:
+        for i, page in enumerate(parse_document(file_path)):
+            if i >= start_page:
+                yield page
+
+
+class TextChunker:
+    """流式分块器：逐页输入文本，跨页拼接，按句子边界输出固定大小的分块"""
+
+    def __init__(self, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self._buffer = ""
+        self._page = None
+
+    def get_state(self) -> dict:
+        """返回未输出的缓冲文本，用于断点续传"""
+        return {"buffer": self._buffer, "page": self._page}
+
+    def set_state(self, state: dict):
+        """从断点恢复缓冲文本"""
+        self._buffer = state.get("buffer", "")
+        self._page = state.get("page")
+
+    def feed(self, text: str, page: str) -> Iterator[Tuple[str, str]]:
+        """输入一页文本，产出已完整的分块 (分块文本, 起始页码)"""
+        for sentence in _sentence_end.split(text):
+            if not sentence:
+                continue
+            if not self._buffer.strip():
+                self._page = page
+            self._buffer += sentence
+            while len(self._buffer) >= self.chunk_size:
+                yield from self._emit(page)
+
+    def _emit(self, page: str) -> Iterator[Tuple[str, str]]:
+        cut = self.chunk_size
+        # 优先在分块尾部的句末标点处断开
+        match = None
+        for match in _sentence_end.finditer(self._buffer, self.chunk_size // 2, self.chunk_size):
+            pass
+        if match and match.start() > 0:
+            cut = match.start()
+        chunk = self._buffer[:cut].strip()
+        rest = self._buffer[cut:]
+        overlap = self._buffer[max(0, cut - self.chunk_overlap):cut] if self.chunk_overlap else ""
+        chunk_page = self._page
+        self._buffer = overlap + rest
+        self._page = page
+        if chunk:
+            yield chunk, chunk_page
+
+    def flush(self) -> Iterator[Tuple[str, str]]:
+        """输出剩余文本"""
+        chunk = self._buffer.strip()
+        self._buffer = ""
+        if chunk:
+            yield chunk, self._page
+
+
+def chunk_pages(pages: Iterable[Tuple[str, str]], chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP) -> Iterator[Tuple[str, str]]:
+    """把 [(页码, 文本)] 切分为 [(分块文本, 起始页码)]"""
+    chunker = TextChunker(chunk_size, chunk_overlap)
+    for page, text in pages:
+        yield from chunker.feed(text, page)
+    yield from chunker.flush()
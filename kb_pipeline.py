@@ -0,0 +1,183 @@
+"""
+知识库并行导入流水线
+
+解析（进程池，每个文件或 PDF 页段一个任务）→ 分块（主线程）→ 批量嵌入并写入 Chroma（嵌入线程），
+三个阶段重叠执行，解析吞吐随 CPU 核数增长。结束时报告 文档/秒 与 分块/秒。
+"""
+import os
+import time
+import threading
+from queue import Queue
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from kb_parsers import parse_document, count_pages, chunk_pages
+
+
+PAGES_PER_TASK = 50
+EMBED_BATCH_SIZE = 64
+EMBED_QUEUE_SIZE = 8
+
+
+class IngestPipeline:
+    """
+    并行导入流水线。
+    jobs：[{"rel_path", "abs_path", "file_hash"}]
+    build_nodes：把 (rel_path, file_hash, 分块列表, 向量列表, 起始序号) 组装为节点的函数
+    on_file_done(rel_path, chunk_ids)：文件全部分块写入后回调（在嵌入线程中调用）
+    on_file_failed(rel_path, error)：文件解析或嵌入失败时回调
+    """
+
+    def __init__(self, kb, embed_model, build_nodes, workers: int = None,
+                 embed_batch_size: int = EMBED_BATCH_SIZE, pages_per_task: int = PAGES_PER_TASK):
+        self.kb = kb
+        self.embed_model = embed_model
+        self.build_nodes = build_nodes
+        self.workers = workers or os.cpu_count() or 1
+        self.embed_batch_size = embed_batch_size
+        self.pages_per_task = pages_per_task
+        self._queue = Queue(maxsize=EMBED_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self.stats = {"docs": 0, "chunks": 0, "failed": 0}
+
+    def _plan_tasks(self, job):
+        """把一个文件拆分为解析任务：PDF 按页段拆分，其余格式整文件一个任务"""
+        try:
+            pages = count_pages(job["abs_path"])
+        except Exception:
+            pages = 0
+        if pages <= self.pages_per_task:
+            return [None]
+        return [(start, min(start + self.pages_per_task, pages)) for start in range(0, pages, self.pages_per_task)]
+
+    def run(self, jobs, on_file_done, on_file_failed) -> dict:
+        """执行流水线，返回统计信息"""
+        start = time.time()
+        embed_thread = threading.Thread(target=self._embed_stage, args=(on_file_done, on_file_failed), daemon=True)
+        embed_thread.start()
+        try:
+            self._parse_stage(jobs, on_file_failed)
+        finally:
+            self._queue.put(None)
+            embed_thread.join()
+
+        seconds = max(time.time() - start, 1e-6)
+        self.stats["seconds"] = round(seconds, 2)
+        self.stats["docs_per_sec"] = round(self.stats["docs"] / seconds, 2)
+        self.stats["chunks_per_sec"] = round(self.stats["chunks"] / seconds, 2)
+        print(f"导入流水线：{self.stats['docs']} 个文档，{self.stats['chunks']} 个分块，"
+              f"{self.stats['docs_per_sec']} 文档/秒，{self.stats['chunks_per_sec']} 分块/秒")
+        return self.stats
+
+    def _parse_stage(self, jobs, on_file_failed):
+        """进程池解析；文件的所有页段完成后按页序分块，交给嵌入阶段"""
+        pending = {}
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {}
+            for job in jobs:
+                ranges = self._plan_tasks(job)
+                pending[job["rel_path"]] = {"job": job, "parts": [None] * len(ranges), "left": len(ranges), "error": None}
+                for part, page_range in enumerate(ranges):
+                    future = executor.submit(parse_document, job["abs_path"], page_range)
+                    futures[future] = (job["rel_path"], part)
+
+            for future in as_completed(futures):
+                rel_path, part = futures[future]
+                state = pending[rel_path]
+                try:
+                    state["parts"][part] = future.result()
+                except Exception as e:
+                    state["error"] = e
+                state["left"] -= 1
+                if state["left"]:
+                    continue
+
+                del pending[rel_path]
+                if state["error"] is not None:
+                    self._fail(rel_path, state["error"], on_file_failed)
+                    continue
+                pages = [page for part_pages in state["parts"] for page in part_pages]
+                chunks = list(chunk_pages(pages))
+                self._queue.put((state["job"], chunks))
+
+    def _fail(self, rel_path, error, on_file_failed):
+        with self._lock:
+            self.stats["failed"] += 1
+        on_file_failed(rel_path, error)
+
+    def _embed_stage(self, on_file_done, on_file_failed):
+        """跨文件攒批嵌入并写入 Chroma；文件的全部分块写入后回调"""
+        batch = []  # [(job, 分块序号, (文本, 页码))]
+        progress = {}  # rel_path -> {"job": job, "left": 剩余分块数, "ids": [...], "failed": bool}
+
+        def flush():
+            if not batch:
+                return
+            items = list(batch)
+            batch.clear()
+            try:
+                embeddings = self.embed_model.get_text_embedding_batch([chunk[0] for _, _, chunk in items])
+                # 同一文件在批内的分块是连续的，按文件分组组装节点，整批只写入一次 Chroma
+                groups = []  # [(state, 分块列表, 向量列表, 起始序号)]
+                for (job, index, chunk), embedding in zip(items, embeddings):
+                    state = progress[job["rel_path"]]
+                    if state["failed"]:
+                        continue
+                    if groups and groups[-1][0] is state:
+                        groups[-1][1].append(chunk)
+                        groups[-1][2].append(embedding)
+                    else:
+                        groups.append((state, [chunk], [embedding], index))
+                nodes, owners = [], []
+                for state, chunks, vectors, start in groups:
+                    job = state["job"]
+                    group_nodes = self.build_nodes(job["rel_path"], job["file_hash"], chunks, vectors, start)
+                    nodes.extend(group_nodes)
+                    owners.extend([state] * len(group_nodes))
+                if nodes:
+                    node_ids = self.kb.vector_store.add(nodes)
+                    for state, node_id in zip(owners, node_ids):
+                        state["ids"].append(node_id)
+                error = None
+            except Exception as e:
+                error = e
+            for job, _, _ in items:
+                state = progress.get(job["rel_path"])
+                if state is None:
+                    continue
+                if error is not None and not state["failed"]:
+                    state["failed"] = True
+                    self._cleanup(state["ids"])
+                    self._fail(job["rel_path"], error, on_file_failed)
+                state["left"] -= 1
+                if state["left"] == 0:
+                    del progress[job["rel_path"]]
+                    if not state["failed"]:
+                        with self._lock:
+                            self.stats["docs"] += 1
+                            self.stats["chunks"] += len(state["ids"])
+                        on_file_done(job["rel_path"], state["ids"])
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            job, chunks = item
+            if not chunks:
+                with self._lock:
+                    self.stats["docs"] += 1
+                on_file_done(job["rel_path"], [])
+                continue
+            progress[job["rel_path"]] = {"job": job, "left": len(chunks), "ids": [], "failed": False}
+            for index, chunk in enumerate(chunks):
+                batch.append((job, index, chunk))
+                if len(batch) >= self.embed_batch_size:
+                    flush()
+        flush()
+
+    def _cleanup(self, chunk_ids):
+        """删除失败文件已写入的分块"""
+        if chunk_ids:
+            try:
+                self.kb.collection.delete(ids=list(chunk_ids))
+            except Exception:
+                pass
@@ -0,0 +1,465 @@
+"""
+知识库连接池
+
+进程内共享 Chroma 客户端、集合与向量索引，按知识库名称缓存。
+每个知识库只打开一次，HNSW 段常驻内存，查询时直接取出现成的检索器。
+每个用户/班级可以有自己的知识库（<名称>/chroma_db），首次查询时打开；
+已打开的知识库按 LRU 管理，超过数量上限或内存预算时淘汰最久未用的，空闲超时的由后台线程定期关闭。
+查询通过 kb_lease() 租用句柄，被淘汰的句柄等最后一个租用者归还后才真正关闭，不会在查询中途被关闭。
+"""
+import os
+import time
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from shared_utils import (
+    chromadb, ChromaVectorStore, StorageContext, VectorStoreIndex,
+    OllamaEmbedding, VectorIndexRetriever, VectorStoreQueryMode
+)
+from embedding_cache import CachedEmbedding, get_embedding_cache
+from embedding_batcher import BatchedEmbedding
+from bm25_index import build_bm25_from_collection, reciprocal_rank_fusion
+from vector_index import load_or_build_vector_index
+from rerank_cache import set_vector_score
+from llama_index.core.schema import NodeWithScore, TextNode
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+
+
+# 知识库集合的 HNSW 参数（与原 query_knowledge_base 保持一致）
+KB_COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 100,
+    "hnsw:M": 32
+}
+EMBEDDING_DIM = 1024
+# Ollama 服务地址（嵌入模型与启动预热共用）
+OLLAMA_BASE_URL = os.getenv("ollama_base_url", "http://localhost:11434")
+# 混合检索中向量检索的权重（其余为 BM25 关键词检索权重）
+HYBRID_ALPHA = 0.3
+# 向量检索后端：hnsw（Chroma 默认）、float16 / int8（内存映射旁路索引，精确暴力检索）
+VECTOR_BACKEND = os.getenv("kb_vector_backend", "hnsw")
+# 知识库池：最多同时打开的知识库数量、估算内存预算、空闲关闭时间；root 知识库常驻不淘汰
+DEFAULT_KBNAME = "root"
+KB_POOL_MAX_OPEN = 16
+KB_POOL_MEMORY_BUDGET_MB = 2048
+KB_POOL_IDLE_SECONDS = 1800
+# 后台检查空闲知识库的间隔（秒）
+KB_POOL_REAP_SECONDS = 60
+
+
+def get_kb_path(kbname: str) -> str:
+    """返回知识库的 chroma_db 目录"""
+    return os.path.join(kbname, "chroma_db")
+
+
+def resolve_kbname(logged_in_name: str) -> str:
+    """用户建有自己的知识库时使用该知识库，否则使用 root 公共知识库"""
+    if logged_in_name and os.path.isdir(get_kb_path(logged_in_name)):
+        return logged_in_name
+    return DEFAULT_KBNAME
+
+
+# 嵌入模型实例缓存（按模型名称共享）
+# 调用链：嵌入向量缓存 -> 微批合并 -> OllamaEmbedding
+_embed_models = {}
+_embed_lock = threading.Lock()
+
+
+def get_embed_model(embedding_model_name: str):
+    """获取共享的嵌入模型实例，避免每次查询重新创建；重复文本直接命中嵌入缓存"""
+    embed_model = _embed_models.get(embedding_model_name)
+    if embed_model is None:
+        with _embed_lock:
+            embed_model = _embed_models.get(embedding_model_name)
+            if embed_model is None:
+                embed_model = CachedEmbedding(
+                    BatchedEmbedding(
+                        OllamaEmbedding(
+                            model_name=embedding_model_name,
+                            base_url=OLLAMA_BASE_URL,
+                            embedding_dim=EMBEDDING_DIM
+                        )
+                    ),
+                    get_embedding_cache()
+                )
+                _embed_models[embedding_model_name] = embed_model
+    return embed_model
+
+
+class KnowledgeBaseHandle:
+    """单个知识库的已打开句柄：客户端、集合、向量存储与各嵌入模型对应的索引"""
+
+    def __init__(self, kbname: str):
+        self.kbname = kbname
+        self.path = get_kb_path(kbname)
+        self.client = chromadb.PersistentClient(path=self.path)
+        self.collection = self.client.get_or_create_collection(
+            name=kbname,
+            metadata=KB_COLLECTION_METADATA,
+        )
+        self.vector_store = ChromaVectorStore(chroma_collection=self.collection)
+        self.storage_context = StorageContext.from_defaults(vector_store=self.vector_store)
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self._lexical = None
+        self._lexical_fingerprint = None
+        self._lexical_lock = threading.Lock()
+        self._flats = {}  # 向量类型 -> (旁路索引, 集合指纹)
+        self._flat_lock = threading.Lock()
+        self._refs = 0
+        self._retired = False
+        self._closed = False
+        self._ref_lock = threading.Lock()
+        self.last_used = time.time()
+        # 最近一次读到的向量数量，供池在持锁时估算内存（不在锁内查询 SQLite）
+        try:
+            self.cached_count = self.collection.count()
+        except Exception:
+            self.cached_count = 0
+
+    def touch(self):
+        """记录最近一次使用时间"""
+        self.last_used = time.time()
+
+    def acquire(self) -> "KnowledgeBaseHandle":
+        """租用句柄（由连接池在持锁时调用），用完必须调用 release()"""
+        with self._ref_lock:
+            self._refs += 1
+        return self
+
+    def release(self):
+        """归还租用；句柄已被淘汰且没有其他租用者时关闭"""
+        with self._ref_lock:
+            self._refs -= 1
+            close = self._retired and self._refs == 0 and not self._closed
+            self._closed = self._closed or close
+        if close:
+            self.close()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def retire(self) -> bool:
+        """句柄已从池中移除（连接池持锁时调用）：没有租用者时返回 True，由调用方在锁外关闭；
+        否则等最后一个租用者归还时关闭"""
+        with self._ref_lock:
+            self._retired = True
+            close = self._refs == 0 and not self._closed
+            self._closed = self._closed or close
+        return close
+
+    def revive(self) -> bool:
+        """被淘汰但仍有租用者、尚未关闭的句柄重新放回池中时调用；已关闭时返回 False"""
+        with self._ref_lock:
+            if self._closed:
+                return False
+            self._retired = False
+            return True
+
+    def estimated_bytes(self) -> int:
+        """估算常驻内存：HNSW 向量与图（约 1.5 倍 float32 向量）+ BM25 索引 + 旁路索引；向量数量使用缓存值"""
+        size = int(self.cached_count * EMBEDDING_DIM * 4 * 1.5)
+        if self._lexical is not None:
+            size += sum(len(p) * 6 for p in self._lexical.postings_docs) + len(self._lexical.doc_ids) * 64
+        for flat, _ in list(self._flats.values()):
+            size += flat.scales.nbytes if flat.scales is not None else 0
+            size += len(flat.ids) * 64
+        return size
+
+    def close(self):
+        """释放索引、集合与客户端引用，让 HNSW 段可以被回收；chromadb 提供 close() 时一并关闭客户端"""
+        self._indexes.clear()
+        self._lexical = None
+        self._flats.clear()
+        close = getattr(self.client, "close", None)
+        if callable(close):
+            try:
+                close()
+            except Exception as e:
+                print(f"关闭知识库 {self.kbname} 出错: {e}")
+
+    def count(self) -> int:
+        """返回集合中的向量数量"""
+        self.cached_count = self.collection.count()
+        return self.cached_count
+
+    def fingerprint(self) -> tuple:
+        """返回集合的变更指纹（向量数量, chroma.sqlite3 修改时间），用于判断缓存是否失效"""
+        sqlite_path = os.path.join(self.path, "chroma.sqlite3")
+        mtime = os.path.getmtime(sqlite_path) if os.path.exists(sqlite_path) else 0.0
+        return (self.count(), mtime)
+
+    def get_index(self, embedding_model_name: str):
+        """获取绑定指定嵌入模型的索引（只构建一次）"""
+        index = self._indexes.get(embedding_model_name)
+        if index is None:
+            with self._lock:
+                index = self._indexes.get(embedding_model_name)
+                if index is None:
+                    index = VectorStoreIndex.from_vector_store(
+                        self.vector_store,
+                        storage_context=self.storage_context,
+                        embed_model=get_embed_model(embedding_model_name)
+                    )
+                    self._indexes[embedding_model_name] = index
+        return index
+
+    def get_retriever(self, embedding_model_name: str, similarity_top_k: int = 10,
+                      vector_store_query_mode=VectorStoreQueryMode.HYBRID, alpha: float = 0.3):
+        """基于共享索引创建检索器（检索器本身很轻量，每次调用新建）"""
+        return VectorIndexRetriever(
+            index=self.get_index(embedding_model_name),
+            similarity_top_k=similarity_top_k,
+            vector_store_query_mode=vector_store_query_mode,
+            alpha=alpha
+        )
+
+    def get_lexical_index(self):
+        """获取与集合同步的 BM25 索引；集合指纹变化时重建"""
+        fingerprint = self.fingerprint()
+        if self._lexical is None or self._lexical_fingerprint != fingerprint:
+            with self._lexical_lock:
+                if self._lexical is None or self._lexical_fingerprint != fingerprint:
+                    self._lexical = build_bm25_from_collection(self.collection)
+                    self._lexical_fingerprint = fingerprint
+        return self._lexical
+
+    def get_vector_index(self, dtype: str = "float16"):
+        """获取与集合同步的内存映射旁路索引（每种向量类型各自缓存、各自目录）；集合指纹变化时重新加载"""
+        fingerprint = self.fingerprint()
+        cached = self._flats.get(dtype)
+        if cached is None or cached[1] != fingerprint:
+            with self._flat_lock:
+                cached = self._flats.get(dtype)
+                if cached is None or cached[1] != fingerprint:
+                    cached = (load_or_build_vector_index(self, dtype), fingerprint)
+                    self._flats[dtype] = cached
+        return cached[0]
+
+    def vector_search(self, embedding_model_name: str, query: str, similarity_top_k: int = 10,
+                      query_embedding=None, vector_backend: str = VECTOR_BACKEND):
+        """向量检索，返回 NodeWithScore 列表；vector_backend 选择 HNSW 或旁路索引"""
+        if vector_backend == "hnsw":
+            retriever = self.get_retriever(
+                embedding_model_name,
+                similarity_top_k=similarity_top_k,
+                vector_store_query_mode=VectorStoreQueryMode.DEFAULT
+            )
+            return retriever.retrieve(query)
+        if query_embedding is None:
+            query_embedding = get_embed_model(embedding_model_name).get_query_embedding(query)
+        hits = self.get_vector_index(vector_backend).search(query_embedding, similarity_top_k)
+        nodes = self._load_nodes([node_id for node_id, _ in hits])
+        return [NodeWithScore(node=nodes[node_id], score=score) for node_id, score in hits if node_id in nodes]
+
+    def _load_nodes(self, node_ids):
+        """按ID从集合读取分块并转换为节点（用于仅被关键词检索命中的分块）"""
+        if not node_ids:
+            return {}
+        result = self.collection.get(ids=list(node_ids), include=["documents", "metadatas"])
+        nodes = {}
+        for node_id, text, metadata in zip(result["ids"], result["documents"], result["metadatas"]):
+            try:
+                node = metadata_dict_to_node(metadata or {})
+                node.set_content(text or "")
+            except Exception:
+                node = TextNode(id_=node_id, text=text or "", metadata=metadata or {})
+            nodes[node_id] = node
+        return nodes
+
+    def hybrid_retrieve(self, embedding_model_name: str, query: str, similarity_top_k: int = 10, alpha: float = HYBRID_ALPHA,
+                        query_embedding=None, vector_backend: str = VECTOR_BACKEND):
+        """向量检索与 BM25 关键词检索各取 top_k，按倒数排名融合后返回前 top_k 个节点；
+        节点分数为融合分数，原始向量相似度记录在节点元数据中（供重排序跳过判断）"""
+        vector_hits = self.vector_search(
+            embedding_model_name, query, similarity_top_k,
+            query_embedding=query_embedding, vector_backend=vector_backend
+        ) if alpha > 0 else []
+        lexical_hits = self.get_lexical_index().search(query, similarity_top_k) if alpha < 1 else []
+
+        nodes = {}
+        for hit in vector_hits:
+            if hit.score is not None:
+                set_vector_score(hit.node, hit.score)
+            nodes[hit.node.node_id] = hit.node
+        fused = reciprocal_rank_fusion(
+            [list(nodes.keys()), [node_id for node_id, _ in lexical_hits]],
+            [alpha, 1 - alpha]
+        )[:similarity_top_k]
+        nodes.update(self._load_nodes([node_id for node_id, _ in fused if node_id not in nodes]))
+        return [NodeWithScore(node=nodes[node_id], score=score) for node_id, score in fused if node_id in nodes]
+
+
+class KnowledgeBasePool:
+    """线程安全的知识库句柄池，按知识库名称缓存已打开的句柄，LRU + 内存预算 + 空闲超时淘汰"""
+
+    def __init__(self, max_open: int = KB_POOL_MAX_OPEN, memory_budget_mb: int = KB_POOL_MEMORY_BUDGET_MB,
+                 idle_seconds: float = KB_POOL_IDLE_SECONDS, pinned=(DEFAULT_KBNAME,),
+                 reap_seconds: float = KB_POOL_REAP_SECONDS):
+        self.max_open = max_open
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.idle_seconds = idle_seconds
+        self.reap_seconds = reap_seconds
+        self.pinned = set(pinned)
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+        self._reload_hooks = []
+        self._evictions = 0
+        # 已淘汰但仍有租用者的句柄：同名知识库再次打开时复用，避免两个句柄共用的 Chroma 系统被旧句柄关闭
+        self._retiring = {}
+        self._reaper = None
+
+    def get(self, kbname: str, lease: bool = False) -> KnowledgeBaseHandle:
+        """获取知识库句柄，首次访问时打开，并淘汰空闲或超出预算的句柄；lease 为 True 时同时租用句柄"""
+        self._start_reaper()
+        with self._lock:
+            handle = self._handles.get(kbname)
+            if handle is not None:
+                self._handles.move_to_end(kbname)
+                handle.touch()
+                return handle.acquire() if lease else handle
+            handle = self._retiring.pop(kbname, None)
+            if handle is not None and not handle.revive():
+                handle = None
+        if handle is None:
+            # 打开集合较慢，放在锁外进行
+            handle = KnowledgeBaseHandle(kbname)
+        with self._lock:
+            existing = self._handles.get(kbname)
+            if existing is not None:
+                handle = existing
+            else:
+                self._handles[kbname] = handle
+            self._handles.move_to_end(kbname)
+            handle.touch()
+            if lease:
+                handle.acquire()
+            evicted = self._select_evictions(kbname)
+        for old in evicted:
+            old.close()
+        return handle
+
+    @contextmanager
+    def lease(self, kbname: str):
+        """租用知识库句柄，with 块内句柄不会被关闭"""
+        handle = self.get(kbname, lease=True)
+        try:
+            yield handle
+        finally:
+            handle.release()
+
+    def _start_reaper(self):
+        """首次使用时启动后台线程，定期关闭空闲超时的知识库"""
+        if self._reaper is not None or self.reap_seconds <= 0:
+            return
+        with self._lock:
+            if self._reaper is not None:
+                return
+            self._reaper = threading.Thread(target=self._reap, name="kb-pool-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(self.reap_seconds)
+            try:
+                self.evict_idle()
+            except Exception as e:
+                print(f"关闭空闲知识库出错: {e}")
+
+    def _select_evictions(self, current: str) -> list:
+        """选出需要淘汰的句柄（调用方持有锁）：空闲超时的，以及超出数量/内存预算时最久未用的；
+        内存按句柄缓存的向量数量估算，不在锁内查询集合。返回没有租用者、需要由调用方在锁外关闭的句柄"""
+        now = time.time()
+        evicted = []
+        for name in list(self._handles):
+            handle = self._handles[name]
+            if name != current and name not in self.pinned and now - handle.last_used > self.idle_seconds:
+                evicted.append(self._handles.pop(name))
+        total = sum(handle.estimated_bytes() for handle in self._handles.values())
+        for name in list(self._handles):
+            if len(self._handles) <= self.max_open and total <= self.memory_budget:
+                break
+            if name == current or name in self.pinned:
+                continue
+            handle = self._handles.pop(name)
+            total -= handle.estimated_bytes()
+            evicted.append(handle)
+        self._evictions += len(evicted)
+        self._retiring = {name: handle for name, handle in self._retiring.items() if not handle.closed}
+        to_close = []
+        for handle in evicted:
+            print(f"关闭空闲知识库: {handle.kbname}")
+            if handle.retire():
+                to_close.append(handle)
+            else:
+                self._retiring[handle.kbname] = handle
+        return to_close
+
+    def evict_idle(self):
+        """关闭所有空闲超时的知识库"""
+        with self._lock:
+            evicted = self._select_evictions(None)
+        for handle in evicted:
+            handle.close()
+
+    def reload(self, kbname: str) -> KnowledgeBaseHandle:
+        """知识库重新导入后调用：重新打开集合并重建索引，然后通知已注册的回调"""
+        # 新句柄与旧句柄共用同一 Chroma 客户端系统，旧句柄不关闭，只丢弃其索引
+        handle = KnowledgeBaseHandle(kbname)
+        with self._lock:
+            self._handles.pop(kbname, None)
+            self._handles[kbname] = handle
+            hooks = list(self._reload_hooks)
+        for hook in hooks:
+            try:
+                hook(kbname)
+            except Exception as e:
+                print(f"知识库重载回调出错: {e}")
+        return handle
+
+    def add_reload_hook(self, hook):
+        """注册知识库重载回调，回调参数为知识库名称"""
+        with self._lock:
+            self._reload_hooks.append(hook)
+
+    def peek(self, kbname: str):
+        """返回已打开的知识库句柄，未打开时返回 None（不打开、不更新使用时间）"""
+        with self._lock:
+            return self._handles.get(kbname)
+
+    def loaded(self) -> list[str]:
+        """返回已打开的知识库名称列表"""
+        return list(self._handles.keys())
+
+    def stats(self) -> dict:
+        """返回已打开的知识库数量、估算内存与淘汰次数"""
+        with self._lock:
+            handles = list(self._handles.values())
+            evictions = self._evictions
+        return {
+            "open": len(handles),
+            "memory_mb": round(sum(handle.estimated_bytes() for handle in handles) / 1024 / 1024, 1),
+            "evictions": evictions,
+        }
+
+
+# 进程内全局知识库池
+kb_pool = KnowledgeBasePool()
+
+
+def get_kb(kbname: str) -> KnowledgeBaseHandle:
+    """获取知识库句柄（不租用，句柄被淘汰后可能关闭；服务内查询请使用 kb_lease）"""
+    return kb_pool.get(kbname)
+
+
+def kb_lease(kbname: str):
+    """租用知识库句柄：with kb_lease(名称) as kb: ...，块内句柄不会被关闭"""
+    return kb_pool.lease(kbname)
+
+
+def reload_kb(kbname: str) -> KnowledgeBaseHandle:
+    """重新加载知识库（知识库重新导入后调用）"""
+    return kb_pool.reload(kbname)
@@ -0,0 +1,115 @@
+"""
+按请求隔离的流式输出通道
+
+智能体和工具原来通过 print 输出，由 run_agent_workflow_stream 把进程全局的 sys.stdout 换成队列写入器收集；
+多个请求并发时会互相抢走输出、恢复错误的 stdout。
+现在每次工作流运行创建一个 OutputChannel（asyncio 队列），通过上下文变量绑定到运行工作流的任务上，
+工具调用 emit() 写入结构化事件。工作流内部创建的任务和 asyncio.to_thread 线程都会继承上下文变量，
+因此并发请求各自输出、互不干扰。没有绑定通道时（命令行、基准测试）emit 退回到 print。
+"""
+import asyncio
+import contextvars
+from typing import AsyncIterator, NamedTuple, Optional
+
+from stream_frames import STREAM_FRAME_INTERVAL
+
+
+# 事件类型：delta（智能体 LLM 流式输出）、text（工具输出）、error（错误信息）
+EVENT_KINDS = ("delta", "text", "error")
+
+
+class OutputEvent(NamedTuple):
+    kind: str
+    text: str
+
+
+class OutputChannel:
+    """一次工作流运行的输出通道，可在事件循环线程和工作线程中写入，在事件循环中异步读取"""
+
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self.closed = False
+
+    def put(self, event: Optional[OutputEvent]):
+        """写入一个事件（None 为结束标记）；在其他线程中调用时转交给事件循环"""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._queue.put_nowait(event)
+        elif not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, event)
+
+    def close(self):
+        """发送结束标记"""
+        if not self.closed:
+            self.closed = True
+            self.put(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> OutputEvent:
+        event = await self._queue.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    async def frames(self, interval: float = STREAM_FRAME_INTERVAL) -> AsyncIterator[str]:
+        """
+        功能：按帧读取输出：距上一帧已超过 interval 时立即输出，否则收集到下一帧时刻再合并输出。
+        参数：interval：帧间隔（秒）。
+        返回：异步生成器，每项为一帧内所有事件文本的拼接。
+        """
+        last_sent = None
+        finished = False
+        while not finished:
+            event = await self._queue.get()
+            if event is None:
+                return
+            parts = [event.text]
+            deadline = self._loop.time() if last_sent is None else last_sent + interval
+            while True:
+                # 先取走已经到达的事件，再等待到下一帧时刻
+                while not self._queue.empty():
+                    event = self._queue.get_nowait()
+                    if event is None:
+                        finished = True
+                        break
+                    parts.append(event.text)
+                remaining = deadline - self._loop.time()
+                if finished or remaining <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if event is None:
+                    finished = True
+                    break
+                parts.append(event.text)
+            last_sent = self._loop.time()
+            yield "".join(parts)
+
+
+# 当前请求的输出通道
+current_channel: contextvars.ContextVar[Optional[OutputChannel]] = contextvars.ContextVar(
+    "current_channel", default=None
+)
+
+
+def emit(*values, sep: str = " ", end: str = "\n", flush: bool = False, kind: str = "text"):
+    """
+    功能：向当前请求的输出通道写入一个事件，参数与 print 一致。
+    参数：values/sep/end：同 print；flush：兼容 print，忽略；kind：事件类型（delta/text/error）。
+    返回：无。未绑定通道时直接 print。
+    """
+    channel = current_channel.get()
+    if channel is None:
+        print(*values, sep=sep, end=end, flush=flush)
+        return
+    text = sep.join(str(value) for value in values) + end
+    if text.strip():
+        channel.put(OutputEvent(kind, text))
@@ -0,0 +1,121 @@
+"""
+重排序结果缓存与跳过策略
+
+1. 按（查询哈希, 有序节点ID）缓存 qwen3-rerank 的排序结果，相同查询与候选集不再请求网络。
+2. 向量检索分数已经明显分层时（第 k 名与第 k+1 名的分差超过阈值），前 k 个结果已确定，跳过重排序。
+   混合检索的节点分数是倒数排名融合分数，不是余弦相似度，分差判断使用检索时记录在节点元数据中的原始向量相似度。
+"""
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from embedding_cache import normalize_text
+
+
+logger = logging.getLogger(__name__)
+
+RERANK_CACHE_MAX_ENTRIES = 2048
+RERANK_SKIP_GAP = 0.1
+RERANK_LOG_EVERY = 50
+# 节点元数据中记录原始向量相似度（余弦）的键，仅被关键词检索命中的节点没有该值
+VECTOR_SCORE_KEY = "vector_score"
+
+
+def set_vector_score(node, score: float):
+    """在节点元数据中记录原始向量相似度，并排除在发给 LLM 和嵌入模型的元数据之外"""
+    node.metadata[VECTOR_SCORE_KEY] = score
+    for keys in (node.excluded_llm_metadata_keys, node.excluded_embed_metadata_keys):
+        if VECTOR_SCORE_KEY not in keys:
+            keys.append(VECTOR_SCORE_KEY)
+
+
+def get_vector_score(node_with_score) -> Optional[float]:
+    """返回节点的原始向量相似度，没有时返回 None"""
+    return (node_with_score.node.metadata or {}).get(VECTOR_SCORE_KEY)
+
+
+def sort_by_vector_score(nodes) -> list:
+    """按原始向量相似度降序排列节点（跳过重排序时使用，融合顺序不一定与向量顺序一致）"""
+    return sorted(nodes, key=lambda node: get_vector_score(node) or 0.0, reverse=True)
+
+
+class RerankCache:
+    """重排序结果缓存，附带网络调用节省统计"""
+
+    def __init__(self, max_entries: int = RERANK_CACHE_MAX_ENTRIES, skip_gap: float = RERANK_SKIP_GAP):
+        self.max_entries = max_entries
+        self.skip_gap = skip_gap
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.network_calls = 0
+        self.cache_hits = 0
+        self.skipped = 0
+
+    @staticmethod
+    def make_key(query: str, node_ids: List[str]) -> tuple:
+        query_hash = hashlib.sha1(normalize_text(query).encode("utf-8")).hexdigest()
+        return (query_hash, tuple(node_ids))
+
+    def get(self, query: str, node_ids: List[str]) -> Optional[List[Tuple[int, float]]]:
+        """返回缓存的 [(原始下标, 相关性分数)]，未命中返回 None"""
+        key = self.make_key(query, node_ids)
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                return None
+            self._entries.move_to_end(key)
+            self.cache_hits += 1
+        self._log_avoided()
+        return result
+
+    def put(self, query: str, node_ids: List[str], result: List[Tuple[int, float]]):
+        """缓存一次重排序结果"""
+        key = self.make_key(query, node_ids)
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self.network_calls += 1
+
+    def should_skip(self, nodes, top_k: int = 5) -> bool:
+        """原始向量相似度在第 top_k 名处分差超过阈值时，按向量相似度排序后的前 top_k 个结果已确定，可跳过重排序
+        （调用方需用 sort_by_vector_score 按向量顺序返回）；有节点缺少向量相似度（仅被关键词检索命中）时不跳过"""
+        scores = [get_vector_score(node) for node in nodes]
+        if len(scores) <= top_k or any(score is None for score in scores):
+            return False
+        scores = sorted(scores, reverse=True)
+        if scores[top_k - 1] - scores[top_k] < self.skip_gap:
+            return False
+        with self._lock:
+            self.skipped += 1
+        self._log_avoided()
+        return True
+
+    def record_network_call(self):
+        """记录一次未缓存的网络重排序（例如请求失败时）"""
+        with self._lock:
+            self.network_calls += 1
+
+    def _log_avoided(self):
+        stats = self.stats()
+        if stats["avoided"] % RERANK_LOG_EVERY == 1:
+            logger.info("重排序：已避免 %d 次网络调用（缓存命中 %d，分差跳过 %d，实际调用 %d）",
+                        stats["avoided"], stats["cache_hits"], stats["skipped"], stats["network_calls"])
+
+    def stats(self) -> dict:
+        """返回网络调用与节省统计"""
+        with self._lock:
+            return {
+                "network_calls": self.network_calls,
+                "cache_hits": self.cache_hits,
+                "skipped": self.skipped,
+                "avoided": self.cache_hits + self.skipped,
+                "entries": len(self._entries),
+            }
+
+
+# 进程内共享的重排序缓存
+rerank_cache = RerankCache()
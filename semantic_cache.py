@@ -0,0 +1,107 @@
+"""
+知识库语义答案缓存
+
+保存（查询向量, 检索到的节点ID, 最终答案），新查询与已缓存查询的余弦相似度
+超过阈值时直接返回缓存答案，跳过检索、重排序和 LLM 生成。
+知识库集合发生变化（向量数量或 chroma.sqlite3 修改时间变化、或知识库重载）时自动失效。
+"""
+import time
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_MAX_ENTRIES = 1024
+
+
+class SemanticAnswerCache:
+    """按（知识库, 模型）分区的语义答案缓存"""
+
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._partitions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _partition(self, kbname: str, model_name: str, fingerprint) -> OrderedDict:
+        """获取分区；知识库指纹变化时清空该分区（调用方持有锁）"""
+        key = (kbname, model_name)
+        partition = self._partitions.get(key)
+        if partition is None or partition["fingerprint"] != fingerprint:
+            if partition is not None:
+                self.invalidations += 1
+            partition = {"fingerprint": fingerprint, "entries": OrderedDict(), "matrix": None}
+            self._partitions[key] = partition
+        return partition
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, kbname: str, model_name: str, fingerprint, embedding) -> Optional[dict]:
+        """查找相似度超过阈值的缓存答案，返回 {"answer", "node_ids", "similarity"} 或 None"""
+        query = self._normalize(embedding)
+        with self._lock:
+            partition = self._partition(kbname, model_name, fingerprint)
+            entries = partition["entries"]
+            if not entries:
+                self.misses += 1
+                return None
+            if partition["matrix"] is None:
+                partition["matrix"] = np.stack([entry["vector"] for entry in entries.values()])
+                partition["keys"] = list(entries.keys())
+            similarities = partition["matrix"] @ query
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.threshold:
+                self.misses += 1
+                return None
+            key = partition["keys"][best]
+            entry = entries[key]
+            entries.move_to_end(key)
+            self.hits += 1
+            return {"answer": entry["answer"], "node_ids": entry["node_ids"], "similarity": similarity}
+
+    def store(self, kbname: str, model_name: str, fingerprint, embedding, node_ids: List[str], answer: str):
+        """缓存一次查询的答案"""
+        vector = self._normalize(embedding)
+        with self._lock:
+            partition = self._partition(kbname, model_name, fingerprint)
+            entries = partition["entries"]
+            key = vector.tobytes()
+            entries[key] = {"vector": vector, "node_ids": list(node_ids), "answer": answer, "created": time.time()}
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            partition["matrix"] = None
+
+    def invalidate(self, kbname: str):
+        """清空指定知识库的所有分区"""
+        with self._lock:
+            for key in [k for k in self._partitions if k[0] == kbname]:
+                del self._partitions[key]
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        """返回命中统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "entries": sum(len(p["entries"]) for p in self._partitions.values()),
+            }
+
+
+# 进程内共享的语义答案缓存
+semantic_cache = SemanticAnswerCache()
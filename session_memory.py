@@ -0,0 +1,220 @@
+"""
+按会话隔离的对话记忆
+
+原来同一用户、同一组设置的所有浏览器会话共用 AgentRagService 上的一个 ChatMemoryBuffer，并且永久常驻内存。
+现在按 session_id 保存对话记忆：活跃会话常驻内存，空闲超时或超出数量/内存上限时用 JsonSerializer
+序列化到磁盘并释放，下次请求时再从磁盘加载。正在处理请求的会话不会被换出。
+空闲超时由后台线程定期检查；同一会话的换出按顺序写入，每次写入使用独立的临时文件。
+"""
+import os
+import sys
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+from shared_utils import JsonSerializer, ChatMemoryBuffer
+
+
+logger = logging.getLogger(__name__)
+
+SESSION_MEMORY_DIR = "SessionMemory"
+SESSION_MEMORY_TOKEN_LIMIT = 8192
+SESSION_MEMORY_MAX_HOT = 256
+SESSION_MEMORY_BUDGET_MB = 256
+SESSION_MEMORY_IDLE_SECONDS = 600
+# 后台检查空闲会话的间隔（秒）
+SESSION_MEMORY_REAP_SECONDS = 60
+# 换出写入的锁分段数（同一会话总是落在同一把锁上）
+SESSION_SPILL_LOCKS = 64
+
+
+def _memory_bytes(memory) -> int:
+    """估算一个对话记忆占用的内存"""
+    try:
+        return sum(sys.getsizeof(str(message.content or "")) for message in memory.get_all())
+    except Exception:
+        return 0
+
+
+class SessionMemoryStore:
+    """线程安全的会话记忆存储：活跃会话在内存中，空闲会话换出到磁盘"""
+
+    def __init__(self, directory: str = SESSION_MEMORY_DIR, max_hot: int = SESSION_MEMORY_MAX_HOT,
+                 memory_budget_mb: int = SESSION_MEMORY_BUDGET_MB, idle_seconds: float = SESSION_MEMORY_IDLE_SECONDS,
+                 token_limit: int = SESSION_MEMORY_TOKEN_LIMIT, reap_seconds: float = SESSION_MEMORY_REAP_SECONDS):
+        self.directory = directory
+        self.max_hot = max_hot
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.idle_seconds = idle_seconds
+        self.token_limit = token_limit
+        self.reap_seconds = reap_seconds
+        self._serializer = JsonSerializer()
+        self._sessions = OrderedDict()
+        # 已从内存移出、正在写入磁盘的会话：session_id -> (记忆, 换出序号)，写完前再次请求时直接取回，避免读到旧文件
+        self._spilling = {}
+        self._spill_seq = 0
+        self._spill_locks = [threading.Lock() for _ in range(SESSION_SPILL_LOCKS)]
+        self._lock = threading.Lock()
+        self._reaper = None
+        self.loads = 0
+        self.spills = 0
+
+    def _path(self, session_id: str) -> str:
+        name = hashlib.sha1(session_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{name}.json")
+
+    def _load(self, session_id: str):
+        """从磁盘加载会话记忆，不存在或损坏时创建新的"""
+        path = self._path(session_id)
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    memory = self._serializer.deserialize(f.read())
+                self.loads += 1
+                return memory
+            except Exception as e:
+                logger.warning("加载会话记忆 %s 失败: %s", session_id, e)
+        return ChatMemoryBuffer.from_defaults(token_limit=self.token_limit)
+
+    def _is_current_spill(self, session_id: str, seq: int) -> bool:
+        """换出是否仍是该会话最新的一次（调用方持有锁）"""
+        pending = self._spilling.get(session_id)
+        return pending is not None and pending[1] == seq
+
+    def _spill(self, session_id: str, memory, seq: int):
+        """
+        把会话记忆写入磁盘：同一会话的换出串行执行，已有更新的换出时跳过本次写入；
+        每次写入独立的临时文件再替换，只有最新一次换出写完后才从 _spilling 中移除。
+        """
+        lock = self._spill_locks[int(hashlib.sha1(session_id.encode("utf-8")).hexdigest(), 16) % len(self._spill_locks)]
+        with lock:
+            with self._lock:
+                if not self._is_current_spill(session_id, seq):
+                    return
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(session_id)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    f.write(self._serializer.serialize(memory))
+                os.replace(tmp_path, path)
+                self.spills += 1
+            except Exception as e:
+                logger.warning("保存会话记忆 %s 失败: %s", session_id, e)
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            finally:
+                with self._lock:
+                    if self._is_current_spill(session_id, seq):
+                        del self._spilling[session_id]
+
+    def acquire(self, session_id: str):
+        """
+        功能：取得会话的对话记忆并标记为使用中（请求结束后须调用 release）。
+        参数：session_id：会话ID。
+        返回：ChatMemoryBuffer。
+        """
+        self._start_reaper()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None and session_id in self._spilling:
+                entry = {"memory": self._spilling[session_id][0], "active": 0}
+                self._sessions[session_id] = entry
+            if entry is not None:
+                entry["active"] += 1
+                entry["last_used"] = time.time()
+                self._sessions.move_to_end(session_id)
+                return entry["memory"]
+        # 磁盘读取放在锁外进行
+        memory = self._load(session_id)
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                entry = {"memory": memory, "active": 0}
+                self._sessions[session_id] = entry
+            entry["active"] += 1
+            entry["last_used"] = time.time()
+            self._sessions.move_to_end(session_id)
+            return entry["memory"]
+
+    def release(self, session_id: str):
+        """请求结束：取消使用中标记，并换出空闲或超出上限的会话"""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                entry["active"] -= 1
+                entry["last_used"] = time.time()
+            evicted = self._select_spills()
+        for spilled_id, memory, seq in evicted:
+            self._spill(spilled_id, memory, seq)
+
+    def _select_spills(self) -> list:
+        """选出需要换出的会话（调用方持有锁）：空闲超时的，以及超出数量/内存上限时最久未用的；
+        返回 [(session_id, 记忆, 换出序号)]"""
+        now = time.time()
+        evicted = []
+        for session_id in list(self._sessions):
+            entry = self._sessions[session_id]
+            if entry["active"] == 0 and now - entry["last_used"] > self.idle_seconds:
+                evicted.append((session_id, self._sessions.pop(session_id)["memory"]))
+        total = sum(_memory_bytes(entry["memory"]) for entry in self._sessions.values())
+        for session_id in list(self._sessions):
+            if len(self._sessions) <= self.max_hot and total <= self.memory_budget:
+                break
+            entry = self._sessions[session_id]
+            if entry["active"]:
+                continue
+            total -= _memory_bytes(entry["memory"])
+            evicted.append((session_id, self._sessions.pop(session_id)["memory"]))
+        spills = []
+        for session_id, memory in evicted:
+            self._spill_seq += 1
+            self._spilling[session_id] = (memory, self._spill_seq)
+            spills.append((session_id, memory, self._spill_seq))
+        return spills
+
+    def spill_idle(self):
+        """换出所有空闲超时的会话"""
+        with self._lock:
+            evicted = self._select_spills()
+        for session_id, memory, seq in evicted:
+            self._spill(session_id, memory, seq)
+
+    def _start_reaper(self):
+        """首次使用时启动后台线程，定期换出空闲超时的会话"""
+        if self._reaper is not None or self.reap_seconds <= 0:
+            return
+        with self._lock:
+            if self._reaper is not None:
+                return
+            self._reaper = threading.Thread(target=self._reap, name="session-memory-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(self.reap_seconds)
+            try:
+                self.spill_idle()
+            except Exception as e:
+                logger.warning("换出空闲会话出错: %s", e)
+
+    def stats(self) -> dict:
+        """返回内存中的会话数、估算内存，以及从磁盘加载/换出到磁盘的次数"""
+        with self._lock:
+            entries = list(self._sessions.values())
+        return {
+            "hot": len(entries),
+            "active": sum(1 for entry in entries if entry["active"]),
+            "memory_mb": round(sum(_memory_bytes(entry["memory"]) for entry in entries) / 1024 / 1024, 2),
+            "loads": self.loads,
+            "spills": self.spills,
+        }
+
+
+# 进程内共享的会话记忆存储
+session_memories = SessionMemoryStore()
@@ -0,0 +1,128 @@
+"""
+知识库查询与联网搜索的推测执行
+
+提示词命中系统提示词中的时间敏感/事实查询触发词时，在智能体开始推理前就并行启动知识库查询和联网搜索，
+智能体调用对应工具时，工具参数与推测查询（原始提示词）规范化后一致才取用已在进行中的结果，否则正常调用；
+知识库结果的原始向量相似度足够高时提前取消联网搜索，工作流结束时取消所有未被使用的任务。
+"""
+import re
+import asyncio
+import logging
+import threading
+import contextvars
+from typing import Optional
+
+from embedding_cache import normalize_text
+from rerank_cache import get_vector_score
+
+
+logger = logging.getLogger(__name__)
+
+# 与 IVAgent 系统提示词“联网搜索自动触发条件”中的时间敏感、新闻、事实、数据类触发词保持一致
+WEB_SEARCH_TRIGGERS = (
+    # 时间敏感
+    "最新", "现在", "今天", "当前", "实时", "近期", "最近",
+    # 新闻事件
+    "新闻", "事件", "报道", "消息", "动态", "疫情", "股市", "天气", "黄金价格", "汇率",
+    # 事实查询
+    "是什么", "什么是", "定义", "解释", "介绍", "概念", "who", "what", "when",
+    # 数据查询
+    "数据", "统计", "排名", "价格", "股价", "数字", "百分比",
+)
+# 知识库结果的最高原始向量相似度（余弦）达到该值时认为本地结果足够，取消联网搜索
+# 节点分数是融合/重排序分数，量纲不同，不能直接比较
+KB_CONFIDENT_SCORE = 0.6
+
+_trigger_pattern = re.compile(
+    "|".join(rf"(?<![a-z]){re.escape(t)}(?![a-z])" if t.isascii() else re.escape(t) for t in WEB_SEARCH_TRIGGERS),
+    re.IGNORECASE,
+)
+
+# 当前工作流运行的推测任务（工具调用在工作流内部的任务中执行，会继承该上下文变量）
+current_speculation: contextvars.ContextVar[Optional["SpeculativeSearch"]] = contextvars.ContextVar(
+    "current_speculation", default=None
+)
+
+_stats = {"runs": 0, "kb_used": 0, "web_used": 0, "web_cancelled_early": 0, "cancelled_unused": 0, "query_mismatch": 0}
+_stats_lock = threading.Lock()
+
+
+def matches_web_search_triggers(prompt: str) -> bool:
+    """提示词是否命中联网搜索触发词"""
+    return bool(_trigger_pattern.search(prompt or ""))
+
+
+def _normalize_query(text: str) -> str:
+    """规范化查询文本用于比较：全角转半角、合并空白、忽略大小写和句末标点"""
+    return normalize_text(text).lower().rstrip("?？。.!！ ")
+
+
+def _count(name: str):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+class SpeculativeSearch:
+    """
+    一次工作流运行中预先并行启动的知识库查询与联网搜索。
+    推测任务直接调用服务的内部实现（不经过工具入口），不会取用自己的结果。
+    """
+
+    def __init__(self, service, prompt: str):
+        self.prompt = prompt
+        self._query = _normalize_query(prompt)
+        # 与工作流中注册的知识库工具保持同一模式
+        kb_impl = service._aquery_knowledge_base_passages if service.kb_mode == "passages" else service._aquery_knowledge_base
+        self.tasks = {
+            "kb": asyncio.create_task(kb_impl(prompt, echo=False, on_retrieved=self._on_kb_retrieved)),
+            "web": asyncio.create_task(service._aweb_search(prompt, echo=False)),
+        }
+        _count("runs")
+
+    def _on_kb_retrieved(self, nodes):
+        """知识库检索完成后，最高原始向量相似度足够高则提前取消联网搜索（只被关键词命中的节点没有该值）"""
+        scores = [score for score in (get_vector_score(node) for node in nodes or []) if score is not None]
+        if scores and max(scores) >= KB_CONFIDENT_SCORE:
+            task = self.tasks.get("web")
+            if task is not None and not task.done():
+                task.cancel()
+                _count("web_cancelled_early")
+
+    async def take(self, name: str, query: str) -> Optional[str]:
+        """
+        功能：取用推测任务的结果（每个任务只能取用一次）。
+        参数：name：kb 或 web；query：工具调用实际传入的查询文本。
+        返回：推测结果；查询与推测查询规范化后不一致、任务不存在、已取消或失败时返回 None，由调用方正常调用。
+        """
+        if name not in self.tasks:
+            return None
+        if _normalize_query(query) != self._query:
+            # 保留任务，工作流结束时统一取消
+            _count("query_mismatch")
+            return None
+        task = self.tasks.pop(name)
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            if task.cancelled():
+                return None
+            raise
+        except Exception as e:
+            logger.info("推测任务 %s 失败，改为正常调用: %s", name, e)
+            return None
+        _count(f"{name}_used")
+        return result
+
+    def cancel_pending(self):
+        """取消未被取用的推测任务"""
+        for task in self.tasks.values():
+            if not task.done():
+                task.cancel()
+                _count("cancelled_unused")
+        self.tasks.clear()
+
+
+def get_speculation_stats() -> dict:
+    """返回推测执行统计"""
+    with _stats_lock:
+        return dict(_stats)
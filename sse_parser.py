@@ -0,0 +1,113 @@
+"""
+增量 SSE 流解析
+
+DashScope 兼容模式的流式接口按 SSE 格式返回 "data: {...}\n\n"，一个事件可能被拆到多个 TCP 分块中，
+一个分块也可能包含多个事件。原来按分块 decode 并假设分块以 "data:" 开头，跨分块的事件会被悄悄丢弃。
+SSEParser 把分块追加到 bytearray 缓冲区，在缓冲区内查找行边界（不复制整个分块、不 decode 整个分块），
+只把 data 字段的负载交给 json.loads，输出类型化的事件：delta（增量文本）、usage（token 用量）、done（结束标记）。
+"""
+import json
+import logging
+from typing import Iterable, Iterator, NamedTuple, Optional, AsyncIterable, AsyncIterator
+
+
+logger = logging.getLogger(__name__)
+
+# 缓冲区已处理部分超过该大小时才整体前移，避免每个事件都移动缓冲区
+SSE_COMPACT_BYTES = 64 * 1024
+
+# 负载已去掉前导空白，直接用 raw_decode，省去 json.loads 的编码检测和首尾空白匹配
+_raw_decode = json.JSONDecoder().raw_decode
+
+
+class SSEEvent(NamedTuple):
+    kind: str                       # delta / usage / done
+    text: str = ""
+    usage: Optional[dict] = None
+
+
+DONE_EVENT = SSEEvent("done")
+
+
+class SSEParser:
+    """增量 SSE 解析器：feed() 传入任意切分的字节分块，返回已完整到达的事件"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._pos = 0
+        self._data = []
+        self.errors = 0
+
+    def feed(self, chunk: bytes) -> list:
+        """追加一个分块，返回其中完整的事件列表"""
+        buffer = self._buffer
+        buffer += chunk
+        events = []
+        pos = self._pos
+        while True:
+            end = buffer.find(b"\n", pos)
+            if end < 0:
+                break
+            line_end = end - 1 if end > pos and buffer[end - 1] == 0x0D else end
+            if line_end == pos:
+                # 空行：事件结束
+                self._dispatch(events)
+            elif buffer.startswith(b"data:", pos):
+                start = pos + 6 if buffer.startswith(b"data: ", pos) else pos + 5
+                # 只复制 data 负载本身（直接解码为 str 交给 JSON 解析）
+                self._data.append(buffer[start:line_end].decode("utf-8", errors="replace"))
+            # 其他字段（event:、id:、注释）忽略
+            pos = end + 1
+        if pos >= SSE_COMPACT_BYTES or pos == len(buffer):
+            del buffer[:pos]
+            pos = 0
+        self._pos = pos
+        return events
+
+    def close(self) -> list:
+        """流结束：处理缓冲区中没有以空行结尾的最后一个事件"""
+        events = self.feed(b"\n") if self._pos < len(self._buffer) else []
+        self._dispatch(events)
+        return events
+
+    def _dispatch(self, events: list):
+        if not self._data:
+            return
+        payload = self._data[0] if len(self._data) == 1 else "\n".join(self._data)
+        self._data = []
+        if payload == "[DONE]" or payload.strip() == "[DONE]":
+            events.append(DONE_EVENT)
+            return
+        try:
+            data = _raw_decode(payload.lstrip())[0]
+        except json.JSONDecodeError as e:
+            self.errors += 1
+            logger.warning("SSE 数据解析失败: %s", e)
+            return
+        choices = data.get("choices")
+        if choices:
+            content = (choices[0].get("delta") or {}).get("content")
+            if content:
+                events.append(SSEEvent("delta", content))
+        if data.get("usage"):
+            events.append(SSEEvent("usage", usage=data["usage"]))
+
+
+def iter_sse(chunks: Iterable[bytes]) -> Iterator[SSEEvent]:
+    """解析同步字节流（如 requests 的 response.iter_content(chunk_size=None)）"""
+    parser = SSEParser()
+    for chunk in chunks:
+        if chunk:
+            yield from parser.feed(chunk)
+    yield from parser.close()
+
+
+async def aiter_sse(chunks: AsyncIterable[bytes]) -> AsyncIterator[SSEEvent]:
+    """解析异步字节流（如 httpx 的 response.aiter_bytes()）"""
+    parser = SSEParser()
+    async for chunk in chunks:
+        if chunk:
+            for event in parser.feed(chunk):
+                yield event
+    for event in parser.close():
+        yield event
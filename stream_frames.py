@@ -0,0 +1,122 @@
+"""
+流式输出按帧合并
+
+后端流式接口每个 token 都产出一次完整的累积文本，chat_with_history 再把整个对话历史拼到前面，
+4000 个 token 的回答要经过 Gradio 队列发送 O(n²) 字节。这里把 token 按固定节奏（默认 80 毫秒）合并成帧：
+同步生成器用 coalesce_frames 只转发每帧最新的累积结果（首个结果立即转发，挂起的结果在帧时刻补发，
+上游停顿时也不会滞留在服务端）；
+智能体工作流的输出通道用 OutputChannel.frames 按同样的节奏定时合并。
+Gradio 对生成器的连续输出按差异发送，新值以旧值为前缀时只发送追加部分，
+因此 chat_with_history 流式过程中的帧保持“只追加”的形式（AI 消息在最后一帧才闭合）。
+"""
+import time
+import queue
+import threading
+import functools
+import contextvars
+from typing import Optional
+
+
+STREAM_FRAME_INTERVAL = 0.08
+
+_END = object()
+
+
+class FrameCoalescer:
+    """
+    按帧合并的状态：距上一帧已超过 interval 的结果立即转发，否则挂起（只保留最新一个），
+    到帧时刻（上一帧 + interval）时转发挂起的结果。时间由调用方传入，便于用模拟时钟测量。
+    """
+
+    def __init__(self, interval: float = STREAM_FRAME_INTERVAL):
+        self.interval = interval
+        self.last_sent = None
+        self.pending = None
+        self.has_pending = False
+
+    def offer(self, item, now: float) -> list:
+        """新到一个结果，返回需要立即转发的结果列表"""
+        if self.last_sent is None or now - self.last_sent >= self.interval:
+            self.last_sent = now
+            self.has_pending = False
+            self.pending = None
+            return [item]
+        self.pending = item
+        self.has_pending = True
+        return []
+
+    def deadline(self) -> Optional[float]:
+        """挂起结果的转发时刻；没有挂起结果时返回 None"""
+        return self.last_sent + self.interval if self.has_pending else None
+
+    def flush(self, now: float) -> list:
+        """帧时刻到达或流结束：返回挂起的结果"""
+        if not self.has_pending:
+            return []
+        item = self.pending
+        self.last_sent = now
+        self.has_pending = False
+        self.pending = None
+        return [item]
+
+
+def coalesce_frames(items, interval: float = STREAM_FRAME_INTERVAL):
+    """
+    功能：合并累积式流式输出：距上一帧不足 interval 的结果只保留最新一个，到帧时刻再转发，
+          上游停顿时最后一段文本也会按时显示，不必等到下一个结果。
+    参数：items：产出累积结果的可迭代对象（在后台线程中迭代）；interval：帧间隔（秒）。
+    返回：生成器，产出的每一项都是原始结果之一，最后一项一定是原始的最后一项。
+    """
+    results = queue.Queue()
+    stop = threading.Event()
+
+    def pump():
+        iterator = iter(items)
+        try:
+            for item in iterator:
+                results.put((item, None))
+                if stop.is_set():
+                    break
+        except BaseException as e:
+            results.put((_END, e))
+            return
+        finally:
+            close = getattr(iterator, "close", None)
+            if stop.is_set() and close is not None:
+                close()
+        results.put((_END, None))
+
+    # 上游生成器可能依赖上下文变量，在复制的上下文中迭代
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(pump,), name="stream-frames", daemon=True).start()
+    coalescer = FrameCoalescer(interval)
+    try:
+        while True:
+            deadline = coalescer.deadline()
+            try:
+                if deadline is None:
+                    item, error = results.get()
+                else:
+                    item, error = results.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                yield from coalescer.flush(time.monotonic())
+                continue
+            if item is _END:
+                if error is not None:
+                    # 先转发已收到的挂起结果，再抛出上游的异常
+                    yield from coalescer.flush(time.monotonic())
+                    raise error
+                break
+            yield from coalescer.offer(item, time.monotonic())
+        yield from coalescer.flush(time.monotonic())
+    finally:
+        # 调用方提前停止读取时，让后台线程在下一个结果后关闭上游生成器
+        stop.set()
+
+
+def coalesced_stream(func):
+    """装饰流式生成器函数，输出按帧合并"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        yield from coalesce_frames(func(*args, **kwargs))
+    return wrapper
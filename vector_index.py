@@ -0,0 +1,201 @@
+"""
+内存映射的紧凑向量旁路索引
+
+把集合中的向量归一化后按 float16 或 int8（逐行缩放）连续存放在 chroma_db 旁边的 .npy 文件中（每种类型一个目录），
+查询时 mmap 加载，按固定行数分块转为 float32 做矩阵乘法（走 BLAS），每块保留 top 候选，
+再从 Chroma 读取候选的原始向量重新打分。对几万个分块的知识库，比 HNSW 更快且结果确定（召回率为 1）。
+默认不保存 float32 副本以保持索引紧凑；设置 kb_vector_keep_f32=1 时额外保存副本，重新打分不再访问 Chroma。
+"""
+import os
+import json
+import logging
+import threading
+from typing import List, Tuple
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+VECTOR_INDEX_DIR = "vector_index"
+# 候选数量 = top_k * RESCORE_FACTOR，候选用 float32 原始向量重新打分
+RESCORE_FACTOR = 4
+# 检索时每次转为 float32 参与矩阵乘法的行数（1024 维时约 16MB 临时内存）
+VECTOR_SEARCH_BLOCK = 4096
+# 是否额外保存 float32 向量副本（用于重新打分）
+VECTOR_INDEX_KEEP_F32 = os.getenv("kb_vector_keep_f32", "0") == "1"
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def get_vector_index_path(kb_path: str, dtype: str) -> str:
+    """返回知识库某种向量类型的旁路索引目录（与 chroma_db 同级）"""
+    return os.path.join(os.path.dirname(kb_path), f"{VECTOR_INDEX_DIR}_{dtype}")
+
+
+def iter_collection_vectors(collection, page_size: int = 1000):
+    """分页读取集合中的向量，逐页产出 (ID列表, 归一化后的 float32 矩阵)"""
+    offset = 0
+    while True:
+        result = collection.get(include=["embeddings"], limit=page_size, offset=offset)
+        page_ids = result.get("ids") or []
+        if not page_ids:
+            break
+        yield page_ids, _normalize(np.asarray(result["embeddings"], dtype=np.float32))
+        offset += len(page_ids)
+
+
+class FlatVectorIndex:
+    """float16 / int8 量化的内存映射向量矩阵，支持精确 top-k 检索"""
+
+    def __init__(self, path: str, collection=None):
+        self.path = path
+        self.collection = collection
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        with open(os.path.join(path, "ids.json"), "r", encoding="utf-8") as f:
+            self.ids: List[str] = json.load(f)
+        self.dtype = self.meta["dtype"]
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        f32_path = os.path.join(path, "vectors_f32.npy")
+        self.vectors_f32 = np.load(f32_path, mmap_mode="r") if self.meta.get("keep_f32") and os.path.exists(f32_path) else None
+        self.scales = np.load(os.path.join(path, "scales.npy")) if self.dtype == "int8" else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def fingerprint(self) -> list:
+        return self.meta.get("fingerprint")
+
+    def search(self, query_embedding, top_k: int = 10, rescore_factor: int = RESCORE_FACTOR,
+               block: int = VECTOR_SEARCH_BLOCK) -> List[Tuple[str, float]]:
+        """返回 [(分块ID, 余弦相似度)]，按相似度降序"""
+        n = len(self.ids)
+        if n == 0:
+            return []
+        query = _normalize(np.asarray(query_embedding, dtype=np.float32))
+        candidates = min(n, max(top_k, top_k * rescore_factor))
+        hits = np.empty(0, dtype=np.int64)
+        approx = np.empty(0, dtype=np.float32)
+        # float16/int8 没有 BLAS 路径，分块复制到复用的 float32 缓冲区再相乘
+        buffer = np.empty((min(block, n), self.vectors.shape[1]), dtype=np.float32)
+        for start in range(0, n, block):
+            rows = buffer[:min(block, n - start)]
+            np.copyto(rows, self.vectors[start:start + block])
+            scores = rows @ query
+            if self.scales is not None:
+                scores *= self.scales[start:start + block]
+            top = np.argpartition(-scores, candidates - 1)[:candidates] if len(scores) > candidates else np.arange(len(scores))
+            hits = np.concatenate([hits, top + start])
+            approx = np.concatenate([approx, scores[top]])
+            if len(hits) > candidates:
+                keep = np.argpartition(-approx, candidates - 1)[:candidates]
+                hits, approx = hits[keep], approx[keep]
+        order = np.argsort(hits)
+        hits, approx = hits[order], approx[order]
+        exact = self._rescore(hits, query, approx)
+        order = np.argsort(-exact)[:top_k]
+        return [(self.ids[hits[i]], float(exact[i])) for i in order]
+
+    def _rescore(self, hits: np.ndarray, query: np.ndarray, approx: np.ndarray) -> np.ndarray:
+        """候选用 float32 原始向量重新打分：优先用本地副本，否则从 Chroma 读取候选向量；都不可用时保留量化分数"""
+        if self.vectors_f32 is not None:
+            return self.vectors_f32[hits] @ query
+        if self.collection is None:
+            return approx
+        ids = [self.ids[i] for i in hits]
+        try:
+            result = self.collection.get(ids=ids, include=["embeddings"])
+        except Exception as e:
+            logger.warning("读取候选向量失败，使用量化分数: %s", e)
+            return approx
+        embeddings = dict(zip(result.get("ids") or [], result["embeddings"]))
+        exact = approx.copy()
+        found = [i for i, doc_id in enumerate(ids) if doc_id in embeddings]
+        if found:
+            vectors = _normalize(np.asarray([embeddings[ids[i]] for i in found], dtype=np.float32))
+            exact[found] = vectors @ query
+        return exact
+
+
+def build_vector_index(collection, path: str, dtype: str = "float16", fingerprint=None, page_size: int = 1000,
+                       keep_f32: bool = VECTOR_INDEX_KEEP_F32) -> FlatVectorIndex:
+    """从 Chroma 集合分页读取向量，写入内存映射矩阵；dtype 为 float16 或 int8，keep_f32 时额外保存 float32 副本"""
+    if dtype not in ("float16", "int8"):
+        raise ValueError(f"不支持的向量类型: {dtype}")
+    total = collection.count()
+    os.makedirs(path, exist_ok=True)
+    names = ["vectors"] + (["vectors_f32"] if keep_f32 else [])
+    ids = []
+    arrays = {}
+    scales = np.ones(total, dtype=np.float32)
+    offset = 0
+    for page_ids, batch in iter_collection_vectors(collection, page_size):
+        if offset + len(page_ids) > total:
+            break
+        if not arrays:
+            dim = batch.shape[1]
+            for name in names:
+                arrays[name] = np.lib.format.open_memmap(
+                    os.path.join(path, f"{name}.tmp.npy"), mode="w+", shape=(total, dim),
+                    dtype=np.float32 if name == "vectors_f32" else (np.int8 if dtype == "int8" else np.float16))
+        end = offset + len(page_ids)
+        if keep_f32:
+            arrays["vectors_f32"][offset:end] = batch
+        if dtype == "int8":
+            page_scales = np.abs(batch).max(axis=1) / 127.0
+            page_scales[page_scales == 0] = 1.0
+            arrays["vectors"][offset:end] = np.round(batch / page_scales[:, None]).astype(np.int8)
+            scales[offset:end] = page_scales
+        else:
+            arrays["vectors"][offset:end] = batch.astype(np.float16)
+        ids.extend(page_ids)
+        offset = end
+
+    if not arrays:
+        for name in names:
+            np.save(os.path.join(path, f"{name}.tmp.npy"), np.zeros((0, 0), dtype=np.float16))
+    else:
+        for array in arrays.values():
+            array.flush()
+    arrays.clear()
+    # 集合在构建期间发生变化时，截断到实际读取的行数
+    if len(ids) != total:
+        for name in names:
+            data = np.load(os.path.join(path, f"{name}.tmp.npy"))[:len(ids)]
+            np.save(os.path.join(path, f"{name}.tmp.npy"), data)
+        scales = scales[:len(ids)]
+    for name in names:
+        os.replace(os.path.join(path, f"{name}.tmp.npy"), os.path.join(path, f"{name}.npy"))
+    if not keep_f32 and os.path.exists(os.path.join(path, "vectors_f32.npy")):
+        os.remove(os.path.join(path, "vectors_f32.npy"))
+    np.save(os.path.join(path, "scales.npy"), scales)
+    with open(os.path.join(path, "ids.json"), "w", encoding="utf-8") as f:
+        json.dump(ids, f)
+    with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"dtype": dtype, "count": len(ids), "keep_f32": keep_f32,
+                   "fingerprint": list(fingerprint) if fingerprint else None}, f)
+    return FlatVectorIndex(path, collection)
+
+
+_build_lock = threading.Lock()
+
+
+def load_or_build_vector_index(kb, dtype: str = "float16") -> FlatVectorIndex:
+    """加载知识库旁路索引；不存在或与集合指纹不一致时重建"""
+    path = get_vector_index_path(kb.path, dtype)
+    fingerprint = list(kb.fingerprint())
+    try:
+        index = FlatVectorIndex(path, kb.collection)
+        if index.fingerprint == fingerprint and index.dtype == dtype:
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    with _build_lock:
+        print(f"正在构建向量旁路索引: {path}")
+        return build_vector_index(kb.collection, path, dtype=dtype, fingerprint=fingerprint)
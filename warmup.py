@@ -0,0 +1,162 @@
+"""
+启动预热
+
+demo.launch 前在后台线程中依次预热：加载 Ollama 嵌入模型（keep_alive 常驻）、打开知识库并触发 HNSW 段与 BM25 索引加载、
+预创建默认模型组合的 AgentRagService、建立到 DashScope 的 HTTPS 连接。
+预热进度通过 get_warmup_status_markdown() 显示在界面上。
+"""
+import time
+import threading
+import logging
+
+from shared_utils import QWEN_OPENAI_API_BASE
+
+
+logger = logging.getLogger(__name__)
+
+# Ollama 嵌入模型常驻时间
+OLLAMA_KEEP_ALIVE = "24h"
+WARMUP_STEPS = [
+    ("embed", "嵌入模型"),
+    ("kb", "知识库索引"),
+    ("service", "智能体服务"),
+    ("http", "DashScope 连接"),
+]
+
+_status = {name: {"state": "pending", "seconds": 0.0, "error": ""} for name, _ in WARMUP_STEPS}
+_status_lock = threading.Lock()
+_thread = None
+
+
+def _warm_embed(embedding_model_name: str, **_):
+    """加载嵌入模型并设置 keep_alive，避免首个问题等待模型加载"""
+    from kb_pool import get_embed_model, OLLAMA_BASE_URL
+    try:
+        import ollama
+        # 与 OllamaEmbedding 使用同一个服务地址
+        ollama.Client(host=OLLAMA_BASE_URL).embed(model=embedding_model_name, input="预热", keep_alive=OLLAMA_KEEP_ALIVE)
+    except ImportError:
+        # 带时间戳，绕过嵌入缓存
+        get_embed_model(embedding_model_name).get_query_embedding(f"预热 {time.time()}")
+
+
+def _warm_kb(embedding_model_name: str, kbname: str, **_):
+    """打开知识库，做一次查询加载 HNSW 段，并构建 BM25 / 旁路索引"""
+    from kb_pool import kb_lease, get_embed_model, VECTOR_BACKEND
+    with kb_lease(kbname) as kb:
+        if kb.count() == 0:
+            return
+        embedding = get_embed_model(embedding_model_name).get_query_embedding("预热")
+        kb.collection.query(query_embeddings=[embedding], n_results=1, include=[])
+        kb.get_index(embedding_model_name)
+        kb.get_lexical_index()
+        if VECTOR_BACKEND != "hnsw":
+            kb.get_vector_index(VECTOR_BACKEND)
+
+
+def _warm_service(model_name: str, embedding_model_name: str, logged_in_name: str, kb_mode: str, **_):
+    """预创建默认模型组合的智能体服务（编译工作流、创建 LLM 客户端）"""
+    from shared_utils import getnvr_url
+    from agent_rag_service import get_agent_rag_service
+    nvr1_url, nvr2_url = getnvr_url(logged_in_name)
+    get_agent_rag_service(model_name, embedding_model_name, logged_in_name, nvr1_url, nvr2_url, kb_mode=kb_mode)
+
+
+def _warm_http(model_name: str, embedding_model_name: str, logged_in_name: str, kb_mode: str, **_):
+    """通过智能体服务的 LLM 客户端和共享 HTTP 会话各请求一次模型列表，建立并保留 TLS 连接"""
+    from shared_utils import getnvr_url
+    from agent_rag_service import get_agent_rag_service
+    nvr1_url, nvr2_url = getnvr_url(logged_in_name)
+    service = get_agent_rag_service(model_name, embedding_model_name, logged_in_name, nvr1_url, nvr2_url, kb_mode=kb_mode)
+    try:
+        service.llm._get_client().models.list()
+    except Exception as e:
+        # 只需要建立连接，接口本身报错不影响预热
+        logger.info("预热 %s 返回: %s", QWEN_OPENAI_API_BASE, e)
+    # 同时为共享的同步 HTTP 会话建立一条 keep-alive 连接
+    from http_client import get_http_session, endpoint_timeout
+    try:
+        get_http_session().get(f"{QWEN_OPENAI_API_BASE}/models", headers={"Authorization": f"Bearer {service.dashscope_api_key}"},
+                               timeout=endpoint_timeout("task"))
+    except Exception as e:
+        logger.info("预热共享 HTTP 会话返回: %s", e)
+
+
+_step_functions = {
+    "embed": _warm_embed,
+    "kb": _warm_kb,
+    "service": _warm_service,
+    "http": _warm_http,
+}
+
+
+def _set_status(name: str, **values):
+    with _status_lock:
+        _status[name].update(values)
+
+
+def _run(steps, **kwargs):
+    for name in steps:
+        _set_status(name, state="running")
+        start = time.time()
+        try:
+            _step_functions[name](**kwargs)
+            _set_status(name, state="done", seconds=round(time.time() - start, 2))
+        except Exception as e:
+            _set_status(name, state="failed", seconds=round(time.time() - start, 2), error=str(e))
+            logger.warning("预热步骤 %s 失败: %s", name, e)
+    logger.info("预热完成: %s", get_warmup_status())
+
+
+def start_warmup(model_name: str, embedding_model_name: str, logged_in_name: str = "root",
+                 kbname: str = "root", steps=None, kb_mode: str = "generate") -> threading.Thread:
+    """
+    功能：在后台线程中执行预热（重复调用只启动一次）。
+    参数：model_name/embedding_model_name/logged_in_name：需要预创建的默认服务组合；kbname：预热的知识库；
+          steps：预热步骤列表，默认全部（embed、kb、service、http）；kb_mode：智能体知识库工具模式。
+    返回：预热线程。
+    """
+    global _thread
+    with _status_lock:
+        if _thread is not None:
+            return _thread
+        steps = [name for name in (steps or _step_functions) if name in _step_functions]
+        for name in _status:
+            if name not in steps:
+                _status[name]["state"] = "skipped"
+        _thread = threading.Thread(
+            target=_run,
+            args=(steps,),
+            kwargs={"model_name": model_name, "embedding_model_name": embedding_model_name,
+                    "logged_in_name": logged_in_name, "kbname": kbname, "kb_mode": kb_mode},
+            name="warmup",
+            daemon=True,
+        )
+        _thread.start()
+    return _thread
+
+
+def get_warmup_status() -> dict:
+    """返回各预热步骤的状态"""
+    with _status_lock:
+        return {name: dict(status) for name, status in _status.items()}
+
+
+def is_ready() -> bool:
+    """所有预热步骤都已结束（成功、失败或跳过）"""
+    return all(status["state"] in ("done", "failed", "skipped") for status in get_warmup_status().values())
+
+
+def get_warmup_status_markdown() -> str:
+    """返回用于界面显示的预热状态"""
+    icons = {"pending": "⏳", "running": "🔄", "done": "✅", "failed": "⚠️", "skipped": "➖"}
+    status = get_warmup_status()
+    parts = []
+    for name, label in WARMUP_STEPS:
+        item = status[name]
+        text = f"{icons[item['state']]} {label}"
+        if item["state"] == "done":
+            text += f" {item['seconds']}s"
+        parts.append(text)
+    title = "系统已就绪" if is_ready() else "系统预热中"
+    return f"<p style='text-align: center;font-size: 12px;'>{title}：{' | '.join(parts)}</p>"
@@ -0,0 +1,124 @@
+"""
+联网搜索结果缓存
+
+web_search 每次都会请求开启 enable_search 的 DashScope 对话接口，几分钟内的相同问题也会重复请求。
+按（模型名称, 规范化查询）缓存流式返回的完整文本与 usage，按查询的时效类别设置不同的过期时间：
+实时类（天气、汇率、股价、黄金价格等）很快过期，定义类（是什么、定义等）长时间有效，其余使用默认时间。
+统计命中率、节省的上游调用次数与 token 数。
+"""
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from embedding_cache import normalize_text
+
+
+logger = logging.getLogger(__name__)
+
+WEB_SEARCH_CACHE_MAX_ENTRIES = 1024
+WEB_SEARCH_CACHE_LOG_EVERY = 20
+# 时效类别：(名称, 关键词, 过期秒数)，按顺序匹配，实时类优先（“今天天气是什么”按实时类处理）
+WEB_SEARCH_FRESHNESS_CLASSES = (
+    ("realtime", ("天气", "汇率", "股价", "黄金价格", "股市", "实时", "最新", "今天", "现在", "当前"), 10 * 60),
+    ("definition", ("是什么", "什么是", "定义", "概念", "含义", "解释"), 7 * 24 * 3600),
+)
+WEB_SEARCH_DEFAULT_CLASS = "default"
+WEB_SEARCH_DEFAULT_TTL = 60 * 60
+
+
+def classify_freshness(query: str) -> tuple:
+    """返回查询的 (时效类别, 过期秒数)"""
+    query = normalize_text(query).lower()
+    for name, keywords, ttl in WEB_SEARCH_FRESHNESS_CLASSES:
+        if any(keyword in query for keyword in keywords):
+            return name, ttl
+    return WEB_SEARCH_DEFAULT_CLASS, WEB_SEARCH_DEFAULT_TTL
+
+
+class WebSearchCache:
+    """联网搜索结果的 TTL 缓存，附带命中率与节省统计"""
+
+    def __init__(self, max_entries: int = WEB_SEARCH_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.expired = 0
+        self.upstream_calls = 0
+        self.tokens_saved = 0
+        self.class_hits = {}
+
+    @staticmethod
+    def make_key(model_name: str, query: str) -> str:
+        raw = f"{model_name}\0{normalize_text(query)}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def get(self, model_name: str, query: str) -> Optional[dict]:
+        """返回未过期的缓存结果 {"text", "usage", "freshness"}，未命中返回 None"""
+        key = self.make_key(model_name, query)
+        now = time.time()
+        with self._lock:
+            self.lookups += 1
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry["expires_at"] <= now:
+                del self._entries[key]
+                self.expired += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.tokens_saved += (entry["usage"] or {}).get("total_tokens", 0)
+            self.class_hits[entry["freshness"]] = self.class_hits.get(entry["freshness"], 0) + 1
+        self._log_saved()
+        return {"text": entry["text"], "usage": entry["usage"], "freshness": entry["freshness"]}
+
+    def put(self, model_name: str, query: str, text: str, usage: Optional[dict] = None):
+        """缓存一次上游搜索的完整文本与 usage（过期时间由查询的时效类别决定）"""
+        freshness, ttl = classify_freshness(query)
+        key = self.make_key(model_name, query)
+        with self._lock:
+            self._entries[key] = {
+                "text": text,
+                "usage": usage,
+                "freshness": freshness,
+                "expires_at": time.time() + ttl,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def record_upstream_call(self):
+        """记录一次实际的上游搜索请求（无论成功与否）"""
+        with self._lock:
+            self.upstream_calls += 1
+
+    def _log_saved(self):
+        stats = self.stats()
+        if stats["hits"] % WEB_SEARCH_CACHE_LOG_EVERY == 1:
+            logger.info("联网搜索缓存：命中率 %.1f%%，已节省 %d 次上游调用、%d tokens（实际调用 %d，按类别命中 %s）",
+                        stats["hit_rate"] * 100, stats["upstream_calls_saved"], stats["tokens_saved"],
+                        stats["upstream_calls"], stats["class_hits"])
+
+    def stats(self) -> dict:
+        """返回命中率与节省统计"""
+        with self._lock:
+            return {
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "expired": self.expired,
+                "upstream_calls": self.upstream_calls,
+                "upstream_calls_saved": self.hits,
+                "tokens_saved": self.tokens_saved,
+                "class_hits": dict(self.class_hits),
+                "entries": len(self._entries),
+            }
+
+
+# 进程内共享的联网搜索缓存
+web_search_cache = WebSearchCache()